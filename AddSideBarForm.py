@@ -9,6 +9,12 @@ if "form_responses" not in st.session_state:
     st.session_state.form_responses = {}
 if "should_generate_response" not in st.session_state:
     st.session_state.should_generate_response = False
+# "Draft full proposal" writes each section in parallel, see drafting.py
+# Also add 'from drafting import start_draft' to your imports
+if "draft_requested" not in st.session_state:
+    st.session_state.draft_requested = False
+if "proposal_draft" not in st.session_state:
+    st.session_state.proposal_draft = None
 
 
 # Add form to sidebar
@@ -28,63 +34,81 @@ if "should_generate_response" not in st.session_state:
         if submit_button:
             st.session_state.form_submitted = True
             st.session_state.should_generate_response = True
+        draft_button = st.form_submit_button("Draft full proposal")
+        if draft_button:
+            st.session_state.form_submitted = True
+            st.session_state.draft_requested = True
 
 # Handle form submission and generate response
-# Add this code AFTER display chat message code block and BEFORE user_input = st.chat_input("Your message:")
-# Handle form submission and generate response
+# Add this code AFTER the sidebar code block and BEFORE the chat_pane() call.
+# The form's message goes into the chat pane's queue like a typed message, so it is answered by
+# the generation pool and, with "Reuse answers to identical questions" on, the same answers from
+# another user are served from the response cache. The template is built in a fixed order so
+# identical answers always produce identical text.
 if st.session_state.should_generate_response:
     # Create combined prompt from responses
     combined_prompt = "Form Responses:\n"
     for q, a in st.session_state.form_responses.items():
-        combined_prompt += f"{q}: {a}\n"
-    
-    # Add user message to chat history
-    current_message = {"role": "user", "content": combined_prompt}
-    st.session_state.messages.append(current_message)
+        combined_prompt += f"{q}: {a.strip()}\n"
+    st.session_state.pending_prompts.append(combined_prompt)
+    st.session_state.should_generate_response = False
 
-    with st.chat_message("user"):
-        st.markdown(current_message["content"])
 
-    # Generate and display assistant response
-    with st.chat_message("assistant"):
-        message_placeholder = st.empty()
+# Draft a full proposal, one section per request, all sections at the same time
+# Add this code AFTER the draw_output() definition and BEFORE the chat_pane() call.
+# Each section streams into its own expander as it is written; when every section is done
+# they are joined into one document that is added to the chat and offered as a download.
+# The draft is drawn by a fragment that refreshes on its own and returns straight away, so the
+# chat below keeps working while the sections are written. Each section's job is drawn with
+# the chat pane's draw_output().
+@st.fragment(run_every=0.5)
+def show_draft(draft):
+    if draft.done:
+        # Rerun the whole app so the finished draft is added to the chat
+        st.rerun()
+    for section in draft.sections:
+        with st.expander(section.title, expanded=True):
+            job = section.job
+            if job.status == "failed":
+                st.error(f"This section could not be drafted: {job.error}")
+            else:
+                draw_output(st.empty(), job)
+    if st.button("Stop drafting"):
+        draft.cancel()
+    st.caption(f"Drafting: {draft.sections_done}/{len(draft.sections)} sections done, {draft.elapsed:.0f}s")
 
-        # Initialize chat session if needed
-        if st.session_state.chat_session is None:
-            generation_config = {
-                "temperature": st.session_state.temperature,
-                "top_p": 0.95,
-                "top_k": 40,
-                "max_output_tokens": 8192,
-            }
-            model = genai.GenerativeModel(
-                model_name=st.session_state.model_name,
-                generation_config=generation_config,
-            )
-            
-            initial_messages = [
-                {"role": "user", "parts": [f"System: {system_prompt}"]},
-                {"role": "model", "parts": ["Understood. I will follow these instructions."]},
-            ]
-            
-            if st.session_state.pdf_content:
-                initial_messages.extend([
-                    {"role": "user", "parts": [f"The following is the content of an uploaded PDF document. Please consider this information when responding to user queries:\n\n{st.session_state.pdf_content}"]},
-                    {"role": "model", "parts": ["I have received and will consider the PDF content in our conversation."]}
-                ])
-            
-            st.session_state.chat_session = model.start_chat(history=initial_messages)
 
-        # Generate response with error handling
-        try:
-            response = st.session_state.chat_session.send_message(current_message["content"])
-            full_response = response.text
-            message_placeholder.markdown(full_response)
-            st.session_state.messages.append({"role": "assistant", "content": full_response})
-            st.session_state.debug.append("Assistant response generated")
-        except Exception as e:
-            st.error(f"An error occurred while generating the response: {e}")
-            st.session_state.debug.append(f"Error: {e}")
+if st.session_state.draft_requested:
+    st.session_state.draft_requested = False
+    record_message({"role": "user", "content": "Draft a full proposal from my form answers."})
+    try:
+        st.session_state.proposal_draft = start_draft(
+            st.session_state.form_responses,
+            st.session_state.model_name,
+            st.session_state.temperature,
+            system_prompt,
+            "" if st.session_state.use_retrieval else st.session_state.workspace.combined_text(),
+            allow_fallback=st.session_state.allow_fallback,
+            # With retrieval on, each section is sent the excerpts that match it instead of the whole text
+            retrieval_sources=st.session_state.workspace.sources() if st.session_state.use_retrieval else (),
+        )
+    except Exception as e:
+        st.error(f"Could not start the proposal draft: {e}")
 
-    st.session_state.should_generate_response = False
-    st.rerun()
+draft = st.session_state.proposal_draft
+if draft is not None and not draft.done:
+    show_draft(draft)
+elif draft is not None:
+    document = draft.stitch()
+    record_message({"role": "assistant", "content": document})
+    if st.session_state.chat_session is not None:
+        # Let the chat model see the draft so the user can ask for changes to it
+        history = list(st.session_state.chat_session.history)
+        history.extend([
+            {"role": "user", "parts": ["Draft a full proposal from my form answers."]},
+            {"role": "model", "parts": [document]},
+        ])
+        st.session_state.chat_session.history = history
+    st.session_state.trace.event(draft.timing())
+    st.session_state.proposal_draft = None
+    st.download_button("Download proposal draft", document, file_name="proposal_draft.md")
@@ -1,11 +1,22 @@
 import streamlit as st
 import google.generativeai as genai
 from PIL import Image
-import requests
+from engine import engine
+from streaming import send_reply, describe_result
+from resilience import call_with_retry
+from file_uploads import file_uploads
+from perplexity import perplexity_client, split_queries, search_many, merge_results
+from tracing import Trace, format_span
 
 # Streamlit configuration
 st.set_page_config(page_title="Welcome to Grantbuddy!", layout="wide")
 
+# Timed spans for each stage of a run, shown in the sidebar; see tracing.py
+if "trace" not in st.session_state:
+    st.session_state.trace = Trace()
+trace = st.session_state.trace
+trace.begin_run()
+
 # Add this code between st.set_page_config(page_title="Streamlit Chatbot", layout="wide") and Display image code block
 if "form_submitted" not in st.session_state:
     st.session_state.form_submitted = False
@@ -21,8 +32,9 @@ if "should_generate_response" not in st.session_state:
 # To use a different image, replace 'Build2.png' with your desired image file name (e.g., 'my_custom_image.jpg').
 image_path = 'Grantbuddy.webp'
 try:
-    image = Image.open(image_path)
-    st.image(image, caption='Created by Awelama Kwarase (2024)', use_column_width=True)
+    with trace.span("image load"):
+        image = Image.open(image_path)
+        st.image(image, caption='Created by Awelama Kwarase (2024)', use_column_width=True)
 except Exception as e:
     st.error(f"Error loading image: {e}")
 
@@ -46,12 +58,12 @@ if "model_name" not in st.session_state:
     st.session_state.model_name = "gemini-1.5-pro-002"
 if "temperature" not in st.session_state:
     st.session_state.temperature = 0.5
-if "debug" not in st.session_state:
-    st.session_state.debug = []
 if "pdf_content" not in st.session_state:
     st.session_state.pdf_content = ""
 if "chat_session" not in st.session_state:
     st.session_state.chat_session = None
+if "stream_responses" not in st.session_state:
+    st.session_state.stream_responses = True
 
 # Sidebar for model and temperature selection
 with st.sidebar:
@@ -66,25 +78,45 @@ with st.sidebar:
         st.session_state.chat_session = None
     temperature = st.slider("Temperature:", 0.0, 1.0, st.session_state.temperature, 0.1)
     st.session_state.temperature = temperature
+    # Streaming shows the answer while it is being written instead of after it is finished
+    st.session_state.stream_responses = st.checkbox("Stream responses", value=st.session_state.stream_responses)
     uploaded_pdf = st.file_uploader("Upload PDF", type=["pdf"])
     clear_button = st.button("Clear Chat")
 
 # Process uploaded PDF
+# Each PDF is uploaded once per content hash on a background worker. Reruns get the same upload
+# back instead of sending the file again, and the chat stays usable while a large file uploads.
+@st.fragment(run_every=2)
+def show_upload_status(upload):
+    if upload.done:
+        # Rerun the whole app so the finished upload is picked up
+        st.rerun()
+    st.info(f"Uploading {upload.display_name} ({upload.status}, {upload.elapsed:.0f}s)...")
+
+
 if uploaded_pdf:
-    try:
-        # Upload file using File API with mime_type specified
-        uploaded_file = genai.upload_file(uploaded_pdf, mime_type="application/pdf")
-        st.session_state.uploaded_file = uploaded_file
+    upload = file_uploads.submit(uploaded_pdf.getvalue(), mime_type="application/pdf", display_name=uploaded_pdf.name)
+    if upload.status == "failed":
+        st.session_state.uploaded_file = None
+        st.error(f"Error uploading file: {upload.error}")
+        trace.event(f"File upload error: {upload.error}")
+        if st.button("Retry upload"):
+            file_uploads.submit(uploaded_pdf.getvalue(), mime_type="application/pdf", display_name=uploaded_pdf.name, retry=True)
+            st.rerun()
+    elif upload.done:
+        if st.session_state.get("uploaded_file") is not upload.file:
+            st.session_state.uploaded_file = upload.file
+            trace.event(f"File ready: {upload.file.name} ({file_uploads.stats()})")
         st.success("File uploaded successfully!")
-                  
-    except Exception as e:
-        st.error(f"Error uploading file: {e}")
-        st.session_state.debug.append(f"File upload error: {e}")
+    else:
+        st.session_state.uploaded_file = None
+        with st.sidebar:
+            show_upload_status(upload)
 
 # Clear chat function
 if clear_button:
     st.session_state.messages = []
-    st.session_state.debug = []
+    trace.clear()
     st.session_state.pdf_content = ""
     st.session_state.chat_session = None
     st.rerun()
@@ -98,32 +130,25 @@ def load_text_file(file_path):
         st.error(f"Error loading text file: {e}")
         return ""
 
-system_prompt = load_text_file('instructions.txt')
+with trace.span("prompt load") as span:
+    system_prompt = load_text_file('instructions.txt')
+    span["chars"] = len(system_prompt)
 
 # Display chat messages
-for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        st.markdown(message["content"])
+with trace.span("render", messages=len(st.session_state.messages)):
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
 def search_perplexity(query):
     """Execute a search query using Perplexity API"""
-    try:
-        response = requests.post(
-            "https://api.perplexity.ai/chat/completions",
-            headers={
-                "accept": "application/json",
-                "content-type": "application/json",
-                "Authorization": f"Bearer {PERPLEXITY_API_KEY}"
-            },
-            json={
-                "model": "llama-3.1-sonar-small-128k-online",
-                "messages": [{"role": "user", "content": f"Search the web for: {query}"}]
-            }
-        )
-        response.raise_for_status()
-        return response.json()['choices'][0]['message']['content']
-    except Exception as e:
-        st.error(f"Perplexity API Error: {e}")
-        return None
+    # A multi-part lookup is split into sub-queries that are searched at the same time.
+    # The shared client reuses connections, times out slow calls and caches repeated queries.
+    results = search_many(split_queries(query), PERPLEXITY_API_KEY)
+    for sub_query, answer, error in results:
+        if error is not None:
+            st.error(f"Perplexity API Error for '{sub_query}': {error}")
+            trace.event(f"Error: Perplexity search for '{sub_query}' failed: {error}")
+    return merge_results(results) or None
 
 # User input
 # The placeholder text "Your message:" can be customized to any desired prompt, e.g., "Message Creative Assistant...".
@@ -141,29 +166,10 @@ if user_input:
 
         # Initialize chat session if needed
         if st.session_state.chat_session is None:
-            generation_config = {
-                "temperature": st.session_state.temperature,
-                "top_p": 0.95,
-                "top_k": 40,
-                "max_output_tokens": 8192,
-            }
-            model = genai.GenerativeModel(
-                model_name=st.session_state.model_name,
-                generation_config=generation_config,
-            )
-            
-            initial_messages = [
-                {"role": "user", "parts": [f"System: {system_prompt}"]},
-                {"role": "model", "parts": ["Understood. I will follow these instructions."]},
-            ]
-            
-            if st.session_state.pdf_content:
-                initial_messages.extend([
-                    {"role": "user", "parts": [f"PDF content for reference:\n\n{st.session_state.pdf_content}"]},
-                    {"role": "model", "parts": ["Acknowledged PDF content."]}
-                ])
-            
-            st.session_state.chat_session = model.start_chat(history=initial_messages)
+            with trace.span("session init", model=st.session_state.model_name):
+                st.session_state.chat_session = engine.start_session(
+                    st.session_state.model_name, st.session_state.temperature, system_prompt, st.session_state.pdf_content
+                )
 
         try:
             is_search = user_input.lower().startswith(("lookup"))
@@ -178,8 +184,10 @@ if user_input:
                     st.rerun()
                 
                 # Execute search
-                message_placeholder.info("🔍 Searching the web...")
-                search_results = search_perplexity(search_query)
+                message_placeholder.info(f"🔍 Searching the web ({len(split_queries(search_query))} queries)...")
+                with trace.span("search", queries=len(split_queries(search_query))) as span:
+                    search_results = search_perplexity(search_query)
+                    span["bytes"] = len((search_results or "").encode("utf-8"))
                 
                 if search_results:
                     # Process results with Gemini
@@ -190,27 +198,52 @@ if user_input:
                         "Include relevant links when available. Verify accuracy before responding."
                     )
                     
-                    response = st.session_state.chat_session.send_message(prompt)
-                    message_placeholder.markdown(response.text)
-                    st.session_state.messages.append({"role": "assistant", "content": response.text})
-                    st.session_state.debug.append("Search results processed successfully")
+                    # Only the send is retried (rate limits, server errors, timeouts); a failed send leaves the history alone
+                    with trace.span("model call", model=st.session_state.model_name, bytes=len(prompt.encode("utf-8"))):
+                        response = call_with_retry(
+                            lambda: st.session_state.chat_session.send_message(prompt, stream=st.session_state.stream_responses),
+                            st.session_state.model_name,
+                        )
+                        result = send_reply(st.session_state.chat_session, prompt, message_placeholder,
+                                            stream=st.session_state.stream_responses, response=response)
+                    st.session_state.messages.append({"role": "assistant", "content": result.text, "partial": result.partial})
+                    trace.event("Search results processed successfully")
+                    trace.event(f"Search cache: {perplexity_client.cache.stats()}")
+                    trace.event(describe_result(result))
             else:
                 # Handle regular chat
-                response = st.session_state.chat_session.send_message(user_input)
-                message_placeholder.markdown(response.text)
-                st.session_state.messages.append({"role": "assistant", "content": response.text})
-                st.session_state.debug.append("Regular chat response generated")
+                # Only the send is retried (rate limits, server errors, timeouts); a failed send leaves the history alone
+                with trace.span("model call", model=st.session_state.model_name, bytes=len(user_input.encode("utf-8"))):
+                    response = call_with_retry(
+                        lambda: st.session_state.chat_session.send_message(user_input, stream=st.session_state.stream_responses),
+                        st.session_state.model_name,
+                    )
+                    result = send_reply(st.session_state.chat_session, user_input, message_placeholder,
+                                        stream=st.session_state.stream_responses, response=response)
+                st.session_state.messages.append({"role": "assistant", "content": result.text, "partial": result.partial})
+                trace.event("Regular chat response generated")
+                trace.event(describe_result(result))
                 
         except Exception as e:
             st.error(f"Error generating response: {e}")
-            st.session_state.debug.append(f"Error: {e}")
-            st.session_state.messages.pop()  # Remove failed message from history
+            trace.event(f"Error: {e}")
+            # The user's message stays in the history so they can see what failed and try again
     
     st.rerun()
 
 # Debug information
 # You can remove this by adding # in front of each line
 
+# Where the latest reply spent its time
+st.sidebar.title("Latency")
+reply_run = trace.latest_run("model call")
+if reply_run is not None:
+    for span in trace.breakdown(reply_run):
+        st.sidebar.text(format_span(span))
+st.sidebar.download_button(
+    "Download spans (JSONL)", trace.to_jsonl(), file_name="grantbuddy_spans.jsonl", mime="application/jsonl"
+)
+
 st.sidebar.title("Debug Info")
-for debug_msg in st.session_state.debug:
+for debug_msg in trace.events():
     st.sidebar.text(debug_msg)
@@ -5,6 +5,10 @@ requests
 #Step 2: Add Import
 #Find the imports section at the top of your code and add:
 import requests
+from streaming import send_reply, describe_result
+from resilience import call_with_retry
+from engine import engine
+from perplexity import perplexity_client, split_queries, search_many, merge_results
 
 
 #Step 3: Add Perplexity API Configuration
@@ -20,24 +24,14 @@ PERPLEXITY_API_KEY = st.secrets["P_API_KEY"]
 #Add this function after your session state initialization code (after all the if "something" not in st.session_state blocks) and before the user input handling:
 def search_perplexity(query):
     """Execute a search query using Perplexity API"""
-    try:
-        response = requests.post(
-            "https://api.perplexity.ai/chat/completions",
-            headers={
-                "accept": "application/json",
-                "content-type": "application/json",
-                "Authorization": f"Bearer {PERPLEXITY_API_KEY}"
-            },
-            json={
-                "model": "llama-3.1-sonar-small-128k-online",
-                "messages": [{"role": "user", "content": f"Search the web for: {query}"}]
-            }
-        )
-        response.raise_for_status()
-        return response.json()['choices'][0]['message']['content']
-    except Exception as e:
-        st.error(f"Perplexity API Error: {e}")
-        return None
+    # A multi-part lookup is split into sub-queries that are searched at the same time.
+    # The shared client reuses connections, times out slow calls and caches repeated queries.
+    results = search_many(split_queries(query), PERPLEXITY_API_KEY)
+    for sub_query, answer, error in results:
+        if error is not None:
+            st.error(f"Perplexity API Error for '{sub_query}': {error}")
+            trace.event(f"Error: Perplexity search for '{sub_query}' failed: {error}")
+    return merge_results(results) or None
 
 #Step 5: Replace Response Generation Code
 #Find the code block that handles generating responses (it starts with if user_input:). Replace everything from there until the st.rerun() with this updated version:
@@ -53,29 +47,9 @@ if user_input:
 
         # Initialize chat session if needed
         if st.session_state.chat_session is None:
-            generation_config = {
-                "temperature": st.session_state.temperature,
-                "top_p": 0.95,
-                "top_k": 40,
-                "max_output_tokens": 8192,
-            }
-            model = genai.GenerativeModel(
-                model_name=st.session_state.model_name,
-                generation_config=generation_config,
+            st.session_state.chat_session = engine.start_session(
+                st.session_state.model_name, st.session_state.temperature, system_prompt, st.session_state.pdf_content
             )
-            
-            initial_messages = [
-                {"role": "user", "parts": [f"System: {system_prompt}"]},
-                {"role": "model", "parts": ["Understood. I will follow these instructions."]},
-            ]
-            
-            if st.session_state.pdf_content:
-                initial_messages.extend([
-                    {"role": "user", "parts": [f"PDF content for reference:\n\n{st.session_state.pdf_content}"]},
-                    {"role": "model", "parts": ["Acknowledged PDF content."]}
-                ])
-            
-            st.session_state.chat_session = model.start_chat(history=initial_messages)
 
         try:
             is_search = user_input.lower().startswith(("search", "search the web", "find", "lookup"))
@@ -90,8 +64,11 @@ if user_input:
                     st.rerun()
                 
                 # Execute search
-                message_placeholder.info("🔍 Searching the web...")
-                search_results = search_perplexity(search_query)
+                message_placeholder.info(f"🔍 Searching the web ({len(split_queries(search_query))} queries)...")
+                # trace is the app's span recorder, see tracing.py
+                with trace.span("search", queries=len(split_queries(search_query))) as span:
+                    search_results = search_perplexity(search_query)
+                    span["bytes"] = len((search_results or "").encode("utf-8"))
                 
                 if search_results:
                     # Process results with Gemini
@@ -102,21 +79,34 @@ if user_input:
                         "Include relevant links when available. Verify accuracy before responding."
                     )
                     
-                    response = st.session_state.chat_session.send_message(prompt)
-                    message_placeholder.markdown(response.text)
-                    st.session_state.messages.append({"role": "assistant", "content": response.text})
-                    st.session_state.debug.append("Search results processed successfully")
+                    # Only the send is retried (rate limits, server errors, timeouts); a failed send leaves the history alone
+                    response = call_with_retry(
+                        lambda: st.session_state.chat_session.send_message(prompt, stream=st.session_state.stream_responses),
+                        st.session_state.model_name,
+                    )
+                    result = send_reply(st.session_state.chat_session, prompt, message_placeholder,
+                                        stream=st.session_state.stream_responses, response=response)
+                    st.session_state.messages.append({"role": "assistant", "content": result.text, "partial": result.partial})
+                    trace.event("Search results processed successfully")
+                    trace.event(f"Search cache: {perplexity_client.cache.stats()}")
+                    trace.event(describe_result(result))
             else:
                 # Handle regular chat
-                response = st.session_state.chat_session.send_message(user_input)
-                message_placeholder.markdown(response.text)
-                st.session_state.messages.append({"role": "assistant", "content": response.text})
-                st.session_state.debug.append("Regular chat response generated")
+                # Only the send is retried (rate limits, server errors, timeouts); a failed send leaves the history alone
+                response = call_with_retry(
+                    lambda: st.session_state.chat_session.send_message(user_input, stream=st.session_state.stream_responses),
+                    st.session_state.model_name,
+                )
+                result = send_reply(st.session_state.chat_session, user_input, message_placeholder,
+                                    stream=st.session_state.stream_responses, response=response)
+                st.session_state.messages.append({"role": "assistant", "content": result.text, "partial": result.partial})
+                trace.event("Regular chat response generated")
+                trace.event(describe_result(result))
                 
         except Exception as e:
             st.error(f"Error generating response: {e}")
-            st.session_state.debug.append(f"Error: {e}")
-            st.session_state.messages.pop()  # Remove failed message from history
+            trace.event(f"Error: {e}")
+            # The user's message stays in the history so they can see what failed and try again
     
     st.rerun()
 
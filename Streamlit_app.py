@@ -1,20 +1,48 @@
+import sqlite3
+import time
 import streamlit as st
 import google.generativeai as genai
-from PyPDF2 import PdfReader
-from PIL import Image
+from assets import header_image, load_text, is_mobile
+from chat_render import escape_currency, first_visible, RECENT_MESSAGES, PAGE_SIZE
+from streaming import send_reply, describe_result
+from document_store import document_store, session_bytes, text_bytes
+from workspace import Workspace
+from response_cache import response_cache
+from retrieval import get_index, search_documents, compose_prompt, TOP_K
+from engine import engine
+from rate_limit import rate_limiter, FALLBACK_MODELS
+from resilience import call_with_retry, hedged_call, circuit_breakers, resilience_stats
+from token_budget import ContextBudget, token_counter, reported_tokens, DEFAULT_BUDGET_TOKENS, SUMMARY_MODEL
+from generation_jobs import generation_pool, GenerationCancelled, PoolFullError
+from conversation_store import conversation_store
+from state_backend import shared_state
+from tracing import Trace, format_span
+
+# How often the chat pane redraws a reply that is being written
+GENERATION_POLL_SECONDS = 0.1
 
 # Streamlit configuration
 st.set_page_config(page_title="Welcome to Grantbuddy!", layout="wide")
 
+# Timed spans for each stage of a run, shown in the sidebar; see tracing.py
+if "trace" not in st.session_state:
+    st.session_state.trace = Trace()
+trace = st.session_state.trace
+trace.begin_run()
+
 # Display image
 # This code attempts to open and display an image file named 'Build2.png'.
 # If successful, it shows the image with a caption. If there's an error, it displays an error message instead.
 # You can customize this by changing the image file name and path. Supported image types include .png, .jpg, .jpeg, and .gif.
 # To use a different image, replace 'Build2.png' with your desired image file name (e.g., 'my_custom_image.jpg').
+# The image is encoded once per process at a few sizes; phones get the smaller one.
 image_path = 'Grantbuddy.webp'
 try:
-    image = Image.open(image_path)
-    st.image(image, caption='Created by Awelama (2024)', use_column_width=True)
+    with trace.span("image load") as span:
+        user_agent = st.context.headers.get("User-Agent", "")
+        image = header_image(image_path, width=414 if is_mobile(user_agent) else None)
+        span["bytes"] = len(image)
+        st.image(image, caption='Created by Awelama (2024)', width="stretch")
 except Exception as e:
     st.error(f"Error loading image: {e}")
 
@@ -27,136 +55,707 @@ st.caption("Grantbuddy can make mistakes. Please double-check all responses.")
 # Initialize Gemini client
 genai.configure(api_key=st.secrets["GOOGLE_API_KEY"])
 
+# Count full script runs so the rerun benchmark can see how much work a chat turn costs
+st.session_state.script_runs = st.session_state.get("script_runs", 0) + 1
+
 # Initialize session state
 if "messages" not in st.session_state:
     st.session_state.messages = []
 if "model_name" not in st.session_state:
-    st.session_state.model_name = "gemini-1.5-pro-002"
+    st.session_state.model_name = "gemini-1.5-flash-002"
 if "temperature" not in st.session_state:
     st.session_state.temperature = 0.5
-if "debug" not in st.session_state:
-    st.session_state.debug = []
-if "pdf_content" not in st.session_state:
-    st.session_state.pdf_content = ""
+# The uploaded PDFs; their text is in the shared document store, the workspace only refers to it
+if "workspace" not in st.session_state:
+    st.session_state.workspace = Workspace()
+# Which document text the chat session was started with, when the documents are in its history
+if "session_documents" not in st.session_state:
+    st.session_state.session_documents = ()
 if "chat_session" not in st.session_state:
     st.session_state.chat_session = None
+if "history_pages" not in st.session_state:
+    st.session_state.history_pages = 0
+if "stream_responses" not in st.session_state:
+    st.session_state.stream_responses = True
+if "use_retrieval" not in st.session_state:
+    st.session_state.use_retrieval = True
+if "allow_fallback" not in st.session_state:
+    st.session_state.allow_fallback = False
+if "hedge_requests" not in st.session_state:
+    st.session_state.hedge_requests = False
+if "use_response_cache" not in st.session_state:
+    st.session_state.use_response_cache = False
+if "token_budget" not in st.session_state:
+    st.session_state.token_budget = DEFAULT_BUDGET_TOKENS
+if "token_usage" not in st.session_state:
+    st.session_state.token_usage = []
+# The reply being written for this session, as (job, request), and messages waiting for it
+if "generation" not in st.session_state:
+    st.session_state.generation = None
+if "pending_prompts" not in st.session_state:
+    st.session_state.pending_prompts = []
+
+# The saved conversation this session appends to, see conversation_store.py. Its ID is kept in
+# the page URL, so a refresh, restart or redeploy opens the same conversation again. Only the
+# latest messages are read back; unloaded_messages counts the older ones still in the store.
+if "conversation_id" not in st.session_state:
+    st.session_state.conversation_id = None
+    st.session_state.unloaded_messages = 0
+    resume_id = st.query_params.get("conversation")
+    saved = conversation_store.info(resume_id) if resume_id else None
+    if saved is not None:
+        resume_started = time.perf_counter()
+        settings = saved["settings"]
+        st.session_state.conversation_id = resume_id
+        st.session_state.messages = conversation_store.load(resume_id, limit=RECENT_MESSAGES)
+        st.session_state.unloaded_messages = saved["message_count"] - len(st.session_state.messages)
+        st.session_state.model_name = settings.get("model_name", st.session_state.model_name)
+        st.session_state.temperature = settings.get("temperature", st.session_state.temperature)
+        restored = st.session_state.workspace.restore(settings.get("documents", []))
+        trace.event(
+            f"Resumed conversation {resume_id}: {len(st.session_state.messages)} of {saved['message_count']} "
+            f"messages and {len(restored)} documents loaded in {(time.perf_counter() - resume_started) * 1000:.0f} ms"
+        )
+
+
+def stop_generation():
+    # Stop the reply still being written for this session and drop the messages waiting for it
+    if st.session_state.generation is not None:
+        st.session_state.generation[0].cancel()
+    st.session_state.generation = None
+    st.session_state.pending_prompts = []
+
+
+def record_message(message):
+    # Add a message to the chat and append it to the saved conversation, creating that on first use
+    st.session_state.messages.append(message)
+    settings = {
+        "model_name": st.session_state.model_name,
+        "temperature": st.session_state.temperature,
+        "documents": st.session_state.workspace.saved(),
+    }
+    try:
+        if st.session_state.conversation_id is None:
+            st.session_state.conversation_id = conversation_store.create(settings)
+            st.query_params["conversation"] = st.session_state.conversation_id
+        conversation_store.append(st.session_state.conversation_id, message, settings)
+    except sqlite3.Error as e:
+        # The chat goes on without saving rather than failing the turn
+        trace.event(f"Could not save message: {e}")
+
+
+def load_earlier_messages():
+    # Read older messages of a resumed conversation once every loaded one is on screen
+    wanted = RECENT_MESSAGES + st.session_state.history_pages * PAGE_SIZE - len(st.session_state.messages)
+    unloaded = st.session_state.unloaded_messages
+    if wanted <= 0 or not unloaded:
+        return
+    earlier = conversation_store.load(st.session_state.conversation_id, end=unloaded, limit=wanted)
+    st.session_state.messages = earlier + st.session_state.messages
+    st.session_state.unloaded_messages = unloaded - len(earlier)
+
+
+def model_history():
+    # The whole saved conversation as chat turns, to start a chat session that continues it
+    messages = st.session_state.messages
+    if st.session_state.unloaded_messages:
+        messages = conversation_store.load(
+            st.session_state.conversation_id, end=st.session_state.unloaded_messages
+        ) + messages
+    return [
+        {"role": "model" if message["role"] == "assistant" else "user", "parts": [message["content"]]}
+        for message in messages
+    ]
+
 
 # Sidebar for model and temperature selection
 with st.sidebar:
     st.title("Settings")
     st.caption("Note: Gemini-1.5-pro-002 can only handle 2 requests per minute, gemini-1.5-flash-002 can handle 15 per minute")
+    model_options = ["gemini-1.5-flash-002", "gemini-1.5-pro-002"]
     model_option = st.selectbox(
-        "Select Model:", ["gemini-1.5-flash-002", "gemini-1.5-pro-002"]
+        "Select Model:", model_options, index=model_options.index(st.session_state.model_name)
     )
+    # A new model or temperature keeps the conversation: the chat moves over with the next message
     if model_option != st.session_state.model_name:
         st.session_state.model_name = model_option
-        st.session_state.messages = []
-        st.session_state.chat_session = None
     temperature = st.slider("Temperature:", 0.0, 1.0, st.session_state.temperature, 0.1)
     st.session_state.temperature = temperature
-    uploaded_pdf = st.file_uploader("Upload PDF", type=["pdf"])
+    # Streaming shows the answer while it is being written instead of after it is finished
+    st.session_state.stream_responses = st.checkbox("Stream responses", value=st.session_state.stream_responses)
+    # Retrieval sends only the parts of the PDF that match each message instead of the whole document
+    use_retrieval = st.checkbox("Send only relevant PDF excerpts", value=st.session_state.use_retrieval)
+    if use_retrieval != st.session_state.use_retrieval:
+        st.session_state.use_retrieval = use_retrieval
+        stop_generation()
+        st.session_state.chat_session = None
+    # Requests wait in a shared queue per model; optionally use flash when pro's queue is long
+    st.session_state.allow_fallback = st.checkbox(
+        "Use gemini-1.5-flash-002 when gemini-1.5-pro-002 is busy", value=st.session_state.allow_fallback
+    )
+    # Hedging asks a second model too when the first is slow to answer, and keeps the faster reply
+    st.session_state.hedge_requests = st.checkbox(
+        "Ask gemini-1.5-flash-002 too when gemini-1.5-pro-002 is slow", value=st.session_state.hedge_requests
+    )
+    # Answers to a message already asked in the same situation are reused instead of generated again
+    st.session_state.use_response_cache = st.checkbox(
+        "Reuse answers to identical questions", value=st.session_state.use_response_cache
+    )
+    # Older turns are replaced by a summary once the conversation would go over this many tokens
+    st.session_state.token_budget = st.number_input(
+        "Context budget (tokens):", min_value=8000, value=st.session_state.token_budget, step=8000
+    )
+    uploaded_pdfs = st.file_uploader("Upload PDFs", type=["pdf"], accept_multiple_files=True)
     clear_button = st.button("Clear Chat")
 
-# Process uploaded PDF
-if uploaded_pdf:
-    try:
-        pdf_reader = PdfReader(uploaded_pdf)
-        pdf_text = ""
-        for page in pdf_reader.pages:
-            pdf_text += page.extract_text() + "\n"
-        st.session_state.pdf_content = pdf_text
-        st.session_state.debug.append(f"PDF processed: {len(pdf_text)} characters")
-        # Reset chat session when new PDF is uploaded
-        st.session_state.chat_session = None
-    except Exception as e:
-        st.error(f"Error processing PDF: {e}")
-        st.session_state.debug.append(f"PDF processing error: {e}")
+# Process uploaded PDFs
+# The uploader keeps its files across reruns, so only do work when a file is added or removed.
+# Extraction results are cached by content hash and shared by all sessions in this process.
+# Each PDF is extracted by its own background job, so several files are ingested side by side,
+# and chat can start once the first pages of a document are ready.
+@st.fragment(run_every=1)
+def show_ingest_progress(documents):
+    if any(document.job.done for document in documents):
+        # Rerun the whole app so the remaining pages are picked up
+        st.rerun()
+    for document in documents:
+        job = document.job
+        st.progress(
+            job.pages_done / max(job.page_count, 1),
+            text=f"Extracting {document.name}: {job.pages_done}/{job.page_count} pages",
+        )
+
+
+workspace = st.session_state.workspace
+for document in workspace.sync([(uploaded.name, uploaded.getvalue()) for uploaded in uploaded_pdfs or []]):
+    trace.event(f"PDF added: {document.name}")
+for document in workspace.refresh():
+    trace.event(f"PDF processed: {document.name}, {document.length} characters")
+    job = document.job
+    if job.done:
+        # Extraction ran in the background; record it once, in the run that picks up the full text
+        trace.add(
+            "pdf extraction", job.finished - job.started, document=document.name,
+            pages=job.page_count, bytes=text_bytes(document.text), cached=job.page_count == 0,
+        )
+for document in workspace.failed():
+    st.error(f"Error processing {document.name}: {document.job.error}")
+if workspace.documents:
+    with st.sidebar:
+        # Switching a document off only changes what later messages can see; the chat is kept
+        st.caption("Documents used in the chat")
+        for document in workspace.documents.values():
+            document.enabled = st.checkbox(document.name, value=document.enabled, key=f"document_{document.digest}")
+            st.caption(document.report(document_store))
+        if workspace.ingesting():
+            show_ingest_progress(workspace.ingesting())
 
 # Clear chat function
 if clear_button:
+    stop_generation()
     st.session_state.messages = []
-    st.session_state.debug = []
-    st.session_state.pdf_content = ""
+    st.session_state.history_pages = 0
+    st.session_state.token_usage = []
+    trace.clear()
+    st.session_state.workspace.clear()
     st.session_state.chat_session = None
+    # The cleared conversation stays saved; the next message starts a new one
+    st.session_state.conversation_id = None
+    st.session_state.unloaded_messages = 0
+    if "conversation" in st.query_params:
+        del st.query_params["conversation"]
     st.rerun()
 
 # Load system prompt
+# The file is read once per process and again only when it changes on disk
 def load_text_file(file_path):
     try:
-        with open(file_path, 'r') as file:
-            return file.read()
+        return load_text(file_path)
     except Exception as e:
         st.error(f"Error loading text file: {e}")
         return ""
 
-system_prompt = load_text_file('instructions.txt')
-
-# Display chat messages
-for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        st.markdown(message["content"])
+with trace.span("prompt load") as span:
+    system_prompt = load_text_file('instructions.txt')
+    span["chars"] = len(system_prompt)
 
-# User input
-# The placeholder text "Your message:" can be customized to any desired prompt, e.g., "Message Creative Assistant...".
-user_input = st.chat_input("Your message:")
+def show_message_notes(message):
+    # Notes under a reply that was cut off, stopped or answered by a different model
+    if message.get("stopped"):
+        st.caption("You stopped this response. The part written so far has been kept.")
+    elif message.get("partial"):
+        st.caption("This response was interrupted. The part received so far has been kept.")
+    if message.get("cached") == "exact":
+        st.caption("⚡ Cached answer to the same question.")
+    elif message.get("cached"):
+        st.caption("⚡ Cached answer to a near-identical question.")
+    if message.get("rebuild"):
+        st.caption(message["rebuild"])
+    if message.get("fallback_model"):
+        st.caption(f"Answered by {message['fallback_model']} because the selected model was busy.")
 
-if user_input:
-    # Add user message to chat history
-    current_message = {"role": "user", "content": user_input}
-    st.session_state.messages.append(current_message)
 
-    with st.chat_message("user"):
-        st.markdown(current_message["content"])
+def generate_reply(job, request):
+    # Runs in a generation worker thread, so it reads only request, never st.session_state.
+    # job stands in for the reply placeholder; the chat pane draws what is written to it.
+    # Spans go to the session's trace under the run the message was sent in
+    trace, run = request["trace"], request["run"]
+    budget = ContextBudget(token_counter, request["token_budget"])
 
-    # Generate and display assistant response
-    with st.chat_message("assistant"):
-        message_placeholder = st.empty()
+    def turn_usage(prompt, reply, response=None):
+        # The counts the model reported for the request when it has them, otherwise estimates
+        reported = reported_tokens(response)
+        if reported is not None:
+            token_counter.observe(chat_session.model_name, reply, reported[1])
+        prompt_tokens, reply_tokens = reported or (
+            token_counter.count(chat_session.model_name, prompt), token_counter.count(chat_session.model_name, reply)
+        )
+        return {"prompt": prompt_tokens, "reply": reply_tokens, "context": budget.usage(chat_session)["total"]}
 
-        # Prepare messages for Gemini API
-        if st.session_state.chat_session is None:
-            generation_config = {
-                "temperature": st.session_state.temperature,
-                "top_p": 0.95,
-                "top_k": 40,
-                "max_output_tokens": 8192,
+    # Serve a stored reply to the same message, asked in the same situation, without calling the model.
+    # This comes before any session work, so a hit never opens or moves a chat session.
+    cache_keys = None
+    if request["use_cache"]:
+        cache_keys = response_cache.keys(
+            request["model_name"],
+            request["temperature"],
+            request["system_prompt"],
+            request["cache_documents"],
+            request["conversation"],
+            request["text"],
+        )
+        with trace.span("response cache", run) as span:
+            cached = response_cache.get(cache_keys)
+            span["hit"] = cached[1] if cached is not None else None
+        if cached is not None:
+            text, tier = cached
+            model_name = request["model_name"]
+            turn = [{"role": "user", "parts": [request["text"]]}, {"role": "model", "parts": [text]}]
+            chat_session = request["chat_session"]
+            if chat_session is not None:
+                # The model still needs to see the turn to follow the rest of the conversation. A session
+                # due to move to new settings is moved with it on the next message that reaches the model.
+                chat_session.history = list(chat_session.history) + turn
+                context = budget.usage(chat_session)["total"]
+            else:
+                # No session is opened for it: the next one starts from the saved messages, this turn included
+                prefix = engine.prefix_for(request["system_prompt"], request["session_pdf"])
+                context = token_counter.count_messages(model_name, list(prefix) + list(request["history"]) + turn)
+            # The session was only added to, so the one this session holds is still the right one
+            request["chat_session"] = None
+            job.markdown(escape_currency(text))
+            job.note(f"Response cache: {tier} hit, {response_cache.stats()}")
+            usage = {
+                "prompt": token_counter.count(model_name, request["text"]),
+                "reply": token_counter.count(model_name, text),
+                "context": context,
+                "cached": True,
             }
-            model = genai.GenerativeModel(
-                model_name=st.session_state.model_name,
-                generation_config=generation_config,
+            return {"message": {"role": "assistant", "content": text, "cached": tier}, "usage": usage}
+
+    # Start the chat with the system prompt and PDF content
+    chat_session = request["chat_session"]
+    rebuild_note = None
+    if chat_session is None:
+        # With retrieval on, the documents are not put in the history, excerpts go with each message.
+        # A resumed conversation is carried into the new session as its history.
+        with trace.span("session init", run, model=request["model_name"], history_turns=len(request["history"])):
+            chat_session = engine.start_session(
+                request["model_name"], request["temperature"], request["system_prompt"], request["session_pdf"],
+                history=request["history"],
             )
-            
-            # Initialize chat with system prompt and PDF content
-            initial_messages = [
-                {"role": "user", "parts": [f"System: {system_prompt}"]},
-                {"role": "model", "parts": ["Understood. I will follow these instructions."]},
-            ]
-            
-            if st.session_state.pdf_content:
-                initial_messages.extend([
-                    {"role": "user", "parts": [f"The following is the content of an uploaded PDF document. Please consider this information when responding to user queries:\n\n{st.session_state.pdf_content}"]},
-                    {"role": "model", "parts": ["I have received and will consider the PDF content in our conversation."]}
-                ])
-            
-            st.session_state.chat_session = model.start_chat(history=initial_messages)
-
-        # Generate response with error handling
-        try:
-            response = st.session_state.chat_session.send_message(current_message["content"])
+        request["chat_session"] = chat_session
+        job.note(f"Engine: {engine.stats()}")
+    elif (request["documents_changed"] or chat_session.model_name != request["model_name"]
+          or chat_session.temperature != request["temperature"]):
+        # The model, temperature or documents changed since the last message. The conversation is
+        # kept and moved to a session with the new settings; documents only change the prefix.
+        with trace.span("session init", run, model=request["model_name"], rebuild=True) as span:
+            prefix = None
+            if request["documents_changed"]:
+                prefix = engine.prefix_for(request["system_prompt"], request["session_pdf"])
+            chat_session, cost = engine.rebuild(chat_session, request["model_name"], request["temperature"], prefix)
+            span.update(history_turns=cost["turns"], bytes=cost["history_bytes"] + cost["prefix_bytes"])
+        request["chat_session"] = chat_session
+        rebuild_note = (
+            f"Moved the conversation to {request['model_name']} at temperature {request['temperature']} "
+            f"in {cost['seconds'] * 1000:.0f} ms: {cost['turns']} turns ({cost['history_bytes'] / 1024:,.0f} KB) kept, "
+            f"{cost['prefix_bytes'] / 1024:,.0f} KB prefix {cost['prefix']}."
+        )
+        job.note(rebuild_note)
+        if request["documents_changed"]:
+            job.note(f"Documents changed, chat moved to a new prefix: {engine.stats()}")
 
-            full_response = response.text
-            message_placeholder.markdown(full_response)
-            st.session_state.messages.append({"role": "assistant", "content": full_response})
-            st.session_state.debug.append("Assistant response generated")
+    # Pick the PDF excerpts that match this message, from every enabled document
+    prompt = request["text"]
+    sources = request["retrieval_sources"]
+    if sources:
+        with trace.span("search", run, documents=len(sources)) as span:
+            indexes = [(name, get_index(text)) for name, text in sources]
+            prompt = compose_prompt(prompt, search_documents(indexes, prompt, k=TOP_K))
+            span.update(chunks=sum(len(index) for _, index in indexes), bytes=text_bytes(prompt))
+        job.note(
+            f"Retrieval: sent {len(prompt)} of {sum(len(text) for _, text in sources)} PDF characters "
+            f"from {len(sources)} documents ({sum(len(index) for _, index in indexes)} chunks)"
+        )
 
+    # The summary and the reply each wait for their model's request slot with the worker given
+    # back to the pool (see generation_jobs.py), so a long queue for pro never holds a worker
+    def summarize(job):
+        # The first request uses the slot this step waited for; a retry waits for a new one
+        slot_taken = True
+
+        def generate(summary_request):
+            def attempt():
+                nonlocal slot_taken
+                job.checkpoint()
+                if not slot_taken:
+                    rate_limiter.acquire(SUMMARY_MODEL)
+                slot_taken = False
+                return engine.generate(SUMMARY_MODEL, summary_request)
+            return call_with_retry(attempt, SUMMARY_MODEL, sleep=job.sleep)
+
+        try:
+            with trace.span("summary", run, model=SUMMARY_MODEL) as span:
+                summarized = budget.compact(chat_session, generate)
+                span["turns"] = summarized
+            job.note(f"Context budget: summarized {summarized} older turns")
+        except GenerationCancelled:
+            raise
         except Exception as e:
-            st.error(f"An error occurred while generating the response: {e}")
-            st.session_state.debug.append(f"Error: {e}")
+            job.note(f"Context budget: summary failed, sending full history ({e})")
+        job.empty()
+        return queue_reply(job)
+
+    def queue_reply(job):
+        # Wait for our turn in the model's queue, falling back to flash if allowed and pro is saturated
+        # or keeps failing
+        reply_model = request["model_name"]
+        if request["allow_fallback"]:
+            if circuit_breakers.is_open(reply_model) and reply_model in FALLBACK_MODELS:
+                reply_model = FALLBACK_MODELS[reply_model]
+            else:
+                reply_model = rate_limiter.choose_model(reply_model)
+        if reply_model != request["model_name"]:
+            job.note(f"{request['model_name']} is busy, using {reply_model}")
+        return job.after_slot(
+            reply_model, send, reply_model, time.perf_counter(), on_wait=queue_position(job, reply_model)
+        )
+
+    def queue_position(job, model_name):
+        def show(position, wait):
+            job.info(f"⏳ {model_name} is busy. You are number {position} in the queue, about {wait:.0f}s to go.")
+        return show
+
+    def send(job, reply_model, queued):
+        # Time in the model's rate-limit queue is reported apart from the call itself
+        queue_seconds = time.perf_counter() - queued
+        stream = request["stream"]
+
+        def show_retry(attempt, delay, error):
+            job.checkpoint()
+            job.warning(f"⚠️ {reply_model} did not answer ({error}). Retrying in {delay:.0f}s...")
+
+        def open_reply(model_name, chat, on_retry=None):
+            # Send the message on the slot already taken, retrying rate limits, server errors and timeouts
+            slot_taken = True
+
+            def attempt():
+                nonlocal slot_taken
+                job.checkpoint()
+                if not slot_taken:
+                    # A retry after a failed call takes a new slot; retries are rare and already
+                    # keep the worker through their backoff
+                    rate_limiter.acquire(model_name, on_wait=queue_position(job, model_name))
+                slot_taken = False
+                return chat.send_message(prompt, stream=stream)
+            return call_with_retry(attempt, model_name, on_retry=on_retry, sleep=job.sleep)
+
+        started = time.perf_counter()
+        hedge_model = FALLBACK_MODELS.get(reply_model) if request["hedge"] else None
+        if hedge_model:
+            # Both attempts run on their own copy of the conversation; the winner's turn is kept
+            chats = [chat_session.continue_on(model) for model in (reply_model, hedge_model)]
+
+            def hedge():
+                # Only hedge when the second model has a free request slot right now
+                if not rate_limiter.acquire(hedge_model, timeout=0):
+                    raise RuntimeError(f"{hedge_model} has no free request slot")
+                return chats[1].send_message(prompt, stream=stream)
+
+            winner, response = hedged_call(lambda: open_reply(reply_model, chats[0]), hedge, model=reply_model)
+            reply_session = chats[winner]
+            answered_by = (reply_model, hedge_model)[winner]
+        else:
+            reply_session = chat_session
+            if reply_model != request["model_name"]:
+                reply_session = chat_session.continue_on(reply_model)
+            response = open_reply(reply_model, reply_session, on_retry=show_retry)
+            answered_by = reply_model
+
+        result = send_reply(
+            reply_session,
+            prompt,
+            job,
+            stream=stream,
+            response=response,
+            started=started,
+            check=job.checkpoint,
+        )
+        if reply_session is not chat_session:
+            # Copy the new turn back so the selected model sees it next time
+            chat_session.adopt_last_turn(reply_session)
+        if prompt != request["text"]:
+            # The excerpts were only needed for this answer; the history keeps the bare message so
+            # later turns don't send them again
+            chat_session.replace_last_message(request["text"])
+
+        assistant_message = {"role": "assistant", "content": result.text}
+        if rebuild_note:
+            assistant_message["rebuild"] = rebuild_note
+        if answered_by != request["model_name"]:
+            assistant_message["fallback_model"] = answered_by
+        if result.partial:
+            # Keep the half-written answer, but mark it so the user knows it was cut off
+            if isinstance(result.error, GenerationCancelled):
+                assistant_message["stopped"] = True
+            else:
+                assistant_message["partial"] = True
+                job.note(f"Partial response kept: {result.error}")
+        if cache_keys is not None and not result.partial and answered_by == request["model_name"]:
+            response_cache.put(cache_keys, result.text)
+        usage = turn_usage(prompt, result.text, result.response)
+        if queue_seconds:
+            trace.add("queue", queue_seconds, run, model=reply_model)
+        trace.add(
+            "model call", result.total_time, run, model=answered_by,
+            prompt_tokens=usage["prompt"], reply_tokens=usage["reply"], bytes=text_bytes(prompt),
+            first_token_ms=None if result.time_to_first_token is None else round(result.time_to_first_token * 1000),
+            chunks=result.chunks,
+        )
+        job.note("Assistant response generated")
+        job.note(describe_result(result))
+        job.note(f"Model calls: {resilience_stats.snapshot()}")
+        return {"message": assistant_message, "usage": usage}
+
+    # Summarize older turns first when this message would take the conversation over budget
+    if budget.over_budget(chat_session, prompt):
+        job.info("Summarizing the earlier conversation to stay within the context budget...")
+        return job.after_slot(SUMMARY_MODEL, summarize)
+    return queue_reply(job)
+
+
+def start_generation(text):
+    # Hand the message to the generation pool with a snapshot of everything the worker needs
+    use_retrieval = st.session_state.use_retrieval
+    workspace = st.session_state.workspace
+    documents = () if use_retrieval else workspace.key()
+    request = {
+        "text": text,
+        "chat_session": st.session_state.chat_session,
+        # Earlier turns for a new chat session, when there is a conversation but no session yet
+        "history": model_history() if st.session_state.chat_session is None else (),
+        "model_name": st.session_state.model_name,
+        "temperature": st.session_state.temperature,
+        "system_prompt": system_prompt,
+        "session_pdf": "" if use_retrieval else workspace.combined_text(),
+        "retrieval_sources": workspace.sources() if use_retrieval else [],
+        "documents": documents,
+        "documents_changed": documents != st.session_state.session_documents,
+        "use_cache": st.session_state.use_response_cache,
+        "cache_documents": [use_retrieval, workspace.key()],
+        # The conversation before this message; the new user message is added after submitting
+        "conversation": [(message["role"], message["content"]) for message in st.session_state.messages],
+        "token_budget": st.session_state.token_budget,
+        "allow_fallback": st.session_state.allow_fallback,
+        "hedge": st.session_state.hedge_requests,
+        "stream": st.session_state.stream_responses,
+        "trace": trace,
+        "run": trace.run,
+    }
+    job = generation_pool.submit(generate_reply, request)
+    st.session_state.generation = (job, request)
+
+
+def draw_output(placeholder, job):
+    kind, body = job.output()
+    if kind == "empty":
+        placeholder.empty()
+    else:
+        getattr(placeholder, kind)(body)
+
+
+def follow_generation(job):
+    # Draw the job's output as it arrives. A click reruns the script, which ends this loop but
+    # not the job; the next run picks the job up again, so only the drawing is ever interrupted.
+    placeholder = st.empty()
+    stop_slot = st.empty()
+    status = st.empty()
+    if stop_slot.button("Stop generating", key=f"stop_generation_{job.id}"):
+        job.cancel()
+    drawn_version = None
+    last_status = 0.0
+    while True:
+        finished = job.wait(GENERATION_POLL_SECONDS)
+        if job.version != drawn_version:
+            drawn_version = job.version
+            draw_output(placeholder, job)
+        if finished:
+            break
+        now = time.perf_counter()
+        if now - last_status >= 1:
+            # Also keeps the loop interruptible while nothing new has arrived
+            last_status = now
+            if job.cancelled:
+                status.caption("Stopping...")
+            elif job.status == "queued":
+                status.caption(f"Waiting for a free worker... {job.queued_for:.0f}s")
+            elif job.status == "waiting for slot":
+                status.caption(f"Waiting for the model's next request slot... {now - job.submitted:.0f}s")
+            else:
+                status.caption(f"Generating... {now - job.submitted:.0f}s")
+    stop_slot.empty()
+    status.empty()
+
+
+def collect_reply(job, request):
+    # Move a finished job's reply, debug notes and chat session into this session's state
+    st.session_state.generation = None
+    for note in job.notes:
+        trace.event(note, request["run"])
+    if request["chat_session"] is not None:
+        st.session_state.chat_session = request["chat_session"]
+        st.session_state.session_documents = request["documents"]
+    if job.status == "done":
+        reply = job.result
+        record_message(reply["message"])
+        st.session_state.token_usage.append(reply["usage"])
+        show_message_notes(reply["message"])
+    elif job.status == "cancelled":
+        st.caption("You stopped this response before any text arrived.")
+        trace.event("Reply stopped before any text arrived")
+    else:
+        st.error(f"An error occurred while generating the response: {job.error}")
+        trace.event(f"Error: {job.error}")
+    trace.event(f"Generation pool: {generation_pool.stats()}")
+
+
+def show_token_usage():
+    # Token usage per turn, and how full the context is after the latest one
+    if not st.session_state.token_usage:
+        return
+    latest = st.session_state.token_usage[-1]
+    with st.expander("Token usage"):
+        st.progress(
+            min(latest["context"] / st.session_state.token_budget, 1.0),
+            text=f"Context: {latest['context']:,} of {st.session_state.token_budget:,} tokens",
+        )
+        for turn, usage in enumerate(st.session_state.token_usage, start=1):
+            cached = " (cached)" if usage.get("cached") else ""
+            st.text(f"Turn {turn}: {usage['prompt']:,} in, {usage['reply']:,} out{cached}")
 
-    st.rerun()
 
 # Debug information
-# You can remove this by adding # in front of each line
+# You can remove this by adding # in front of each line, and the show_debug_info() call in chat_pane
+def show_debug_info():
+    # Where the latest reply spent its time, and how long each stage usually takes
+    with st.expander("Latency"):
+        reply_run = trace.latest_run("model call", "response cache")
+        if reply_run is not None:
+            st.caption(f"Latest reply, slowest stage first (run {reply_run})")
+            for span in trace.breakdown(reply_run):
+                st.text(format_span(span))
+        st.caption("Each stage over the recent runs: count, p50, p95")
+        for stage, (count, p50, p95) in trace.stage_summary().items():
+            st.text(f"{stage}: {count}x, p50 {p50:,.0f} ms, p95 {p95:,.0f} ms")
+        st.download_button(
+            "Download spans (JSONL)", trace.to_jsonl(), file_name="grantbuddy_spans.jsonl", mime="application/jsonl"
+        )
+
+    with st.expander("Debug info"):
+        for debug_msg in trace.events():
+            st.text(debug_msg)
+
+
+# Chat pane
+# The conversation runs in a fragment: sending a message reruns only this function, not the
+# header, sidebar and PDF processing above it, and the reply is already on screen when it
+# finishes, so no extra st.rerun() is needed. Replies are written by the generation pool;
+# this only draws them, so a slow model never holds the script thread. What changes with each
+# turn, like the token usage and the debug panels, is drawn in here too, since the sidebar
+# isn't redrawn with it.
+@st.fragment
+def chat_pane():
+    st.session_state.chat_pane_runs = st.session_state.get("chat_pane_runs", 0) + 1
+    if st.session_state.get("chat_pane_script_run") == st.session_state.script_runs:
+        # Only the fragment is rerunning, its spans are a run of their own
+        trace.begin_run()
+    st.session_state.chat_pane_script_run = st.session_state.script_runs
+
+    # Display chat messages
+    # Only the latest messages are drawn; earlier ones are loaded a page at a time, from the
+    # conversation store once the ones in memory run out
+    messages = st.session_state.messages
+    hidden = first_visible(len(messages), st.session_state.history_pages)
+    earlier = hidden + st.session_state.unloaded_messages
+    if earlier and st.button(f"Show earlier messages ({earlier} hidden)"):
+        st.session_state.history_pages += 1
+        load_earlier_messages()
+        messages = st.session_state.messages
+        hidden = first_visible(len(messages), st.session_state.history_pages)
+    with trace.span("render", messages=len(messages) - hidden) as span:
+        for message in messages[hidden:]:
+            with st.chat_message(message["role"]):
+                st.markdown(escape_currency(message["content"]))
+                show_message_notes(message)
+        span["bytes"] = sum(text_bytes(message["content"]) for message in messages[hidden:])
+
+    # User input
+    # The placeholder text "Your message:" can be customized to any desired prompt, e.g., "Message Creative Assistant...".
+    user_input = st.chat_input("Your message:")
+    if user_input:
+        # Messages sent while a reply is still being written wait for it to finish
+        st.session_state.pending_prompts.append(user_input)
+
+    while st.session_state.generation is not None or st.session_state.pending_prompts:
+        if st.session_state.generation is None:
+            text = st.session_state.pending_prompts.pop(0)
+            try:
+                start_generation(text)
+            except PoolFullError as e:
+                st.error(f"Grantbuddy is very busy right now ({e}). Please send your message again in a moment.")
+                break
+            # Add user message to chat history
+            record_message({"role": "user", "content": text})
+            with st.chat_message("user"):
+                st.markdown(escape_currency(text))
+
+        job, request = st.session_state.generation
+        reply_area = st.chat_message("assistant")
+        queued = st.empty()
+        if st.session_state.pending_prompts:
+            with queued.container():
+                for text in st.session_state.pending_prompts:
+                    with st.chat_message("user"):
+                        st.markdown(escape_currency(text))
+                        st.caption("Waiting for the reply above.")
+        with reply_area:
+            follow_generation(job)
+            collect_reply(job, request)
+        queued.empty()
+
+    show_token_usage()
+    show_debug_info()
+
+
+chat_pane()
 
-st.sidebar.title("Debug Info")
-for debug_msg in st.session_state.debug:
-    st.sidebar.text(debug_msg)
+# Memory this session holds on its own, and the document text it shares with other sessions
+st.sidebar.title("Memory")
+st.sidebar.text(
+    f"This session: {session_bytes(st.session_state.messages, st.session_state.chat_session) / 1024:,.0f} KB"
+)
+st.sidebar.text(f"Document store: {document_store.stats()}")
+if st.session_state.conversation_id is not None:
+    st.sidebar.text(f"Saved conversation: {st.session_state.conversation_id}")
+st.sidebar.text(f"Shared state: {shared_state.stats()}")
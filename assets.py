@@ -0,0 +1,77 @@
+import io
+import os
+import threading
+
+from PIL import Image
+
+# Static assets loaded once per process.
+# Files are read once and kept until their modification time changes. The header image is
+# encoded ahead of time at a few widths; passing the same bytes to st.image on every rerun
+# gives the same media URL, so the browser keeps its cached copy.
+
+# Widths the header image is prepared at; the original size is always included
+IMAGE_WIDTHS = (414, 828)
+IMAGE_QUALITY = 85
+
+_cache = {}
+_lock = threading.Lock()
+stats = {"loads": 0, "hits": 0}
+
+
+def _cached(key, path, build):
+    # Return build() for path, reusing the last result while the file's mtime is unchanged
+    mtime = os.stat(path).st_mtime_ns
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None and entry[0] == mtime:
+            stats["hits"] += 1
+            return entry[1]
+    value = build()
+    with _lock:
+        _cache[key] = (mtime, value)
+        stats["loads"] += 1
+    return value
+
+
+def load_text(path):
+    """Contents of a text file, read again only when the file changes"""
+    def read():
+        with open(path, "r") as file:
+            return file.read()
+    return _cached(("text", path), path, read)
+
+
+def _encode_variants(path, widths):
+    with open(path, "rb") as file:
+        original = file.read()
+    image = Image.open(io.BytesIO(original))
+    variants = {image.width: original}
+    for width in widths:
+        if width >= image.width:
+            continue
+        height = round(image.height * width / image.width)
+        buffer = io.BytesIO()
+        image.resize((width, height), Image.LANCZOS).save(buffer, format="WEBP", quality=IMAGE_QUALITY)
+        variants[width] = buffer.getvalue()
+    return variants
+
+
+def image_variants(path, widths=IMAGE_WIDTHS):
+    """Encoded image bytes keyed by pixel width"""
+    return _cached(("image", path, tuple(widths)), path, lambda: _encode_variants(path, widths))
+
+
+def header_image(path, width=None, widths=IMAGE_WIDTHS):
+    """Bytes of the smallest prepared variant at least width pixels wide (the largest if width is None)"""
+    variants = image_variants(path, widths)
+    sizes = sorted(variants)
+    if width is not None:
+        for size in sizes:
+            if size >= width:
+                return variants[size]
+    return variants[sizes[-1]]
+
+
+def is_mobile(user_agent):
+    """Rough check for phone browsers, which get the smaller header image"""
+    return bool(user_agent) and ("Mobi" in user_agent or "Android" in user_agent)
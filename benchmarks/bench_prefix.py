@@ -0,0 +1,78 @@
+"""Count the prefix bytes a chat sends, with and without the context cache.
+
+Runs a chat on a large document against engine.StubBackend, which counts the bytes each
+request would carry, once with the system prompt and document registered as cached content
+and once with them sent as history:
+
+    python benchmarks/bench_prefix.py --turns 10 --document-kb 400
+
+With the cache, the prefix is uploaded once when the cache is created and never again, even
+when the chat outlives the cache's TTL or the cache is evicted (the session then moves to a
+new cache). Without it, every turn sends the prefix again. Exits with status 1 otherwise.
+"""
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def run(turns, document_kb, cached):
+    sys.path.insert(0, ROOT)
+    from context_cache import PrefixCache, content_bytes
+    from engine import Engine, StubBackend
+
+    backend = StubBackend()
+    engine = Engine(backend)
+    clock = Clock()
+    engine.prefix_cache = PrefixCache(backend, clock=clock, min_chars=0 if cached else float("inf"))
+    document = ("Budget line, indicator and outcome text. " * (document_kb * 25))[:document_kb * 1024]
+    session = engine.start_session("gemini-1.5-flash-002", 0.5, "You help write grant proposals.", document)
+    prefix_bytes = content_bytes(session.prefix_messages)
+    for turn in range(turns):
+        # Each turn comes a quarter of the TTL after the last, so the chat outlives the cache's first TTL
+        clock.now += engine.prefix_cache.ttl / 4
+        session.send_message(f"Question {turn}: how should the monitoring budget be split?")
+    return {
+        "prefix_bytes": prefix_bytes,
+        "bytes_sent": backend.bytes_sent,
+        "history_bytes": content_bytes(session.conversation()),
+        "caches_created": engine.prefix_cache.created,
+        "renewed": engine.prefix_cache.renewed,
+        "reopened": session.reopened,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--document-kb", type=int, default=400)
+    args = parser.parse_args()
+
+    results = {name: run(args.turns, args.document_kb, cached) for name, cached in (("cached", True), ("history", False))}
+    print(f"{'prefix':<8} {'prefix KB':>10} {'sent KB':>10} {'caches':>7} {'renewed':>8} {'reopened':>9}")
+    for name, row in results.items():
+        print(
+            f"{name:<8} {row['prefix_bytes'] / 1024:>10,.0f} {row['bytes_sent'] / 1024:>10,.0f} "
+            f"{row['caches_created']:>7} {row['renewed']:>8} {row['reopened']:>9}"
+        )
+
+    cached = results["cached"]
+    # The prefix once, plus at most the conversation itself on every turn
+    limit = cached["prefix_bytes"] + args.turns * cached["history_bytes"]
+    if cached["caches_created"] != 1 or cached["bytes_sent"] > limit:
+        raise SystemExit("The cached prefix was sent more than once")
+    if results["history"]["bytes_sent"] < args.turns * results["history"]["prefix_bytes"]:
+        raise SystemExit("Without the cache every turn should carry the prefix")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Count script executions per chat turn.
+
+Runs Streamlit_app.py headlessly with Streamlit's AppTest against the stub backend and
+reports how many full script runs and chat-pane fragment runs each chat turn costs.
+
+    python benchmarks/bench_reruns.py --turns 5
+
+AppTest always runs the whole script when a widget changes, so here a turn costs at least
+one full run; in a browser the same turn only reruns the chat_pane fragment. What this
+catches is extra work on top of that, such as the st.rerun() that used to follow every reply.
+"""
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(turns):
+    os.environ.setdefault("GRANTBUDDY_BACKEND", "stub")
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+
+    from streamlit.testing.v1 import AppTest
+    import rate_limit
+
+    # The benchmark measures reruns, not queueing
+    rate_limit.rate_limiter.limits = {}
+
+    app = AppTest.from_file(os.path.join(ROOT, "Streamlit_app.py"), default_timeout=60)
+    app.secrets["GOOGLE_API_KEY"] = "benchmark"
+    app.run()
+    start_runs = app.session_state["script_runs"]
+    start_pane_runs = app.session_state["chat_pane_runs"]
+
+    for turn in range(turns):
+        app.chat_input[0].set_value(f"Benchmark question {turn}").run()
+        if app.exception:
+            raise SystemExit(f"App raised: {app.exception[0].value}")
+
+    full_runs = app.session_state["script_runs"] - start_runs
+    pane_runs = app.session_state["chat_pane_runs"] - start_pane_runs
+    return {
+        "turns": turns,
+        "script_runs_per_turn": full_runs / turns,
+        "chat_pane_runs_per_turn": pane_runs / turns,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=5)
+    args = parser.parse_args()
+    for name, value in run(args.turns).items():
+        print(f"{name}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Time resuming a saved conversation against its length.
+
+Writes conversations of increasing length to a fresh SQLite file with conversation_store.py,
+then opens the file again as a restarted process would and times:
+
+- append: writing one message, averaged over the last 100 written;
+- resume: reading the conversation's settings and the latest messages, as the app does on open;
+- full load: reading every message, which the app only does to start a new chat session.
+
+    python benchmarks/bench_resume.py --lengths 10 100 1000 10000
+
+Append and resume should stay flat as the transcript grows; only the full load grows with it.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# About the size of a typical proposal turn
+MESSAGE_CHARS = 1500
+
+
+def run(lengths):
+    sys.path.insert(0, ROOT)
+    from chat_render import RECENT_MESSAGES
+    from conversation_store import ConversationStore
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "conversations.sqlite")
+        writer = ConversationStore(path)
+        for length in lengths:
+            conversation_id = writer.create({"model_name": "gemini-1.5-flash-002", "temperature": 0.5})
+            last_appends = 0.0
+            for index in range(length):
+                role = "user" if index % 2 == 0 else "assistant"
+                message = {"role": role, "content": f"Message {index} " + "x" * MESSAGE_CHARS}
+                started = time.perf_counter()
+                writer.append(conversation_id, message)
+                if index >= length - 100:
+                    last_appends += time.perf_counter() - started
+
+            # A new connection, as after a restart
+            started = time.perf_counter()
+            reader = ConversationStore(path)
+            info = reader.info(conversation_id)
+            recent = reader.load(conversation_id, limit=RECENT_MESSAGES)
+            resume = time.perf_counter() - started
+            started = time.perf_counter()
+            everything = reader.load(conversation_id)
+            full_load = time.perf_counter() - started
+            reader.close()
+            assert info["message_count"] == len(everything) == length
+            assert recent == everything[-RECENT_MESSAGES:]
+
+            results.append({
+                "messages": length,
+                "append_ms": last_appends / min(length, 100) * 1000,
+                "resume_ms": resume * 1000,
+                "full_load_ms": full_load * 1000,
+            })
+        writer.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lengths", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    args = parser.parse_args()
+    print(f"{'messages':>9} {'append ms':>10} {'resume ms':>10} {'full load ms':>13}")
+    for row in run(args.lengths):
+        print(
+            f"{row['messages']:>9} {row['append_ms']:>10.3f} {row['resume_ms']:>10.2f} {row['full_load_ms']:>13.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
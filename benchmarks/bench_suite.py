@@ -0,0 +1,270 @@
+"""Offline benchmark suite, compared against a stored baseline.
+
+Runs the apps headlessly with Streamlit's AppTest against the stub Gemini backend
+(engine.StubBackend) and the stub Perplexity API (perplexity.StubSearchSession). No quota is
+used. The stubs are given a time to first token, a delay per streamed chunk and a share of
+injected 429s, all seeded so that a run can be repeated. Reported:
+
+- chat: p50/p95 turn latency and script runs per turn in Streamlit_app.py;
+- search: the same for "lookup" turns in For editing.app.py, the runnable app that
+  PSearch.py's steps describe;
+- errors: the failures each app recorded in its trace, and turns that got no reply;
+- ingest: pages per second over a corpus of synthetic PDFs;
+- peak RSS of the benchmark process.
+
+    python benchmarks/bench_suite.py                  # run and compare with baseline.json
+    python benchmarks/bench_suite.py --save-baseline  # run and store the result as the baseline
+
+Exits with status 1 when a metric is worse than the baseline by more than --tolerance, or
+when a turn got no reply: its latency would only show how quickly it failed. The baseline
+records the settings it was taken with; compare runs made with the same settings.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+# Metric name and whether lower or higher is better
+METRICS = {
+    "chat_p50_seconds": "lower",
+    "chat_p95_seconds": "lower",
+    "chat_script_runs_per_turn": "lower",
+    "search_p50_seconds": "lower",
+    "search_p95_seconds": "lower",
+    "search_script_runs_per_turn": "lower",
+    "ingest_pages_per_second": "higher",
+    "peak_rss_mb": "lower",
+}
+
+WORDS = (
+    "grant proposal budget impact community education health water training outcome indicator "
+    "partner district school farmer women youth evaluation baseline target activity output"
+).split()
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def synthetic_pdf(pages, seed, lines_per_page=40, words_per_line=12):
+    """A text-only PDF of pages pages of random words, the same for the same seed"""
+    rand = random.Random(seed)
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{4 + 2 * index} 0 R" for index in range(pages))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode())
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for index in range(pages):
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * index} 0 R >>".encode()
+        )
+        lines = [" ".join(rand.choice(WORDS) for _ in range(words_per_line)) for _ in range(lines_per_page)]
+        text = " T* ".join(f"({line}) Tj" for line in lines)
+        stream = f"BT /F1 10 Tf 12 TL 50 760 Td {text} ET".encode()
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += b"".join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return out
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def count_errors(trace, after_run):
+    # Errors are read from the trace, not from st.error: an app that reruns after a turn has
+    # already cleared the error from the page
+    return sum(
+        1 for span in trace.spans()
+        if span["run"] > after_run and span["stage"] == "event" and span["message"].startswith("Error")
+    )
+
+
+def run_turns(app_file, messages):
+    """Send messages one by one; returns turn latencies, script runs per turn, error count and unanswered turns"""
+    from streamlit.testing.v1 import AppTest
+
+    app = AppTest.from_file(os.path.join(ROOT, app_file), default_timeout=120)
+    app.secrets["GOOGLE_API_KEY"] = "benchmark"
+    app.secrets["P_API_KEY"] = "benchmark"
+    app.run()
+    # Every script run, including st.rerun(), starts a new run of the session's trace
+    start_runs = app.session_state["trace"].run
+    latencies = []
+    unanswered = 0
+    for message in messages:
+        replies = sum(entry["role"] == "assistant" for entry in app.session_state["messages"])
+        started = time.perf_counter()
+        app.chat_input[0].set_value(message).run()
+        latencies.append(time.perf_counter() - started)
+        if app.exception:
+            raise SystemExit(f"{app_file} raised: {app.exception[0].value}")
+        if sum(entry["role"] == "assistant" for entry in app.session_state["messages"]) == replies:
+            unanswered += 1
+    trace = app.session_state["trace"]
+    return latencies, (trace.run - start_runs) / len(messages), count_errors(trace, start_runs), unanswered
+
+
+def run_ingest(corpus):
+    """Extract every PDF of the corpus side by side, as the workspace does; returns pages per second"""
+    from pdf_ingest import PdfTextCache, start_ingest, SHARD_PAGES
+
+    # Start the process that forks extraction workers first, so its start-up isn't counted
+    start_ingest(synthetic_pdf(2 * SHARD_PAGES, seed=-1), cache=PdfTextCache(directory=None)).wait()
+    cache = PdfTextCache(directory=None)
+    documents = [synthetic_pdf(pages, seed=index) for index, pages in enumerate(corpus)]
+    started = time.perf_counter()
+    jobs = [start_ingest(data, cache=cache) for data in documents]
+    for job in jobs:
+        job.wait()
+        if job.error is not None:
+            raise SystemExit(f"Ingest failed: {job.error}")
+    return sum(corpus) / (time.perf_counter() - started)
+
+
+def run(settings):
+    cache_dir = tempfile.mkdtemp(prefix="grantbuddy-bench-")
+    # Before any app module is imported: stub backends and empty caches
+    os.environ["GRANTBUDDY_BACKEND"] = "stub"
+    os.environ["GRANTBUDDY_CACHE_DIR"] = cache_dir
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+
+    import engine
+    import perplexity
+    import rate_limit
+
+    random.seed(settings["seed"])
+    # The suite measures the app and the stubs' latency, not the client-side request queue
+    rate_limit.rate_limiter.limits = {}
+    engine.engine = engine.Engine(engine.StubBackend(
+        chunk_chars=settings["chunk_chars"],
+        first_token_seconds=settings["first_token_seconds"],
+        chunk_seconds=settings["chunk_seconds"],
+        error_rate=settings["error_rate"],
+        seed=settings["seed"],
+    ))
+    search_session = perplexity.StubSearchSession(
+        latency_seconds=settings["search_latency_seconds"],
+        error_rate=settings["error_rate"],
+        # Its own sequence, so the two stubs don't fail in step
+        seed=settings["seed"] + 1,
+    )
+    perplexity.perplexity_client = perplexity.PerplexityClient(session=search_session)
+
+    turns = settings["turns"]
+    chat, chat_runs, chat_errors, chat_unanswered = run_turns(
+        "Streamlit_app.py", [f"Question {turn}: how should I budget for monitoring?" for turn in range(turns)]
+    )
+    search, search_runs, search_errors, search_unanswered = run_turns(
+        "For editing.app.py", [f"lookup education funders in region {turn}, deadlines" for turn in range(turns)]
+    )
+    pages_per_second = run_ingest(settings["pdf_pages"])
+    return {
+        "chat_p50_seconds": round(percentile(chat, 0.5), 4),
+        "chat_p95_seconds": round(percentile(chat, 0.95), 4),
+        "chat_script_runs_per_turn": chat_runs,
+        "chat_errors": chat_errors,
+        "chat_unanswered": chat_unanswered,
+        "search_p50_seconds": round(percentile(search, 0.5), 4),
+        "search_p95_seconds": round(percentile(search, 0.95), 4),
+        "search_script_runs_per_turn": search_runs,
+        "search_errors": search_errors,
+        "search_unanswered": search_unanswered,
+        "model_requests": engine.engine.backend.requests,
+        "search_requests": search_session.requests,
+        "injected_429s": engine.engine.backend.rate_limited + search_session.rate_limited,
+        "ingest_pages_per_second": round(pages_per_second, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print each metric against the baseline; returns the names of those that got worse"""
+    regressions = []
+    print(f"{'metric':<30} {'result':>10} {'baseline':>10} {'change':>8}")
+    for name, better in METRICS.items():
+        value = results[name]
+        base = baseline["results"].get(name) if baseline else None
+        if not base:
+            print(f"{name:<30} {value:>10} {'-':>10} {'-':>8}")
+            continue
+        change = (value - base) / base
+        worse = change > tolerance if better == "lower" else change < -tolerance
+        if worse:
+            regressions.append(name)
+        flag = "  worse" if worse else ""
+        print(f"{name:<30} {value:>10} {base:>10} {change:>+8.0%}{flag}")
+    for name in ("chat_errors", "chat_unanswered", "search_errors", "search_unanswered",
+                 "model_requests", "search_requests", "injected_429s"):
+        print(f"{name:<30} {results[name]:>10}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--first-token-seconds", type=float, default=0.3)
+    parser.add_argument("--chunk-seconds", type=float, default=0.02)
+    parser.add_argument("--chunk-chars", type=int, default=40)
+    parser.add_argument("--search-latency-seconds", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.1, help="share of model and search calls that get a 429")
+    parser.add_argument("--pdf-pages", type=int, nargs="+", default=[20, 50, 100, 200], help="pages of each synthetic PDF")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed change before a metric counts as worse")
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    settings = {
+        "turns": args.turns,
+        "first_token_seconds": args.first_token_seconds,
+        "chunk_seconds": args.chunk_seconds,
+        "chunk_chars": args.chunk_chars,
+        "search_latency_seconds": args.search_latency_seconds,
+        "error_rate": args.error_rate,
+        "pdf_pages": args.pdf_pages,
+        "seed": args.seed,
+    }
+    results = run(settings)
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+        if baseline["settings"] != settings:
+            print("Note: the baseline was taken with different settings:", baseline["settings"])
+    regressions = compare(results, None if args.save_baseline else baseline, args.tolerance)
+
+    unanswered = results["chat_unanswered"] + results["search_unanswered"]
+    if unanswered:
+        # Not saved as a baseline either
+        raise SystemExit(f"{unanswered} turns got no reply, see chat_errors and search_errors")
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump({"settings": settings, "results": results}, file, indent=2)
+            file.write("\n")
+        print(f"Baseline saved to {args.baseline}")
+    elif regressions:
+        raise SystemExit(f"Worse than the baseline: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
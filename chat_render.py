@@ -0,0 +1,25 @@
+import re
+
+# Chat history rendering helpers.
+# Long sessions have hundreds of messages, and drawing all of them on every run makes the
+# page slower as the conversation grows. Only the most recent messages are drawn; older ones
+# are loaded a page at a time on request.
+
+RECENT_MESSAGES = 20
+PAGE_SIZE = 20
+
+# A "$" right before a digit that isn't escaped yet. Streamlit renders the text between two
+# dollar signs as LaTeX, so a budget line like "$50,000 for staff and $10,000 for travel"
+# came out as a garbled formula. Math such as "$x^2$" doesn't start with a digit and still renders.
+_CURRENCY = re.compile(r"(?<!\\)\$(?=\d)")
+
+
+def escape_currency(content):
+    """Markdown with dollar amounts escaped so they show as text, not math"""
+    return _CURRENCY.sub(r"\\$", content)
+
+
+def first_visible(message_count, pages_loaded=0, recent=RECENT_MESSAGES, page_size=PAGE_SIZE):
+    """Index of the first message to draw; every message before it stays hidden"""
+    visible = recent + pages_loaded * page_size
+    return max(0, message_count - visible)
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# Gemini context caching for the fixed start of every chat.
+# The opening turns of a chat (the system prompt and, when retrieval is off, the documents)
+# are registered once as cached content, keyed by model and content hash, and sessions point
+# at the cache instead of sending the prefix with every message. Prefixes below Gemini's
+# minimum cache size are sent as history. A session renews the cache while it uses it. The
+# calls that create, renew and delete caches go through the engine backend (see engine.py),
+# so the stub backend can count the prefix bytes that would be sent.
+
+CACHE_TTL_SECONDS = 3600
+# A session that uses the cache renews it once less than this is left, so a chat keeps its
+# cache for as long as it is active, even when turns are many minutes apart
+RENEW_MARGIN_SECONDS = CACHE_TTL_SECONDS // 2
+MAX_ENTRIES = 8
+# Gemini only caches prefixes of at least 32,768 tokens; roughly 4 characters per token
+MIN_CACHE_CHARS = 32768 * 4
+
+
+def content_bytes(messages):
+    """Size in bytes of the text parts of a list of chat turns (dicts or Gemini Content objects)"""
+    total = 0
+    for message in messages:
+        parts = message.get("parts", []) if isinstance(message, dict) else message.parts
+        for part in parts:
+            text = part if isinstance(part, str) else getattr(part, "text", "")
+            total += len(text.encode("utf-8"))
+    return total
+
+
+def prefix_key(model_name, prefix_messages):
+    """Cache key: the model plus a hash of the prefix turns"""
+    digest = hashlib.sha256(json.dumps(prefix_messages, sort_keys=True).encode("utf-8")).hexdigest()
+    return model_name, digest
+
+
+class _Entry:
+    def __init__(self, handle, expires_at, prefix_bytes):
+        self.handle = handle
+        self.expires_at = expires_at
+        self.prefix_bytes = prefix_bytes
+
+
+class PrefixCache:
+    """Registers chat prefixes as cached content and hands out the cache handles"""
+
+    def __init__(self, backend, ttl=CACHE_TTL_SECONDS, renew_margin=RENEW_MARGIN_SECONDS,
+                 max_entries=MAX_ENTRIES, min_chars=MIN_CACHE_CHARS, clock=time.time):
+        self.backend = backend
+        self.ttl = ttl
+        self.renew_margin = renew_margin
+        self.max_entries = max_entries
+        self.min_chars = min_chars
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.renewed = 0
+        self.evicted = 0
+        self.failures = 0
+        self.prefix_bytes_saved = 0
+
+    def _drop(self, key):
+        # Caller holds the lock
+        entry = self._entries.pop(key)
+        self.evicted += 1
+        if entry.handle is not None:
+            try:
+                self.backend.delete_cache(entry.handle)
+            except Exception:
+                pass
+
+    def _renew(self, key, entry, now):
+        # Caller holds the lock; False if the cache could not be renewed and was dropped
+        if entry.expires_at - now >= self.renew_margin:
+            return True
+        try:
+            self.backend.renew_cache(entry.handle, self.ttl)
+        except Exception:
+            self._drop(key)
+            return False
+        entry.expires_at = now + self.ttl
+        self.renewed += 1
+        return True
+
+    def lookup(self, model_name, prefix_messages):
+        """Return a cache handle for the prefix, creating or renewing it as needed; None if not cacheable"""
+        prefix_bytes = content_bytes(prefix_messages)
+        if prefix_bytes < self.min_chars:
+            return None
+        key = prefix_key(model_name, prefix_messages)
+        with self._lock:
+            now = self.clock()
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= now:
+                self._drop(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if entry.handle is None:
+                    # Creation failed recently, don't retry until the entry expires
+                    return None
+                if not self._renew(key, entry, now):
+                    return None
+                self.reused += 1
+                self.prefix_bytes_saved += entry.prefix_bytes
+                return entry.handle
+
+            try:
+                handle = self.backend.create_cache(model_name, prefix_messages, self.ttl)
+                self.created += 1
+            except Exception:
+                handle = None
+                self.failures += 1
+            self._entries[key] = _Entry(handle, now + self.ttl, prefix_bytes)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+            return handle
+
+    def touch(self, key, handle):
+        """Renew the cache a session is sending with; False if it expired or was evicted
+
+        A session that gets False has to reopen on a fresh cache (see EngineSession.send_message).
+        """
+        with self._lock:
+            now = self.clock()
+            entry = self._entries.get(key)
+            if entry is None or entry.handle is not handle:
+                return False
+            if entry.expires_at <= now:
+                self._drop(key)
+                return False
+            self._entries.move_to_end(key)
+            return self._renew(key, entry, now)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "created": self.created,
+                "reused": self.reused,
+                "renewed": self.renewed,
+                "evicted": self.evicted,
+                "failures": self.failures,
+                "prefix_bytes_saved": self.prefix_bytes_saved,
+            }
+
@@ -0,0 +1,126 @@
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from pdf_ingest import CACHE_DIR
+
+# Durable conversations.
+# Every message is appended to a local SQLite database as it is added, one INSERT per
+# message. A conversation has a short ID that the app keeps in the page URL; opening the URL
+# again resumes it. Resuming reads only the latest messages, older ones are read a page at a
+# time when the user scrolls back, so resume time does not grow with the transcript.
+
+DB_PATH = os.path.join(CACHE_DIR, "conversations.sqlite") if CACHE_DIR else None
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    settings TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    meta TEXT,
+    created REAL NOT NULL,
+    PRIMARY KEY (conversation_id, seq)
+);
+"""
+
+
+def _row_message(role, content, meta):
+    message = {"role": role, "content": content}
+    if meta:
+        message.update(json.loads(meta))
+    return message
+
+
+class ConversationStore:
+    """Append-only message log per conversation, in one SQLite file shared by every session"""
+
+    def __init__(self, path=DB_PATH):
+        self.path = path or ":memory:"
+        if path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        # WAL lets other app processes read while one writes
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self.appends = 0
+
+    def create(self, settings=None):
+        """Start a new conversation and return its ID"""
+        conversation_id = secrets.token_urlsafe(9)
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO conversations (id, created, updated, settings) VALUES (?, ?, ?, ?)",
+                (conversation_id, now, now, json.dumps(settings or {})),
+            )
+        return conversation_id
+
+    def append(self, conversation_id, message, settings=None):
+        """Write one message at the end of a conversation; settings, if given, replace the stored ones"""
+        meta = {key: value for key, value in message.items() if key not in ("role", "content")}
+        now = time.time()
+        with self._lock, self._connection:
+            (seq,) = self._connection.execute(
+                "SELECT message_count FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()
+            self._connection.execute(
+                "INSERT INTO messages (conversation_id, seq, role, content, meta, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (conversation_id, seq, message["role"], message["content"], json.dumps(meta) if meta else None, now),
+            )
+            if settings is None:
+                self._connection.execute(
+                    "UPDATE conversations SET message_count = ?, updated = ? WHERE id = ?",
+                    (seq + 1, now, conversation_id),
+                )
+            else:
+                self._connection.execute(
+                    "UPDATE conversations SET message_count = ?, updated = ?, settings = ? WHERE id = ?",
+                    (seq + 1, now, json.dumps(settings), conversation_id),
+                )
+            self.appends += 1
+        return seq
+
+    def info(self, conversation_id):
+        """Message count and stored settings of a conversation, or None if it doesn't exist"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT message_count, settings, updated FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"message_count": row[0], "settings": json.loads(row[1]), "updated": row[2]}
+
+    def load(self, conversation_id, end=None, limit=None):
+        """Messages before position end (all of them by default), at most the last limit, oldest first"""
+        query = "SELECT role, content, meta FROM messages WHERE conversation_id = ?"
+        args = [conversation_id]
+        if end is not None:
+            query += " AND seq < ?"
+            args.append(end)
+        query += " ORDER BY seq DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            args.append(limit)
+        with self._lock:
+            rows = self._connection.execute(query, args).fetchall()
+        return [_row_message(*row) for row in reversed(rows)]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+conversation_store = ConversationStore()
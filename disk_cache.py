@@ -0,0 +1,69 @@
+import os
+
+# Cache entries kept on disk, one file per key, least recently used removed first.
+# Reading an entry touches its file, so file modification times order the entries by last
+# use. A failed read or write counts as a miss: the disk copy only saves work that can be
+# done again.
+
+
+def _read_text(file):
+    return file.read()
+
+
+def _write_text(file, text):
+    file.write(text)
+
+
+class DiskLRU:
+    """At most max_entries files in directory; no directory means nothing is kept
+
+    read(file) and write(file, value) convert values to and from the files, which are opened
+    as UTF-8 text. The default stores strings as they are.
+    """
+
+    def __init__(self, directory, max_entries, suffix=".txt", read=_read_text, write=_write_text):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.suffix = suffix
+        self.read = read
+        self.write = write
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}{self.suffix}")
+
+    def get(self, key):
+        """The stored value for key, or None"""
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as file:
+                value = self.read(file)
+            os.utime(self._path(key))
+            return value
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, value):
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Written under a temporary name first, so other processes never read half a file
+            tmp_path = self._path(key) + f".{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                self.write(file, value)
+            os.replace(tmp_path, self._path(key))
+            self._evict()
+        except OSError:
+            pass
+
+    def _evict(self):
+        names = [name for name in os.listdir(self.directory) if name.endswith(self.suffix)]
+        if len(names) <= self.max_entries:
+            return
+        paths = sorted((os.path.join(self.directory, name) for name in names), key=os.path.getmtime)
+        for path in paths[: len(paths) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,142 @@
+import threading
+import weakref
+from collections import OrderedDict
+
+from token_budget import message_text
+
+# Shared store for extracted document text.
+# The text of each PDF is kept once per process, keyed by the PDF's content hash, and
+# sessions hold only a DocumentRef with that ID. References are counted; a document nobody
+# references stays around for the next upload of the same file until the store is over its
+# size limit, then the least recently used unreferenced documents are dropped. A session's
+# reference is released when it switches to another document, clears the chat, or ends and
+# its state is garbage collected.
+
+MAX_STORE_BYTES = 512 * 1024 * 1024
+
+
+def text_bytes(text):
+    return len(text.encode("utf-8"))
+
+
+class _Document:
+    def __init__(self, text):
+        self.text = text
+        self.size = text_bytes(text)
+        self.refs = 0
+
+
+class DocumentRef:
+    """A session's handle on a stored document; only the document ID is held"""
+
+    def __init__(self, store, doc_id):
+        self.store = store
+        self.doc_id = doc_id
+        # Runs once: on release() or when the session state holding this ref is collected
+        self._release = weakref.finalize(self, store._release, doc_id)
+
+    @property
+    def text(self):
+        return self.store.get(self.doc_id) or ""
+
+    def release(self):
+        self._release()
+
+
+class DocumentStore:
+    """Content-addressed, reference-counted document text shared by every session"""
+
+    def __init__(self, max_bytes=MAX_STORE_BYTES):
+        self.max_bytes = max_bytes
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.evicted = 0
+
+    def put(self, doc_id, text, acquire=False):
+        """Store text under doc_id; a longer text replaces a shorter one as more pages are extracted
+
+        With acquire, a reference is taken before anything is evicted and returned instead of
+        doc_id, so a document stored while the store is full can't be dropped before it is used.
+        """
+        with self._lock:
+            document = self._documents.get(doc_id)
+            if document is None:
+                document = _Document(text)
+                self._documents[doc_id] = document
+                self.total_bytes += document.size
+            elif len(text) > len(document.text):
+                size = text_bytes(text)
+                self.total_bytes += size - document.size
+                document.text, document.size = text, size
+            self._documents.move_to_end(doc_id)
+            if acquire:
+                document.refs += 1
+            self._evict(keep=doc_id)
+        return DocumentRef(self, doc_id) if acquire else doc_id
+
+    def acquire(self, doc_id):
+        """A new reference to a stored document"""
+        with self._lock:
+            self._documents[doc_id].refs += 1
+            self._documents.move_to_end(doc_id)
+        return DocumentRef(self, doc_id)
+
+    def _release(self, doc_id):
+        with self._lock:
+            document = self._documents.get(doc_id)
+            if document is not None:
+                document.refs -= 1
+            self._evict()
+
+    def _evict(self, keep=None):
+        # Caller holds the lock; documents still referenced by a session are never dropped, nor is
+        # keep, the one just stored, which its caller is about to acquire
+        for doc_id in list(self._documents):
+            if self.total_bytes <= self.max_bytes:
+                break
+            document = self._documents[doc_id]
+            if document.refs <= 0 and doc_id != keep:
+                del self._documents[doc_id]
+                self.total_bytes -= document.size
+                self.evicted += 1
+
+    def get(self, doc_id):
+        with self._lock:
+            document = self._documents.get(doc_id)
+            if document is None:
+                return None
+            self._documents.move_to_end(doc_id)
+            return document.text
+
+    def info(self, doc_id):
+        """Size in bytes and number of sessions referencing a document"""
+        with self._lock:
+            document = self._documents.get(doc_id)
+            if document is None:
+                return {"bytes": 0, "references": 0}
+            return {"bytes": document.size, "references": document.refs}
+
+    def stats(self):
+        with self._lock:
+            refs = sum(document.refs for document in self._documents.values())
+            # Bytes a per-session copy would have cost on top of the one stored copy
+            saved = sum(document.size * (document.refs - 1) for document in self._documents.values() if document.refs > 1)
+            return {
+                "documents": len(self._documents),
+                "bytes": self.total_bytes,
+                "references": refs,
+                "bytes_saved": saved,
+                "evicted": self.evicted,
+            }
+
+
+def session_bytes(messages, chat_session=None):
+    """Text a single session keeps for itself: its messages and its model chat history"""
+    total = sum(text_bytes(message["content"]) for message in messages)
+    if chat_session is not None:
+        total += sum(text_bytes(message_text(message)) for message in chat_session.history)
+    return total
+
+
+document_store = DocumentStore()
@@ -0,0 +1,176 @@
+import time
+
+from engine import engine
+from generation_jobs import generation_pool, GenerationCancelled
+from rate_limit import rate_limiter
+from resilience import call_with_retry
+from retrieval import get_index, search_documents, compose_prompt, TOP_K
+from streaming import send_reply
+
+# Full proposal drafts written section by section, in parallel.
+# A draft is one prompt per section, and every section is a job in the shared generation
+# pool, so they are written at the same time. Each still takes its turn in the model's
+# rate-limit queue, and waits there without holding a worker. Each section streams into its
+# own job; when all are done they are stitched into one document in a fixed order. The
+# wall-clock time is close to that of the slowest section rather than the sum of all of them.
+
+SECTIONS = (
+    ("Problem Statement", "Describe the problem the project addresses, who is affected and why it matters now, using evidence where the background gives it."),
+    ("Goals and Objectives", "State the overall goal and three to five SMART objectives that follow from the problem."),
+    ("Budget Narrative", "Explain the main cost categories, how each supports the objectives, and why the amounts are reasonable."),
+    ("Monitoring and Evaluation Plan", "Give the indicators, data sources, collection frequency and responsibilities for tracking each objective."),
+    ("Impact Story", "Tell a short, concrete story of the change the project will make for one beneficiary or community."),
+)
+
+
+def section_prompt(title, instruction, form_responses):
+    """Prompt for one section, with the form answers as shared background"""
+    background = "\n".join(f"{question}: {answer}" for question, answer in form_responses.items())
+    return (
+        f"Write the '{title}' section of a grant proposal. {instruction}\n"
+        "Write only this section, starting straight with its content and without a heading.\n\n"
+        f"Background from the applicant:\n{background}"
+    )
+
+
+class DraftSection:
+    def __init__(self, title, job):
+        self.title = title
+        self.job = job
+
+    @property
+    def seconds(self):
+        job = self.job
+        if job.finished is None or job.started is None:
+            return None
+        return job.finished - job.started
+
+
+class ProposalDraft:
+    """The sections of one proposal being drafted side by side"""
+
+    def __init__(self, sections):
+        self.sections = sections
+        self.started = time.perf_counter()
+
+    @property
+    def done(self):
+        return all(section.job.done for section in self.sections)
+
+    @property
+    def sections_done(self):
+        return sum(section.job.done for section in self.sections)
+
+    def wait(self, timeout=None):
+        """Wait up to timeout for the next unfinished section; True once all sections are done"""
+        for section in self.sections:
+            if not section.job.done:
+                section.job.wait(timeout)
+                break
+        return self.done
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def cancel(self):
+        for section in self.sections:
+            section.job.cancel()
+
+    def stitch(self):
+        """All sections as one markdown document, in section order"""
+        parts = ["# Proposal Draft"]
+        for section in self.sections:
+            job = section.job
+            if job.status == "done":
+                body = job.result.text
+                # A section cut off half way is kept, marked like a partial chat reply
+                if job.result.partial and isinstance(job.result.error, GenerationCancelled):
+                    body += "\n\n_You stopped this section. The part written so far has been kept._"
+                elif job.result.partial:
+                    body += "\n\n_This section was interrupted. The part received so far has been kept._"
+            elif job.status == "cancelled":
+                body = "_This section was stopped before it was written._"
+            else:
+                body = f"_This section could not be drafted: {job.error}_"
+            parts.append(f"## {section.title}\n\n{body}")
+        return "\n\n".join(parts)
+
+    def timing(self):
+        """Debug line comparing the draft's wall-clock time with a section-by-section run"""
+        seconds = [section.seconds for section in self.sections if section.seconds is not None]
+        if not seconds:
+            return "Proposal draft: no sections finished"
+        return (
+            f"Proposal draft: {len(self.sections)} sections in {self.elapsed:.1f}s, "
+            f"slowest section {max(seconds):.1f}s, one after another would take {sum(seconds):.1f}s"
+        )
+
+
+def draft_section(job, request, title, instruction):
+    # Runs in a generation worker; the section is written once the model has a request slot
+    model_name = request["model_name"]
+    if request["allow_fallback"]:
+        model_name = rate_limiter.choose_model(model_name)
+
+    def show_queue_position(position, wait):
+        job.info(f"⏳ Waiting for {model_name}: number {position} in the queue, about {wait:.0f}s to go.")
+
+    return job.after_slot(
+        model_name, write_section, request, model_name, title, instruction, on_wait=show_queue_position
+    )
+
+
+def write_section(job, request, model_name, title, instruction):
+    # Its own chat on the shared prefix, so sections don't see each other
+    chat = engine.start_session(model_name, request["temperature"], request["system_prompt"], request["pdf_content"])
+    prompt = section_prompt(title, instruction, request["form_responses"])
+    sources = request["retrieval_sources"]
+    if sources:
+        # With retrieval on, each section gets the document excerpts that match its own prompt
+        indexes = [(name, get_index(text)) for name, text in sources]
+        prompt = compose_prompt(prompt, search_documents(indexes, prompt, k=TOP_K))
+
+    # The first request uses the slot the job waited for; a retry waits for a new one
+    slot_taken = True
+
+    def attempt():
+        nonlocal slot_taken
+        job.checkpoint()
+        if not slot_taken:
+            rate_limiter.acquire(model_name)
+        slot_taken = False
+        return chat.send_message(prompt, stream=True)
+
+    started = time.perf_counter()
+    response = call_with_retry(attempt, model_name, sleep=job.sleep)
+    return send_reply(chat, prompt, job, stream=True, response=response, started=started, check=job.checkpoint)
+
+
+def start_draft(form_responses, model_name, temperature, system_prompt, pdf_content="",
+                allow_fallback=False, sections=SECTIONS, pool=None, retrieval_sources=()):
+    """Submit one job per section and return the ProposalDraft that tracks them
+
+    Documents are given either whole, as pdf_content, or as (name, text) retrieval_sources
+    from which each section is sent only its matching excerpts.
+    """
+    pool = pool or generation_pool
+    request = {
+        "form_responses": dict(form_responses),
+        "model_name": model_name,
+        "temperature": temperature,
+        "system_prompt": system_prompt,
+        "pdf_content": pdf_content,
+        "retrieval_sources": list(retrieval_sources),
+        "allow_fallback": allow_fallback,
+    }
+    jobs = []
+    try:
+        for title, instruction in sections:
+            jobs.append(DraftSection(title, pool.submit(draft_section, request, title, instruction)))
+    except Exception:
+        # Don't leave half a draft running if the pool refuses part of it
+        for section in jobs:
+            section.job.cancel()
+        raise
+    return ProposalDraft(jobs)
@@ -0,0 +1,452 @@
+import datetime
+import hashlib
+import io
+import itertools
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from context_cache import PrefixCache, content_bytes, prefix_key
+
+# Shared generation engine.
+# Every app variant opens its chats through this module:
+#   - a backend does the actual model calls: GeminiBackend for the real API, StubBackend
+#     for a deterministic offline stand-in (set GRANTBUDDY_BACKEND=stub to use it),
+#   - a process-wide registry keeps warm model clients keyed by (model, config),
+#   - Engine.start_session() is the one code path that opens a chat, on top of the
+#     context cache from context_cache.py.
+
+GENERATION_DEFAULTS = {
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 8192,
+}
+SYSTEM_ACK = "Understood. I will follow these instructions."
+PDF_INTRO = "The following is the content of an uploaded PDF document. Please consider this information when responding to user queries:"
+PDF_ACK = "I have received and will consider the PDF content in our conversation."
+MAX_WARM_MODELS = 32
+MAX_SHARED_PREFIXES = 16
+
+
+def generation_config(temperature):
+    """The generation settings every session uses, with the slider's temperature"""
+    return {"temperature": temperature, **GENERATION_DEFAULTS}
+
+
+def build_prefix(system_prompt, pdf_content=""):
+    """Opening turns of every chat: the system prompt and, if given, the PDF text"""
+    prefix = [
+        {"role": "user", "parts": [f"System: {system_prompt}"]},
+        {"role": "model", "parts": [SYSTEM_ACK]},
+    ]
+    if pdf_content:
+        prefix.extend([
+            {"role": "user", "parts": [f"{PDF_INTRO}\n\n{pdf_content}"]},
+            {"role": "model", "parts": [PDF_ACK]},
+        ])
+    return prefix
+
+
+class GeminiBackend:
+    """Model clients and context caches from google.generativeai"""
+
+    name = "gemini"
+
+    def create_model(self, model_name, config, cached_content=None):
+        import google.generativeai as genai
+
+        if cached_content is not None:
+            return genai.GenerativeModel.from_cached_content(cached_content, generation_config=config)
+        return genai.GenerativeModel(model_name=model_name, generation_config=config)
+
+    def create_cache(self, model_name, prefix_messages, ttl):
+        from google.generativeai import caching
+
+        return caching.CachedContent.create(
+            model=f"models/{model_name}",
+            display_name="grantbuddy-prefix",
+            contents=prefix_messages,
+            ttl=ttl,
+        )
+
+    def renew_cache(self, handle, ttl):
+        handle.update(ttl=ttl)
+
+    def delete_cache(self, handle):
+        handle.delete()
+
+    def upload_file(self, data, mime_type, display_name=None):
+        import google.generativeai as genai
+
+        return genai.upload_file(io.BytesIO(data), mime_type=mime_type, display_name=display_name)
+
+    def get_file(self, name):
+        import google.generativeai as genai
+
+        return genai.get_file(name)
+
+
+class StubRateLimitError(Exception):
+    """An injected 429; it carries the status code, so it is retried like the real one"""
+
+    code = 429
+
+
+class StubUsage:
+    """Token counts of a stub request, estimated at 4 characters per token"""
+
+    def __init__(self, prompt_chars, reply_chars):
+        self.prompt_token_count = -(-prompt_chars // 4)
+        self.candidates_token_count = -(-reply_chars // 4)
+
+
+class StubResponse:
+    """Looks enough like a Gemini response for the app: has .text and iterates in chunks
+
+    When streamed, the first chunk arrives after first_delay seconds and each later one after
+    chunk_delay, like a model writing its reply.
+    """
+
+    def __init__(self, text, chunk_chars=40, first_delay=0.0, chunk_delay=0.0, usage_metadata=None):
+        self.text = text
+        self.chunk_chars = chunk_chars
+        self.first_delay = first_delay
+        self.chunk_delay = chunk_delay
+        self.usage_metadata = usage_metadata
+
+    def __iter__(self):
+        for start in range(0, len(self.text), self.chunk_chars):
+            delay = self.first_delay if start == 0 else self.chunk_delay
+            if delay:
+                time.sleep(delay)
+            yield StubResponse(self.text[start:start + self.chunk_chars], self.chunk_chars)
+
+
+class StubChat:
+    """Offline chat session with deterministic replies that counts the bytes each request would send"""
+
+    def __init__(self, backend, model_name, history):
+        self.backend = backend
+        self.model_name = model_name
+        self.history = list(history)
+
+    def send_message(self, content, stream=False):
+        self.backend.check_rate_limit()
+        text = content if isinstance(content, str) else " ".join(str(part) for part in content)
+        # A real request carries the whole history plus the new message, but not a cached prefix
+        size = content_bytes(self.history) + len(text.encode("utf-8"))
+        self.backend.count_request(size)
+        digest = hashlib.sha256(f"{self.model_name}:{text}".encode("utf-8")).hexdigest()[:8]
+        reply = f"[{self.model_name} {digest}] Reply to: {text[:60]}"
+        self.history.extend([{"role": "user", "parts": [text]}, {"role": "model", "parts": [reply]}])
+        return self.backend.respond(reply, stream, StubUsage(size, len(reply)))
+
+    def rewind(self):
+        return self.history.pop(-2), self.history.pop()
+
+
+class StubFile:
+    """Stands in for a File API file: ready at once and kept for 48 hours like the real thing"""
+
+    def __init__(self, name, mime_type, size_bytes, display_name=None):
+        self.name = name
+        self.mime_type = mime_type
+        self.size_bytes = size_bytes
+        self.display_name = display_name
+        self.state = "ACTIVE"
+        self.expiration_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=48)
+
+
+class StubModel:
+    def __init__(self, backend, model_name, config, cached_content=None):
+        self.backend = backend
+        self.model_name = model_name
+        self.config = config
+        self.cached_content = cached_content
+
+    def start_chat(self, history=()):
+        return StubChat(self.backend, self.model_name, history)
+
+    def generate_content(self, prompt):
+        self.backend.check_rate_limit()
+        self.backend.count_request(len(prompt.encode("utf-8")))
+        digest = hashlib.sha256(f"{self.model_name}:{prompt}".encode("utf-8")).hexdigest()[:8]
+        return self.backend.respond(f"[{self.model_name} {digest}] Summary of {len(prompt)} characters", False)
+
+
+class StubBackend:
+    """Deterministic local backend for tests and offline runs, with request and byte counters
+
+    Replies are instant unless first_token_seconds and chunk_seconds are set. A share of
+    requests given by error_rate fails with a 429, drawn from a generator seeded with seed
+    so a benchmark run can be repeated.
+    """
+
+    name = "stub"
+
+    def __init__(self, chunk_chars=40, first_token_seconds=0.0, chunk_seconds=0.0, error_rate=0.0, seed=0):
+        self.chunk_chars = chunk_chars
+        self.first_token_seconds = first_token_seconds
+        self.chunk_seconds = chunk_seconds
+        self.error_rate = error_rate
+        self.caches = {}
+        self._cache_ids = itertools.count(1)
+        self.files = {}
+        self.models_created = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self.bytes_sent = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def count_request(self, size):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += size
+
+    def check_rate_limit(self):
+        with self._lock:
+            limited = self.error_rate > 0 and self._random.random() < self.error_rate
+            if limited:
+                self.rate_limited += 1
+        if limited:
+            raise StubRateLimitError("429 Resource has been exhausted (injected by the stub backend)")
+
+    def respond(self, text, stream, usage=None):
+        """A reply with the configured latency: spread over the chunks when streamed, up front otherwise"""
+        if stream:
+            return StubResponse(text, self.chunk_chars, self.first_token_seconds, self.chunk_seconds, usage)
+        chunks = max(1, -(-len(text) // self.chunk_chars))
+        delay = self.first_token_seconds + self.chunk_seconds * (chunks - 1)
+        if delay:
+            time.sleep(delay)
+        return StubResponse(text, self.chunk_chars, usage_metadata=usage)
+
+    def create_model(self, model_name, config, cached_content=None):
+        with self._lock:
+            self.models_created += 1
+        return StubModel(self, model_name, config, cached_content)
+
+    def create_cache(self, model_name, prefix_messages, ttl):
+        with self._lock:
+            name = f"cachedContents/stub-{next(self._cache_ids)}"
+            self.caches[name] = prefix_messages
+            # Creating the cache is when the prefix is actually uploaded
+            self.bytes_sent += content_bytes(prefix_messages)
+        return name
+
+    def renew_cache(self, handle, ttl):
+        pass
+
+    def delete_cache(self, handle):
+        with self._lock:
+            self.caches.pop(handle, None)
+
+    def upload_file(self, data, mime_type, display_name=None):
+        with self._lock:
+            name = f"files/stub-{len(self.files) + 1}"
+            self.files[name] = StubFile(name, mime_type, len(data), display_name)
+            self.bytes_sent += len(data)
+        return self.files[name]
+
+    def get_file(self, name):
+        return self.files[name]
+
+
+class ModelRegistry:
+    """Warm model clients keyed by (model, config, cached content), reused by every session"""
+
+    def __init__(self, backend, max_models=MAX_WARM_MODELS):
+        self.backend = backend
+        self.max_models = max_models
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, model_name, config, cached_content=None):
+        cache_name = getattr(cached_content, "name", cached_content)
+        key = (model_name, tuple(sorted(config.items())), cache_name)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return self._models[key]
+            self.misses += 1
+            model = self.backend.create_model(model_name, config, cached_content)
+            self._models[key] = model
+            while len(self._models) > self.max_models:
+                self._models.popitem(last=False)
+            return model
+
+    def __len__(self):
+        return len(self._models)
+
+
+class EngineSession:
+    """A chat session plus what is needed to move its conversation to another model
+
+    It can be used wherever a Gemini ChatSession was: send_message, history and rewind are passed through.
+    """
+
+    def __init__(self, engine, chat, model_name, temperature, prefix_messages, history_offset, cache_handle=None):
+        self.engine = engine
+        self.chat = chat
+        self.model_name = model_name
+        self.temperature = temperature
+        self.prefix_messages = prefix_messages
+        self.history_offset = history_offset
+        self.cache_handle = cache_handle
+        self.reopened = 0
+
+    def send_message(self, content, stream=False):
+        if self.cache_handle is not None and not self.engine.prefix_cache.touch(
+            prefix_key(self.model_name, self.prefix_messages), self.cache_handle
+        ):
+            # The context cache expired or was evicted, so move the conversation onto a new one
+            self._reopen()
+        return self.chat.send_message(content, stream=stream)
+
+    def _reopen(self):
+        session = self.engine.start_session_with_prefix(
+            self.model_name, self.temperature, self.prefix_messages, history=self.conversation()
+        )
+        self.chat = session.chat
+        self.history_offset = session.history_offset
+        self.cache_handle = session.cache_handle
+        self.reopened += 1
+
+    @property
+    def history(self):
+        return self.chat.history
+
+    @history.setter
+    def history(self, history):
+        self.chat.history = history
+
+    def rewind(self):
+        return self.chat.rewind()
+
+    def conversation(self):
+        """The turns after the system prompt and document prefix"""
+        return list(self.chat.history)[self.history_offset:]
+
+    def continue_on(self, model_name, temperature=None, prefix_messages=None):
+        """A new session on model_name that carries on this conversation"""
+        return self.engine.start_session_with_prefix(
+            model_name,
+            self.temperature if temperature is None else temperature,
+            self.prefix_messages if prefix_messages is None else prefix_messages,
+            history=self.conversation(),
+        )
+
+    def with_prefix(self, prefix_messages):
+        """A new session on the same model that carries on this conversation after a different prefix"""
+        return self.continue_on(self.model_name, prefix_messages=prefix_messages)
+
+    def replace_last_message(self, content):
+        """Swap the latest user message in the history for content, keeping the reply to it"""
+        history = list(self.chat.history)
+        history[-2] = {"role": "user", "parts": [content]}
+        self.chat.history = history
+
+    def adopt_last_turn(self, other):
+        """Copy the latest user/model turn pair from another session into this one"""
+        history = list(self.chat.history)
+        history.extend(list(other.history)[-2:])
+        self.chat.history = history
+
+
+class Engine:
+    """Single entry point for creating chat sessions"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.models = ModelRegistry(backend)
+        self.prefix_cache = PrefixCache(backend)
+        self._prefixes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start_session_with_prefix(self, model_name, temperature, prefix_messages, history=()):
+        config = generation_config(temperature)
+        # The prefix is registered once as cached content when it is large enough, otherwise sent as history
+        handle = self.prefix_cache.lookup(model_name, prefix_messages)
+        model = self.models.get(model_name, config, handle)
+        opening = list(history) if handle is not None else list(prefix_messages) + list(history)
+        chat = model.start_chat(history=opening)
+        offset = 0 if handle is not None else len(prefix_messages)
+        return EngineSession(self, chat, model_name, temperature, prefix_messages, offset, handle)
+
+    def prefix_for(self, system_prompt, pdf_content=""):
+        """Opening turns for a prompt and document, built once so sessions share them instead of copying the text"""
+        key = (
+            hashlib.sha256(system_prompt.encode("utf-8")).digest(),
+            hashlib.sha256(pdf_content.encode("utf-8")).digest(),
+        )
+        with self._lock:
+            if key in self._prefixes:
+                self._prefixes.move_to_end(key)
+                return self._prefixes[key]
+        prefix = build_prefix(system_prompt, pdf_content)
+        with self._lock:
+            prefix = self._prefixes.setdefault(key, prefix)
+            while len(self._prefixes) > MAX_SHARED_PREFIXES:
+                self._prefixes.popitem(last=False)
+        return prefix
+
+    def start_session(self, model_name, temperature, system_prompt, pdf_content="", history=()):
+        """Open a chat with the system prompt and optional PDF text as its opening turns"""
+        return self.start_session_with_prefix(
+            model_name, temperature, self.prefix_for(system_prompt, pdf_content), history=history
+        )
+
+    def generate(self, model_name, prompt, temperature=0.2):
+        """One-off completion outside any chat, e.g. to summarize old turns"""
+        return self.models.get(model_name, generation_config(temperature)).generate_content(prompt).text
+
+    def rebuild(self, session, model_name, temperature, prefix_messages=None):
+        """Carry a session's conversation over to another model, temperature or prefix
+
+        Returns the new session and what the move cost: how long it took, how much history was
+        carried, and whether the prefix came from a context cache, needed a new one, or will be
+        sent with the history.
+        """
+        created_before = self.prefix_cache.created
+        started = time.perf_counter()
+        new_session = session.continue_on(model_name, temperature, prefix_messages)
+        seconds = time.perf_counter() - started
+        if new_session.history_offset:
+            prefix = "sent with the history"
+        elif self.prefix_cache.created > created_before:
+            prefix = "uploaded to a new context cache"
+        else:
+            prefix = "reused from the context cache"
+        conversation = new_session.conversation()
+        return new_session, {
+            "seconds": seconds,
+            "turns": len(conversation),
+            "history_bytes": content_bytes(conversation),
+            "prefix_bytes": content_bytes(new_session.prefix_messages),
+            "prefix": prefix,
+        }
+
+    def stats(self):
+        return {
+            "backend": self.backend.name,
+            "warm_models": len(self.models),
+            "model_hits": self.models.hits,
+            "model_misses": self.models.misses,
+            "context_cache": self.prefix_cache.stats(),
+        }
+
+
+def make_backend(name=None):
+    name = name or os.environ.get("GRANTBUDDY_BACKEND", "gemini")
+    if name == "stub":
+        return StubBackend()
+    return GeminiBackend()
+
+
+engine = Engine(make_backend())
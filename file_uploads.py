@@ -0,0 +1,137 @@
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from engine import engine
+
+# Background, de-duplicated Gemini File API uploads.
+# Uploads are keyed by the SHA-256 of the file bytes: the first request starts the upload on
+# a worker thread, and every later rerun or session with the same file gets the same job
+# back. A finished upload is reused until it is close to expiring on Google's side, and a
+# failed one is kept until the user retries it. The page only polls the job's status, so the
+# user can keep typing while a large file uploads.
+
+UPLOAD_WORKERS = 4
+# How often to ask the File API whether an uploaded file has finished processing
+POLL_SECONDS = 2
+PROCESSING_TIMEOUT_SECONDS = 300
+# Upload again when the stored file expires within this many seconds
+EXPIRY_MARGIN_SECONDS = 3600
+
+
+def _state_name(file):
+    # The real File API returns an enum, the stub backend a plain string
+    return getattr(file.state, "name", file.state)
+
+
+class UploadJob:
+    """Progress of one file upload: uploading, processing, active or failed"""
+
+    def __init__(self, digest, size, display_name=None):
+        self.digest = digest
+        self.size = size
+        self.display_name = display_name
+        self.status = "uploading"
+        self.file = None
+        self.error = None
+        self.started = time.perf_counter()
+        self.finished = None
+        self._done = threading.Event()
+
+    def _finish(self, status, error=None):
+        self.status = status
+        self.error = error
+        self.finished = time.perf_counter()
+        self._done.set()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def usable(self, now=None, margin=EXPIRY_MARGIN_SECONDS):
+        """True while the uploaded file is active and not about to expire"""
+        if self.status != "active":
+            return False
+        expires = getattr(self.file, "expiration_time", None)
+        if expires is None:
+            return True
+        return expires.timestamp() - (now if now is not None else time.time()) > margin
+
+    def expired(self, now=None, margin=EXPIRY_MARGIN_SECONDS):
+        """True for an upload that finished but whose file is about to expire"""
+        return self.status == "active" and not self.usable(now, margin)
+
+
+class FileUploads:
+    """One upload per distinct file, run on a small thread pool and shared by every session"""
+
+    def __init__(self, backend, workers=UPLOAD_WORKERS, poll_seconds=POLL_SECONDS,
+                 processing_timeout=PROCESSING_TIMEOUT_SECONDS, sleep=time.sleep):
+        self.backend = backend
+        self.poll_seconds = poll_seconds
+        self.processing_timeout = processing_timeout
+        self.sleep = sleep
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="grantbuddy-upload")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.uploads = 0
+        self.reused = 0
+        self.bytes_uploaded = 0
+
+    def submit(self, data, mime_type="application/pdf", display_name=None, digest=None, retry=False):
+        """The upload job for data, started in the background unless one already exists
+
+        A failed upload is kept, so every rerun shows its error, until it is submitted again
+        with retry=True. Only an expiring upload is replaced without asking.
+        """
+        digest = digest or hashlib.sha256(data).hexdigest()
+        with self._lock:
+            job = self._jobs.get(digest)
+            if job is not None and not job.expired() and not (retry and job.status == "failed"):
+                self.reused += 1
+                return job
+            job = UploadJob(digest, len(data), display_name)
+            self._jobs[digest] = job
+            self.uploads += 1
+        self._pool.submit(self._run, job, data, mime_type)
+        return job
+
+    def _run(self, job, data, mime_type):
+        try:
+            file = self.backend.upload_file(data, mime_type, job.display_name)
+            with self._lock:
+                self.bytes_uploaded += len(data)
+            job.file = file
+            job.status = "processing"
+            deadline = time.perf_counter() + self.processing_timeout
+            while _state_name(file) == "PROCESSING":
+                if time.perf_counter() > deadline:
+                    raise TimeoutError(f"{file.name} was still processing after {self.processing_timeout}s")
+                self.sleep(self.poll_seconds)
+                file = self.backend.get_file(file.name)
+                job.file = file
+            if _state_name(file) != "ACTIVE":
+                raise RuntimeError(f"{file.name} could not be processed (state {_state_name(file)})")
+            job._finish("active")
+        except Exception as e:
+            job._finish("failed", e)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "files": len(self._jobs),
+                "uploads": self.uploads,
+                "reused": self.reused,
+                "bytes_uploaded": self.bytes_uploaded,
+            }
+
+
+file_uploads = FileUploads(engine.backend)
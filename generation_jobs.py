@@ -0,0 +1,244 @@
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from rate_limit import rate_limiter
+
+# Off-thread generation.
+# Replies are produced by a worker pool shared by every session, so a long model call never
+# holds a session's script thread. The script submits a job and gets a handle back, then only
+# redraws what the job has written so far. Any click (including "Stop generating") interrupts
+# that redraw loop straight away while the job carries on, or stops, in its worker. The pool
+# size is the server-wide limit on concurrent generations; jobs beyond it wait their turn,
+# and when too many are waiting new ones are refused instead of piling up.
+# A job that has to wait for a model's request slot (rate_limit.py) gives its worker back
+# while it waits: it returns job.after_slot(model, next_step) and the pool runs next_step
+# once the slot is free. A few requests queued for a slow model therefore never keep replies
+# for another model waiting for a worker.
+
+GENERATION_WORKERS = int(os.environ.get("GRANTBUDDY_GENERATION_WORKERS", 8))
+MAX_WAITING_JOBS = 64
+
+
+class GenerationCancelled(Exception):
+    """The user stopped the reply"""
+
+
+class PoolFullError(RuntimeError):
+    """Too many replies are already waiting for a worker"""
+
+
+class AfterSlot:
+    """What a job does next once its model has a free request slot, see GenerationJob.after_slot"""
+
+    def __init__(self, model, fn, args, on_wait=None):
+        self.model = model
+        self.fn = fn
+        self.args = args
+        self.on_wait = on_wait
+
+
+class GenerationJob:
+    """Handle on one reply being generated in the pool
+
+    It takes the place of the Streamlit placeholder for code running in the worker: markdown(),
+    info(), warning() and empty() record the latest output, and the script draws it on its next poll.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self):
+        self.id = next(self._ids)
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.notes = []
+        self.submitted = time.perf_counter()
+        self.started = None
+        # Seconds spent waiting for request slots, off the workers
+        self.slot_seconds = 0.0
+        self.finished = None
+        self.stop_event = threading.Event()
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._output = ("empty", None)
+        self.version = 0
+
+    def _show(self, kind, body=None):
+        with self._lock:
+            self._output = (kind, body)
+            self.version += 1
+
+    def markdown(self, body):
+        self._show("markdown", body)
+
+    def info(self, body):
+        self._show("info", body)
+
+    def warning(self, body):
+        self._show("warning", body)
+
+    def empty(self):
+        self._show("empty")
+
+    def output(self):
+        """(kind, body) of the latest output, for drawing into a real placeholder"""
+        with self._lock:
+            return self._output
+
+    def note(self, line):
+        """Debug line to hand to the session when the job is collected"""
+        self.notes.append(line)
+
+    def after_slot(self, model, fn, *args, on_wait=None):
+        """Return this from a job function to run fn(job, *args) once model has a free request slot
+
+        The slot is taken for fn, so fn sends its request without calling rate_limiter.acquire().
+        on_wait(position, seconds) is called while the job is in the model's queue.
+        """
+        return AfterSlot(model, fn, args, on_wait)
+
+    def cancel(self):
+        self.stop_event.set()
+
+    @property
+    def cancelled(self):
+        return self.stop_event.is_set()
+
+    def checkpoint(self):
+        """Raise GenerationCancelled if the user has stopped this job"""
+        if self.stop_event.is_set():
+            raise GenerationCancelled()
+
+    def sleep(self, seconds):
+        """time.sleep() that ends early, raising GenerationCancelled, when the job is stopped"""
+        if self.stop_event.wait(seconds):
+            raise GenerationCancelled()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    @property
+    def queued_for(self):
+        return (self.started or time.perf_counter()) - self.submitted
+
+    def _finish(self, status, result=None, error=None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished = time.perf_counter()
+        self._done.set()
+
+
+class GenerationPool:
+    """Fixed-size worker pool that runs generation jobs for every session in the process"""
+
+    def __init__(self, max_workers=GENERATION_WORKERS, max_waiting=MAX_WAITING_JOBS, limiter=None):
+        self.max_workers = max_workers
+        self.max_waiting = max_waiting
+        self.limiter = limiter or rate_limiter
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="grantbuddy-generate")
+        # Jobs waiting for a request slot only sleep in the rate limiter's queue, one thread each
+        self._slot_waiters = ThreadPoolExecutor(max_workers=max_waiting, thread_name_prefix="grantbuddy-slot")
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.waiting_for_slot = 0
+        self.running = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.failed = 0
+
+    def submit(self, fn, *args):
+        """Queue fn(job, *args) and return its GenerationJob; fn's return value becomes job.result"""
+        with self._lock:
+            waiting = self.waiting + self.waiting_for_slot
+            if waiting >= self.max_waiting:
+                raise PoolFullError(f"{waiting} replies are already waiting, try again shortly")
+            self.waiting += 1
+        job = GenerationJob()
+        self._executor.submit(self._run, job, fn, args)
+        return job
+
+    def _run(self, job, fn, args):
+        with self._lock:
+            self.waiting -= 1
+            self.running += 1
+        if job.started is None:
+            job.started = time.perf_counter()
+        job.status = "running"
+        try:
+            job.checkpoint()
+            result = fn(job, *args)
+        except GenerationCancelled as e:
+            outcome = ("cancelled", None, e)
+        except Exception as e:
+            outcome = ("failed", None, e)
+        else:
+            if isinstance(result, AfterSlot):
+                with self._lock:
+                    self.running -= 1
+                    self.waiting_for_slot += 1
+                job.status = "waiting for slot"
+                self._slot_waiters.submit(self._wait_for_slot, job, result)
+                return
+            outcome = ("done", result, None)
+        with self._lock:
+            self.running -= 1
+        self._end(job, outcome)
+
+    def _wait_for_slot(self, job, step):
+        def on_wait(position, seconds):
+            job.checkpoint()
+            if step.on_wait is not None:
+                step.on_wait(position, seconds)
+
+        waited = time.perf_counter()
+        try:
+            job.checkpoint()
+            self.limiter.acquire(step.model, on_wait=on_wait)
+        except GenerationCancelled as e:
+            outcome = ("cancelled", None, e)
+        except Exception as e:
+            outcome = ("failed", None, e)
+        else:
+            job.slot_seconds += time.perf_counter() - waited
+            with self._lock:
+                self.waiting_for_slot -= 1
+                self.waiting += 1
+            job.status = "queued"
+            self._executor.submit(self._run, job, step.fn, step.args)
+            return
+        with self._lock:
+            self.waiting_for_slot -= 1
+        self._end(job, outcome)
+
+    def _end(self, job, outcome):
+        with self._lock:
+            if outcome[0] == "done":
+                self.completed += 1
+            elif outcome[0] == "cancelled":
+                self.cancelled += 1
+            else:
+                self.failed += 1
+        job._finish(*outcome)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "running": self.running,
+                "waiting": self.waiting,
+                "waiting_for_slot": self.waiting_for_slot,
+                "completed": self.completed,
+                "cancelled": self.cancelled,
+                "failed": self.failed,
+            }
+
+
+generation_pool = GenerationPool()
@@ -0,0 +1,304 @@
+import hashlib
+import io
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from PyPDF2 import PdfReader
+
+from disk_cache import DiskLRU
+
+# PDF text extraction with a content-addressed cache.
+# Extracted text is keyed by the SHA-256 of the uploaded file bytes, so the same PDF is
+# only parsed once per process no matter how many reruns or sessions see it. Results are
+# kept in a small in-memory LRU and mirrored to disk so a restarted app can skip parsing too.
+# Large PDFs are split into page ranges that are extracted in parallel by worker processes,
+# each given the file once when it starts, and the pages finished so far can be used before
+# the whole document is done.
+
+CACHE_DIR = os.environ.get(
+    "GRANTBUDDY_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".grantbuddy_cache")
+)
+MEMORY_ENTRIES = 16
+DISK_ENTRIES = 64
+# Pages per worker task, and how many pages must be ready before a partial document is used
+SHARD_PAGES = 16
+PREVIEW_PAGES = 20
+INGEST_WORKERS = int(os.environ.get("GRANTBUDDY_INGEST_WORKERS", os.cpu_count() or 2))
+
+
+def file_digest(data):
+    """Content hash used as the cache key for an uploaded file"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def join_pages(pages):
+    """Join page texts in one pass instead of growing a string page by page"""
+    return "".join(f"{page}\n" for page in pages)
+
+
+def extract_page_range(pdf_reader, start, end):
+    """Extract the text of pages [start, end)"""
+    return start, [pdf_reader.pages[i].extract_text() for i in range(start, end)]
+
+
+# The document a worker process extracts pages from, parsed once when the worker starts
+_worker_reader = None
+
+
+def _open_worker_document(data):
+    global _worker_reader
+    _worker_reader = PdfReader(io.BytesIO(data))
+
+
+def _extract_worker_range(start, end):
+    return extract_page_range(_worker_reader, start, end)
+
+
+def extract_pdf_text(data):
+    """Parse PDF bytes and return the text of every page"""
+    pdf_reader = PdfReader(io.BytesIO(data))
+    return join_pages(page.extract_text() for page in pdf_reader.pages)
+
+
+class PdfTextCache:
+    """Bounded LRU of extracted PDF text, kept in memory and on disk"""
+
+    def __init__(self, directory=CACHE_DIR, memory_entries=MEMORY_ENTRIES, disk_entries=DISK_ENTRIES):
+        self.directory = os.path.join(directory, "pdf_text") if directory else None
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self._disk = DiskLRU(self.directory, disk_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _remember(self, digest, text):
+        # Caller holds the lock
+        self._entries[digest] = text
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.memory_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, digest):
+        """Return cached text for a digest, or None"""
+        with self._lock:
+            if digest in self._entries:
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return self._entries[digest]
+        text = self._disk.get(digest)
+        if text is not None:
+            with self._lock:
+                self.disk_hits += 1
+                self._remember(digest, text)
+        return text
+
+    def put(self, digest, text):
+        with self._lock:
+            self._remember(digest, text)
+        self._disk.put(digest, text)
+
+    def get_or_extract(self, data, digest=None, extract=extract_pdf_text):
+        """Return (digest, text), parsing the PDF only when it is not cached yet"""
+        digest = digest or file_digest(data)
+        text = self.get(digest)
+        if text is None:
+            self.count_miss()
+            text = extract(data)
+            self.put(digest, text)
+        return digest, text
+
+    def count_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
+
+
+pdf_text_cache = PdfTextCache()
+
+
+class IngestJob:
+    """Progress of one PDF extraction; pages become readable as their shard finishes"""
+
+    def __init__(self, digest, page_count):
+        self.digest = digest
+        self.page_count = page_count
+        self.pages = [None] * page_count
+        self.error = None
+        self.started = time.perf_counter()
+        self.finished = None
+        self._text = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    @classmethod
+    def from_text(cls, digest, text):
+        # A job for text that came out of the cache, it is complete straight away
+        job = cls(digest, 0)
+        job._text = text
+        job.finished = job.started
+        job._done.set()
+        return job
+
+    @classmethod
+    def from_error(cls, digest, error):
+        # A job for a file that could not be opened at all
+        job = cls(digest, 0)
+        job._finish(error)
+        return job
+
+    def _store(self, start, texts):
+        with self._lock:
+            self.pages[start:start + len(texts)] = texts
+
+    def _finish(self, error=None):
+        self.error = error
+        self.finished = time.perf_counter()
+        self._done.set()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def pages_done(self):
+        with self._lock:
+            if self._text is not None:
+                return self.page_count
+            return sum(page is not None for page in self.pages)
+
+    def _leading_pages(self):
+        # Caller holds the lock
+        if self._text is not None:
+            return self.page_count
+        for index, page in enumerate(self.pages):
+            if page is None:
+                return index
+        return self.page_count
+
+    @property
+    def available_pages(self):
+        """Number of leading pages that are extracted, i.e. usable in order"""
+        with self._lock:
+            return self._leading_pages()
+
+    def available_text(self):
+        """Text of the leading pages extracted so far"""
+        with self._lock:
+            if self._text is not None:
+                return self._text
+            return join_pages(self.pages[:self._leading_pages()])
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    @property
+    def text(self):
+        """Full document text once the job is done, otherwise None"""
+        if not self.done or self.error is not None:
+            return None
+        return self.available_text()
+
+    @property
+    def pages_per_second(self):
+        end = self.finished or time.perf_counter()
+        elapsed = max(end - self.started, 1e-9)
+        return self.pages_done / elapsed
+
+
+_pool_lock = threading.Lock()
+_jobs = {}
+# Worker processes running at once, over every job
+_worker_slots = threading.BoundedSemaphore(INGEST_WORKERS)
+
+
+def _process_context():
+    # Workers are never forked from the app server, which runs many threads
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def _take_worker_slots(wanted):
+    # Wait for one slot, then take as many more as are free right now
+    _worker_slots.acquire()
+    taken = 1
+    while taken < wanted and _worker_slots.acquire(blocking=False):
+        taken += 1
+    return taken
+
+
+def _run_job(job, data, cache):
+    try:
+        shards = [(start, min(start + SHARD_PAGES, job.page_count)) for start in range(0, job.page_count, SHARD_PAGES)]
+        if len(shards) == 1 or INGEST_WORKERS <= 1:
+            # Not worth shipping a small document to other processes
+            pdf_reader = PdfReader(io.BytesIO(data))
+            for start, end in shards:
+                job._store(*extract_page_range(pdf_reader, start, end))
+        else:
+            workers = _take_worker_slots(min(INGEST_WORKERS, len(shards)))
+            try:
+                # Each worker receives the file once, when it starts, and then only page ranges
+                with ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=_process_context(),
+                    initializer=_open_worker_document,
+                    initargs=(data,),
+                ) as pool:
+                    futures = [pool.submit(_extract_worker_range, start, end) for start, end in shards]
+                    for future in as_completed(futures):
+                        job._store(*future.result())
+            finally:
+                for _ in range(workers):
+                    _worker_slots.release()
+        text = job.available_text()
+        cache.put(job.digest, text)
+        with job._lock:
+            # The joined text replaces the pages, so the document is kept once
+            job._text = text
+            job.pages = []
+        job._finish()
+    except Exception as e:
+        job._finish(e)
+    finally:
+        with _pool_lock:
+            _jobs.pop(job.digest, None)
+
+
+def start_ingest(data, digest=None, cache=pdf_text_cache):
+    """Return an IngestJob for the PDF, starting background extraction if it is not cached"""
+    digest = digest or file_digest(data)
+    text = cache.get(digest)
+    if text is not None:
+        return IngestJob.from_text(digest, text)
+    with _pool_lock:
+        # Another session may already be extracting the same file
+        job = _jobs.get(digest)
+    if job is not None:
+        return job
+    # Parsed outside the lock, so a large or broken file doesn't hold up other sessions' uploads
+    page_count = len(PdfReader(io.BytesIO(data)).pages)
+    with _pool_lock:
+        job = _jobs.get(digest)
+        if job is not None:
+            return job
+        cache.count_miss()
+        job = IngestJob(digest, page_count)
+        _jobs[digest] = job
+    threading.Thread(target=_run_job, args=(job, data, cache), daemon=True).start()
+    return job
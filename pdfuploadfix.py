@@ -1,27 +1,47 @@
 #This should fix the problems uploading and using complicated .pdfs use it if the .pdf loading isn't work for you
 
 #IMPORTANT First remove this package from your imports 'from PyPDF2 import PdfReader' no longer needed
+# and add this one instead: 'from file_uploads import file_uploads'
 
 # find and replace 'Process uploaded PDF' code block with the following, keep indenting to match
 # This goes AFTER 'st.session_state.temperature = temperature' and BEFORE 'clear_button' 
 # File upload section
+# Each PDF is uploaded once per content hash on a background worker. Reruns get the same upload
+# back instead of sending the file again, and the chat stays usable while a large file uploads.
+@st.fragment(run_every=2)
+def show_upload_status(upload):
+    if upload.done:
+        # Rerun the whole app so the finished upload is picked up
+        st.rerun()
+    st.info(f"Uploading {upload.display_name} ({upload.status}, {upload.elapsed:.0f}s)...")
+
+
 if uploaded_pdf:
-    try:
-        # Upload file using File API with mime_type specified
-        uploaded_file = genai.upload_file(uploaded_pdf, mime_type="application/pdf")
-        st.session_state.uploaded_file = uploaded_file
+    upload = file_uploads.submit(uploaded_pdf.getvalue(), mime_type="application/pdf", display_name=uploaded_pdf.name)
+    if upload.status == "failed":
+        st.session_state.uploaded_file = None
+        st.error(f"Error uploading file: {upload.error}")
+        trace.event(f"File upload error: {upload.error}")
+        if st.button("Retry upload"):
+            file_uploads.submit(uploaded_pdf.getvalue(), mime_type="application/pdf", display_name=uploaded_pdf.name, retry=True)
+            st.rerun()
+    elif upload.done:
+        if st.session_state.get("uploaded_file") is not upload.file:
+            st.session_state.uploaded_file = upload.file
+            trace.event(f"File ready: {upload.file.name} ({file_uploads.stats()})")
         st.success("File uploaded successfully!")
-                  
-    except Exception as e:
-        st.error(f"Error uploading file: {e}")
-        st.session_state.debug.append(f"File upload error: {e}")
+    else:
+        # Until the upload is active, messages are sent without the file
+        st.session_state.uploaded_file = None
+        with st.sidebar:
+            show_upload_status(upload)
 
 
 #Find 'generate response with error handling' and replace with this keep indentions the same
 
         # Generate response with error handling
         try:
-            if st.session_state.uploaded_file:
+            if st.session_state.get("uploaded_file"):
                 # If there's an uploaded file, include it in the generation
                 response = st.session_state.chat_session.send_message([
                     st.session_state.uploaded_file,
@@ -34,8 +54,8 @@ if uploaded_pdf:
             full_response = response.text
             message_placeholder.markdown(full_response)
             st.session_state.messages.append({"role": "assistant", "content": full_response})
-            st.session_state.debug.append("Assistant response generated")
+            trace.event("Assistant response generated")
 
         except Exception as e:
             st.error(f"An error occurred while generating the response: {e}")
-            st.session_state.debug.append(f"Error: {e}")
\ No newline at end of file
+            trace.event(f"Error: {e}")
\ No newline at end of file
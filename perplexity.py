@@ -0,0 +1,258 @@
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from retrieval import normalize_text
+
+# Perplexity web search client.
+# One pooled requests.Session is shared by the whole process, so connections are kept alive
+# and reused instead of opened per search. Every call has connect and read timeouts, so a
+# slow search can't hang the Streamlit script. Transient failures get a couple of retries,
+# and answers are cached by normalized query so repeated lookups don't hit the API again.
+# A lookup that asks for several things is split into sub-queries that run concurrently,
+# and their answers are merged into one de-duplicated, size-limited context for the model.
+# With GRANTBUDDY_BACKEND=stub the client talks to StubSearchSession instead of the API, for
+# offline runs and benchmarks.
+
+API_URL = "https://api.perplexity.ai/chat/completions"
+SEARCH_MODEL = "llama-3.1-sonar-small-128k-online"
+# (connect, read) timeouts in seconds
+TIMEOUT = (5, 45)
+MAX_RETRIES = 2
+POOL_SIZE = 16
+CACHE_TTL_SECONDS = 3600
+CACHE_ENTRIES = 256
+# Fan-out limits for multi-part lookups
+MAX_QUERIES = 4
+MAX_CONCURRENT_SEARCHES = 4
+MAX_CONTEXT_CHARS = 12000
+# Parts shorter than this many words are read as details of the first part, e.g. "deadlines"
+MIN_STANDALONE_WORDS = 4
+
+
+def make_session(pool_size=POOL_SIZE, max_retries=MAX_RETRIES):
+    """A requests.Session with a connection pool and bounded retries on 429 and 5xx"""
+    retry = Retry(
+        total=max_retries,
+        connect=max_retries,
+        read=max_retries,
+        status=max_retries,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        # The search endpoint is a POST; it has no side effects, so retrying it is safe
+        allowed_methods=frozenset({"POST"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class SearchCache:
+    """TTL + LRU cache of search answers, shared by every session in the process"""
+
+    def __init__(self, ttl=CACHE_TTL_SECONDS, max_entries=CACHE_ENTRIES, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+class StubSearchResponse:
+    """The parts of a requests.Response that PerplexityClient uses"""
+
+    def __init__(self, status_code, payload=None):
+        self.status_code = status_code
+        self._payload = payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Client Error (injected by the stub)", response=self)
+
+    def json(self):
+        return self._payload
+
+
+class StubSearchSession:
+    """Offline stand-in for the search API: deterministic answers, optional latency and 429s
+
+    error_rate is the share of requests answered with a 429, drawn from a generator seeded with
+    seed so a benchmark run can be repeated. A 429 is retried up to max_retries times with the
+    same backoff as make_session's adapter, which the stub replaces.
+    """
+
+    def __init__(self, latency_seconds=0.0, error_rate=0.0, seed=0, max_retries=MAX_RETRIES, backoff_factor=0.5):
+        self.latency_seconds = latency_seconds
+        self.error_rate = error_rate
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.requests = 0
+        self.rate_limited = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def post(self, url, headers=None, json=None, timeout=None):
+        for attempt in range(self.max_retries + 1):
+            if attempt > 1:
+                # urllib3's backoff: none before the first retry, then doubling
+                time.sleep(self.backoff_factor * 2 ** (attempt - 2))
+            if self.latency_seconds:
+                time.sleep(self.latency_seconds)
+            with self._lock:
+                self.requests += 1
+                limited = self.error_rate > 0 and self._random.random() < self.error_rate
+                if limited:
+                    self.rate_limited += 1
+            if not limited:
+                break
+        if limited:
+            return StubSearchResponse(429)
+        query = json["messages"][-1]["content"]
+        digest = hashlib.sha256(query.encode("utf-8")).hexdigest()[:8]
+        answer = (
+            f"Stub search result {digest} for: {query}\n\n"
+            f"Three sources discuss this topic. See https://example.org/{digest} for details."
+        )
+        return StubSearchResponse(200, {"choices": [{"message": {"content": answer}}]})
+
+
+class PerplexityClient:
+    """Pooled, timed-out and cached access to the Perplexity search API"""
+
+    def __init__(self, session=None, cache=None, timeout=TIMEOUT, url=API_URL, model=SEARCH_MODEL):
+        self.session = session or make_session()
+        self.cache = cache or SearchCache()
+        self.timeout = timeout
+        self.url = url
+        self.model = model
+
+    def search(self, query, api_key):
+        """Return the search answer for query, from the cache when it was looked up recently"""
+        key = normalize_text(query)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        response = self.session.post(
+            self.url,
+            headers={
+                "accept": "application/json",
+                "content-type": "application/json",
+                "Authorization": f"Bearer {api_key}",
+            },
+            json={
+                "model": self.model,
+                "messages": [{"role": "user", "content": f"Search the web for: {query}"}],
+            },
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        answer = response.json()["choices"][0]["message"]["content"]
+        self.cache.put(key, answer)
+        return answer
+
+
+perplexity_client = PerplexityClient(
+    session=StubSearchSession() if os.environ.get("GRANTBUDDY_BACKEND") == "stub" else None
+)
+_search_pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_SEARCHES, thread_name_prefix="grantbuddy-search")
+
+
+def split_queries(request, max_queries=MAX_QUERIES):
+    """Break a multi-part lookup into separate search queries
+
+    "funders for girls' education in Kenya, deadlines, typical award sizes" becomes the topic
+    plus "<topic> deadlines" and "<topic> typical award sizes".
+    """
+    parts = [part.strip() for part in re.split(r"[;,\n]|\band also\b|\bplus\b", request) if part.strip()]
+    if len(parts) <= 1:
+        return [request.strip()]
+    topic = parts[0]
+    queries = [topic]
+    for part in parts[1:]:
+        part = re.sub(r"^(and|or)\s+", "", part)
+        query = part if len(part.split()) >= MIN_STANDALONE_WORDS else f"{topic} {part}"
+        if normalize_text(query) not in {normalize_text(q) for q in queries}:
+            queries.append(query)
+    return queries[:max_queries]
+
+
+def search_many(queries, api_key, client=None, pool=None):
+    """Run the queries concurrently; returns (query, answer, error) in the order given"""
+    client = client or perplexity_client
+    pool = pool or _search_pool
+    futures = [pool.submit(client.search, query, api_key) for query in queries]
+    results = []
+    for query, future in zip(queries, futures):
+        try:
+            results.append((query, future.result(), None))
+        except Exception as e:
+            results.append((query, None, e))
+    return results
+
+
+def merge_results(results, max_chars=MAX_CONTEXT_CHARS):
+    """One context from several answers: repeated paragraphs dropped, each answer trimmed to its share"""
+    answered = [(query, answer) for query, answer, error in results if answer]
+    if not answered:
+        return ""
+    share = max_chars // len(answered)
+    seen = set()
+    sections = []
+    for query, answer in answered:
+        paragraphs = []
+        for paragraph in re.split(r"\n\s*\n", answer):
+            key = re.sub(r"\W+", " ", paragraph.lower()).strip()
+            if key and key not in seen:
+                seen.add(key)
+                paragraphs.append(paragraph.strip())
+        if not paragraphs:
+            continue
+        text = "\n\n".join(paragraphs)
+        if len(text) > share:
+            text = text[:share].rsplit(" ", 1)[0] + " ..."
+        sections.append(f"### Results for: {query}\n{text}")
+    return "\n\n".join(sections)
@@ -0,0 +1,166 @@
+import random
+import threading
+import time
+from collections import deque
+
+from state_backend import shared_state
+
+# Client-side rate limiting for the Gemini models.
+# gemini-1.5-pro-002 allows 2 requests per minute and gemini-1.5-flash-002 allows 15.
+# Every request takes a token from a per-model bucket before it is sent, so the limits are
+# kept here instead of coming back as a 429. Requests from all sessions in the process wait
+# in one first-come-first-served queue per model, and can see their position and expected wait.
+# The buckets themselves are kept in the state backend (state_backend.py). With the SQLite
+# backend every app process draws from the same buckets, so the limits hold for the whole
+# deployment rather than for each process; the queues stay per process.
+
+# Requests per minute for each model
+MODEL_LIMITS = {
+    "gemini-1.5-pro-002": 2,
+    "gemini-1.5-flash-002": 15,
+}
+# Where to send a request when its model is saturated
+FALLBACK_MODELS = {
+    "gemini-1.5-pro-002": "gemini-1.5-flash-002",
+}
+# A burst of 1 keeps any 60 second window within the per-minute limit
+BURST = 1
+# How long to wait for pro before falling back to flash, in seconds
+FALLBACK_AFTER_SECONDS = 10
+POLL_SECONDS = 0.5
+# Random extra wait when the buckets are shared with other processes
+SHARED_JITTER_SECONDS = 0.05
+
+
+class _ModelQueue:
+    """The requests in this process waiting for a model's token bucket"""
+
+    def __init__(self, requests_per_minute):
+        self.rate = requests_per_minute / 60.0
+        self.waiting = deque()
+
+    def eta(self, position, tokens):
+        """Seconds until the request at this queue position can take a token"""
+        needed = position + 1 - tokens
+        return max(0.0, needed / self.rate)
+
+
+class ModelRateLimiter:
+    """Per-model token buckets in the state backend, with fair queueing across sessions
+
+    The clock is wall-clock time by default so that buckets shared between processes agree.
+    """
+
+    def __init__(self, limits=None, burst=BURST, clock=time.time, state=None):
+        self.limits = dict(MODEL_LIMITS if limits is None else limits)
+        self.burst = burst
+        self.clock = clock
+        self.state = state if state is not None else shared_state
+        self._queues = {}
+        self._cond = threading.Condition()
+
+    def _queue(self, model):
+        # Caller holds the lock
+        if model not in self._queues:
+            self._queues[model] = _ModelQueue(self.limits[model])
+        return self._queues[model]
+
+    def _refill(self, model, bucket, now):
+        # A bucket is [tokens, updated]; a new one starts full
+        if bucket is None:
+            return float(self.burst)
+        tokens, updated = bucket
+        return min(self.burst, tokens + max(0.0, now - updated) * self.limits[model] / 60.0)
+
+    def _tokens(self, model):
+        """Tokens in the model's bucket right now"""
+        return self._refill(model, self.state.get(f"rate:{model}"), self.clock())
+
+    def _take(self, model):
+        """Take a token from the model's bucket if there is one; returns whether it did and the tokens left"""
+        now = self.clock()
+
+        def take(bucket):
+            tokens = self._refill(model, bucket, now)
+            taken = tokens >= 1
+            if taken:
+                tokens -= 1
+            return [tokens, now], (taken, tokens)
+
+        return self.state.update(f"rate:{model}", take)
+
+    def queue_length(self, model):
+        if model not in self.limits:
+            return 0
+        with self._cond:
+            return len(self._queue(model).waiting)
+
+    def estimated_wait(self, model):
+        """Seconds a request joining the queue now would wait"""
+        if model not in self.limits:
+            return 0.0
+        with self._cond:
+            waiting = len(self._queue(model).waiting)
+        return self._queue(model).eta(waiting, self._tokens(model))
+
+    def choose_model(self, model, max_wait=FALLBACK_AFTER_SECONDS, fallbacks=FALLBACK_MODELS):
+        """Return the fallback model when the requested one would make us wait longer than max_wait"""
+        fallback = fallbacks.get(model)
+        if fallback is None:
+            return model
+        wait = self.estimated_wait(model)
+        if wait <= max_wait:
+            return model
+        return fallback if self.estimated_wait(fallback) < wait else model
+
+    def acquire(self, model, timeout=None, on_wait=None, poll=POLL_SECONDS):
+        """Block until a request to model may be sent; returns False if timeout runs out first
+
+        on_wait(position, seconds) is called while queued, position 1 being next in line.
+        """
+        if model not in self.limits:
+            return True
+        ticket = object()
+        with self._cond:
+            queue = self._queue(model)
+            queue.waiting.append(ticket)
+            deadline = None if timeout is None else self.clock() + timeout
+
+        try:
+            while True:
+                with self._cond:
+                    now = self.clock()
+                    position = queue.waiting.index(ticket)
+                    if position == 0:
+                        # Only the head of the queue draws from the bucket, other processes may too
+                        taken, tokens = self._take(model)
+                        if taken:
+                            queue.waiting.popleft()
+                            self._cond.notify_all()
+                            return True
+                    else:
+                        tokens = self._tokens(model)
+                    if deadline is not None and now >= deadline:
+                        queue.waiting.remove(ticket)
+                        self._cond.notify_all()
+                        return False
+                    wait = queue.eta(position, tokens)
+                if on_wait is not None:
+                    on_wait(position + 1, wait)
+                pause = min(max(wait, 0.01), poll)
+                if self.state.shared:
+                    # Other processes wake at the same moment for the same token; a little
+                    # jitter keeps one of them from winning every time
+                    pause += random.uniform(0, SHARED_JITTER_SECONDS)
+                with self._cond:
+                    self._cond.wait(pause)
+        except BaseException:
+            # A rerun or stop interrupts the wait, don't leave the ticket blocking the queue
+            with self._cond:
+                if ticket in queue.waiting:
+                    queue.waiting.remove(ticket)
+                    self._cond.notify_all()
+            raise
+
+
+rate_limiter = ModelRateLimiter()
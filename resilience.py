@@ -0,0 +1,218 @@
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Resilient model calls.
+# Calls go through three layers:
+#   - retries with exponential backoff and full jitter for errors worth retrying
+#     (429, 5xx, timeouts and dropped connections),
+#   - a circuit breaker per model that fails fast while a model keeps erroring,
+#   - optional hedging: if the first model is slow to answer, a second model is tried
+#     in parallel and whichever answers first is used.
+# Retry counts, hedges and the latency they add are counted for the debug panel.
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+RETRYABLE_NAMES = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+    "DeadlineExceeded", "GatewayTimeout", "BadGateway", "Timeout", "ReadTimeout", "ConnectTimeout",
+}
+# Start a hedged request when the first one hasn't answered after this many seconds
+HEDGE_AFTER_SECONDS = 8
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a model whose circuit breaker is open"""
+
+    def __init__(self, model, retry_in):
+        super().__init__(f"{model} is failing repeatedly, not calling it for another {retry_in:.0f}s")
+        self.model = model
+        self.retry_in = retry_in
+
+
+def is_retryable(error):
+    """True for rate limits, server errors, timeouts and connection problems"""
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    code = getattr(error, "code", None)
+    if isinstance(code, int) and code in RETRYABLE_STATUS:
+        return True
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(status, int) and status in RETRYABLE_STATUS:
+        return True
+    return any(cls.__name__ in RETRYABLE_NAMES for cls in type(error).__mro__)
+
+
+class RetryPolicy:
+    """How many times to try and how long to back off between tries"""
+
+    def __init__(self, max_attempts=4, base_delay=1.0, max_delay=20.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, rand=random.random):
+        # Full jitter: a random delay up to the exponential cap spreads retries from many sessions
+        return rand() * min(self.max_delay, self.base_delay * (2 ** attempt))
+
+
+class CircuitBreaker:
+    """Opens after repeated failures, then lets a single trial call through after a cool-down"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=5, reset_after=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def retry_in(self):
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_after - self.clock())
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN and self.clock() - self.opened_at >= self.reset_after:
+                self.state = self.HALF_OPEN
+                self._trial_running = False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_running = False
+
+    def release_trial(self):
+        """Let another trial call through, without counting this call as a success or a failure"""
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+            self._trial_running = False
+
+
+class ResilienceStats:
+    """Per-model counters for retries, failures, hedges and added latency"""
+
+    FIELDS = ("calls", "successes", "failures", "retries", "added_latency", "hedges", "hedge_wins")
+
+    def __init__(self):
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def add(self, model, **counts):
+        with self._lock:
+            entry = self._models.setdefault(model, dict.fromkeys(self.FIELDS, 0))
+            for name, value in counts.items():
+                entry[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {model: dict(entry) for model, entry in self._models.items()}
+
+
+class BreakerRegistry:
+    """One circuit breaker per model name"""
+
+    def __init__(self, **breaker_options):
+        self.breaker_options = breaker_options
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, model):
+        with self._lock:
+            if model not in self._breakers:
+                self._breakers[model] = CircuitBreaker(**self.breaker_options)
+            return self._breakers[model]
+
+    def is_open(self, model):
+        breaker = self.get(model)
+        return breaker.state == CircuitBreaker.OPEN and breaker.retry_in() > 0
+
+
+DEFAULT_POLICY = RetryPolicy()
+circuit_breakers = BreakerRegistry()
+resilience_stats = ResilienceStats()
+_hedge_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="grantbuddy-hedge")
+
+
+def call_with_retry(fn, model, policy=DEFAULT_POLICY, breakers=circuit_breakers, stats=resilience_stats,
+                    on_retry=None, sleep=time.sleep):
+    """Call fn(), retrying retryable errors with backoff; on_retry(attempt, delay, error) is called before each wait"""
+    breaker = breakers.get(model)
+    first_attempt = time.perf_counter()
+    stats.add(model, calls=1)
+    for attempt in range(policy.max_attempts):
+        if not breaker.allow():
+            stats.add(model, failures=1)
+            raise CircuitOpenError(model, breaker.retry_in())
+        attempt_started = time.perf_counter()
+        try:
+            result = fn()
+        except Exception as e:
+            retryable = is_retryable(e)
+            if retryable:
+                breaker.record_failure()
+            else:
+                # Bad requests and cancelled replies say nothing about the model's health
+                breaker.release_trial()
+            if not retryable or attempt == policy.max_attempts - 1:
+                stats.add(model, failures=1, added_latency=time.perf_counter() - first_attempt)
+                raise
+            delay = policy.delay(attempt)
+            stats.add(model, retries=1)
+            if on_retry is not None:
+                on_retry(attempt + 1, delay, e)
+            sleep(delay)
+            continue
+        breaker.record_success()
+        stats.add(model, successes=1, added_latency=attempt_started - first_attempt)
+        return result
+
+
+def hedged_call(primary, secondary, hedge_after=HEDGE_AFTER_SECONDS, stats=resilience_stats, model=None):
+    """Run primary(); if it is still running after hedge_after seconds, also run secondary().
+
+    Returns (index, result) of the first call to succeed, index 0 for primary and 1 for secondary.
+    The slower call is left to finish in the background and its result is dropped.
+    """
+    futures = [_hedge_pool.submit(primary)]
+    done, _ = wait(futures, timeout=hedge_after)
+    if not done:
+        futures.append(_hedge_pool.submit(secondary))
+        if model is not None:
+            stats.add(model, hedges=1)
+    pending = set(futures)
+    errors = {}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            index = futures.index(future)
+            if future.exception() is None:
+                if index == 1 and model is not None:
+                    stats.add(model, hedge_wins=1)
+                return index, future.result()
+            errors[index] = future.exception()
+    # Both failed; the primary's error is the more useful one to show
+    raise errors.get(0, errors.get(1))
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from disk_cache import DiskLRU
+from pdf_ingest import CACHE_DIR
+from retrieval import normalize_text
+
+# Opt-in cache of model replies.
+# Many turns are close to identical across users: the "Form Responses:" template from the
+# sidebar form, and the first onboarding turns that instructions.txt leads everyone through.
+# A reply is stored under everything that could change it: model, temperature, a hash of the
+# system prompt, the documents in use, the conversation so far and the new message. There are
+# two tiers. The exact key uses the text as typed; the normalized key ignores case, spacing
+# and trailing punctuation, so "What is a logframe?" and "what is a  logframe" share a reply.
+# Entries expire after a TTL, the in-memory copy is an LRU, and every entry is mirrored to disk
+# (one JSON file per key, least recently used dropped first) so a restart keeps the cache.
+
+TTL_SECONDS = 7 * 24 * 3600
+MEMORY_ENTRIES = 512
+DISK_ENTRIES = 4096
+
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(value, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _write_entry(file, entry):
+    json.dump(entry, file)
+
+
+class ResponseCache:
+    """Exact and normalized-match reply cache with TTL, kept in memory and on disk"""
+
+    def __init__(self, directory=CACHE_DIR, ttl=TTL_SECONDS, memory_entries=MEMORY_ENTRIES,
+                 disk_entries=DISK_ENTRIES, clock=time.time):
+        self.directory = os.path.join(directory, "responses") if directory else None
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self._disk = DiskLRU(self.directory, disk_entries, ".json", json.load, _write_entry)
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = {"exact": 0, "normalized": 0}
+        self.disk_hits = 0
+        self.misses = 0
+
+    def keys(self, model_name, temperature, system_prompt, documents, conversation, message):
+        """(exact key, normalized key) for a message sent after conversation, a list of (role, text)"""
+        fixed = [model_name, temperature, hashlib.sha256(system_prompt.encode("utf-8")).hexdigest(), documents]
+        exact = _digest(fixed + [list(conversation), message])
+        normalized = _digest(
+            fixed + [[(role, normalize_text(text)) for role, text in conversation], normalize_text(message)]
+        )
+        return exact, "n" + normalized
+
+    def _remember(self, key, entry):
+        # Caller holds the lock
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.memory_entries:
+            self._entries.popitem(last=False)
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        from_disk = entry is None
+        if from_disk:
+            entry = self._disk.get(key)
+        if entry is None or entry["expires"] <= self.clock():
+            return None
+        if from_disk:
+            with self._lock:
+                self.disk_hits += 1
+                self._remember(key, entry)
+        return entry["text"]
+
+    def get(self, keys):
+        """Return (text, tier) for the first tier that has a live entry, or None"""
+        for tier, key in zip(("exact", "normalized"), keys):
+            text = self._lookup(key)
+            if text is not None:
+                with self._lock:
+                    self.hits[tier] += 1
+                return text, tier
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, keys, text):
+        entry = {"text": text, "expires": self.clock() + self.ttl}
+        for key in keys:
+            with self._lock:
+                self._remember(key, entry)
+            self._disk.put(key, entry)
+
+    def stats(self):
+        with self._lock:
+            lookups = sum(self.hits.values()) + self.misses
+            return {
+                "entries": len(self._entries),
+                "exact_hits": self.hits["exact"],
+                "normalized_hits": self.hits["normalized"],
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(sum(self.hits.values()) / lookups, 3) if lookups else 0.0,
+            }
+
+
+response_cache = ResponseCache()
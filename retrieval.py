@@ -0,0 +1,189 @@
+import hashlib
+import heapq
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, scoring falls back to plain Python
+    np = None
+
+# Local retrieval over uploaded documents.
+# The text is split into overlapping chunks and indexed with BM25, and each question carries
+# only the few chunks that match it best. Everything here runs offline, no API calls are made.
+
+CHUNK_CHARS = 1200
+CHUNK_OVERLAP = 200
+TOP_K = 5
+# Each document in a workspace has its own index, so keep room for several per session
+INDEX_CACHE_ENTRIES = 32
+
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have how i in is it its of on or our that the "
+    "this to was we what when where which who will with you your can do does".split()
+)
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    """Lowercase word tokens without stopwords"""
+    return [word for word in _WORD.findall(text.lower()) if word not in STOPWORDS]
+
+
+def normalize_text(text):
+    """Lowercase, single spaces, no surrounding punctuation: the form queries and messages are matched in"""
+    return re.sub(r"\s+", " ", text.lower()).strip(" \t\n?!.,;:")
+
+
+class Chunk:
+    """A piece of the document and where it starts in the full text"""
+
+    def __init__(self, index, start, text):
+        self.index = index
+        self.start = start
+        self.text = text
+
+
+def split_into_chunks(text, chunk_chars=CHUNK_CHARS, overlap=CHUNK_OVERLAP):
+    """Split text into overlapping chunks, preferring to cut at paragraph or line breaks"""
+    chunks = []
+    start = 0
+    length = len(text)
+    while start < length:
+        end = min(start + chunk_chars, length)
+        if end < length:
+            # Cut at the last break in the second half of the window when there is one
+            cut = max(text.rfind("\n\n", start + chunk_chars // 2, end), text.rfind("\n", start + chunk_chars // 2, end))
+            if cut > start:
+                end = cut
+        piece = text[start:end].strip()
+        if piece:
+            chunks.append(Chunk(len(chunks), start, piece))
+        if end >= length:
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+
+class BM25Index:
+    """BM25 index over document chunks, with NumPy scoring when it is installed"""
+
+    def __init__(self, chunks, k1=1.5, b=0.75, use_numpy=True):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.use_numpy = use_numpy and np is not None
+        self.postings = {}
+
+        term_counts = [Counter(tokenize(chunk.text)) for chunk in chunks]
+        lengths = [sum(counts.values()) for counts in term_counts]
+        average_length = (sum(lengths) / len(lengths)) if lengths else 0.0
+        document_frequency = Counter()
+        for counts in term_counts:
+            document_frequency.update(counts.keys())
+
+        # Precompute the BM25 weight of every (term, chunk) pair so a query is just a sum
+        chunk_count = len(chunks)
+        postings = {}
+        for chunk_index, counts in enumerate(term_counts):
+            norm = k1 * (1 - b + b * lengths[chunk_index] / average_length) if average_length else k1
+            for term, tf in counts.items():
+                df = document_frequency[term]
+                idf = math.log(1 + (chunk_count - df + 0.5) / (df + 0.5))
+                postings.setdefault(term, []).append((chunk_index, idf * tf * (k1 + 1) / (tf + norm)))
+
+        if self.use_numpy:
+            for term, entries in postings.items():
+                ids, weights = zip(*entries)
+                self.postings[term] = (np.array(ids, dtype=np.int64), np.array(weights, dtype=np.float64))
+        else:
+            self.postings = {term: dict(entries) for term, entries in postings.items()}
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def scores(self, query):
+        """BM25 score of every chunk for the query"""
+        terms = set(tokenize(query))
+        if self.use_numpy:
+            scores = np.zeros(len(self.chunks))
+            for term in terms:
+                if term in self.postings:
+                    ids, weights = self.postings[term]
+                    scores[ids] += weights
+            return scores
+        scores = [0.0] * len(self.chunks)
+        for term in terms:
+            for chunk_index, weight in self.postings.get(term, {}).items():
+                scores[chunk_index] += weight
+        return scores
+
+    def search(self, query, k=TOP_K):
+        """Return up to k (score, chunk) pairs with a positive score, best first"""
+        if not self.chunks:
+            return []
+        scores = self.scores(query)
+        if self.use_numpy:
+            k = min(k, len(self.chunks))
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best])]
+            ranked = [(float(scores[i]), self.chunks[i]) for i in best]
+        else:
+            ranked = [(score, self.chunks[i]) for i, score in heapq.nlargest(k, enumerate(scores), key=lambda item: item[1])]
+        return [(score, chunk) for score, chunk in ranked if score > 0]
+
+
+def build_index(text, chunk_chars=CHUNK_CHARS, overlap=CHUNK_OVERLAP):
+    return BM25Index(split_into_chunks(text, chunk_chars, overlap))
+
+
+_index_cache = OrderedDict()
+_index_lock = threading.Lock()
+
+
+def get_index(text):
+    """Build the index for a document once per process and reuse it on later reruns"""
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    with _index_lock:
+        if key in _index_cache:
+            _index_cache.move_to_end(key)
+            return _index_cache[key]
+    index = build_index(text)
+    with _index_lock:
+        _index_cache[key] = index
+        while len(_index_cache) > INDEX_CACHE_ENTRIES:
+            _index_cache.popitem(last=False)
+    return index
+
+
+def search_documents(indexes, query, k=TOP_K):
+    """Search several documents' indexes; returns the best k (score, chunk, document name) overall"""
+    results = []
+    for name, index in indexes:
+        results.extend((score, chunk, name) for score, chunk in index.search(query, k))
+    return heapq.nlargest(k, results, key=lambda result: result[0])
+
+
+def compose_prompt(question, results):
+    """Put the retrieved excerpts, in document order, in front of the user's question
+
+    results are (score, chunk) pairs, or (score, chunk, document name) from search_documents.
+    """
+    if not results:
+        return question
+    excerpts = sorted(
+        ((result[2] if len(result) > 2 else None, result[1]) for result in results),
+        key=lambda excerpt: (excerpt[0] or "", excerpt[1].start),
+    )
+    context = "\n\n".join(
+        f"[{name}, excerpt {chunk.index + 1}]\n{chunk.text}" if name else f"[Excerpt {chunk.index + 1}]\n{chunk.text}"
+        for name, chunk in excerpts
+    )
+    source = "the uploaded PDF documents" if excerpts[0][0] else "the uploaded PDF document"
+    return (
+        f"Relevant excerpts from {source}. Use them when they help answer the message below:\n\n"
+        f"{context}\n\n"
+        f"Message: {question}"
+    )
@@ -0,0 +1,125 @@
+import json
+import os
+import sqlite3
+import threading
+
+from pdf_ingest import CACHE_DIR
+
+# Where state that several app processes must agree on is kept.
+# State that has to be the same in every replica, such as the rate-limit buckets, goes
+# through a small key-value backend:
+# - "memory" keeps it in this process. This is the default, for one replica.
+# - "sqlite" keeps it in one SQLite file that every process on the machine (or on a shared
+#   volume) opens.
+# Conversations and document text are shared through files under the cache directory
+# (conversation_store.py, pdf_ingest.py), so a session can resume on whichever process it
+# reaches. Set GRANTBUDDY_STATE_BACKEND=sqlite when running more than one process.
+
+STATE_BACKEND = os.environ.get("GRANTBUDDY_STATE_BACKEND", "memory")
+STATE_PATH = os.environ.get("GRANTBUDDY_STATE_PATH", os.path.join(CACHE_DIR, "state.sqlite"))
+
+
+class MemoryState:
+    """Key-value state for this process only"""
+
+    name = "memory"
+    shared = False
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._values.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def update(self, key, change, default=None):
+        """Atomically replace the value with change(value)[0] and return change(value)[1]"""
+        with self._lock:
+            value, result = change(self._values.get(key, default))
+            self._values[key] = value
+            return result
+
+    def stats(self):
+        with self._lock:
+            return {"backend": self.name, "keys": len(self._values)}
+
+
+class SQLiteState:
+    """Key-value state in a SQLite file shared by every process that opens it
+
+    Values are stored as JSON. update() holds the database write lock while it runs, so a
+    read-modify-write is atomic across processes, not just threads.
+    """
+
+    name = "sqlite"
+    shared = True
+
+    def __init__(self, path=STATE_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Transactions are opened explicitly; timeout is how long to wait for another process's lock
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._lock = threading.Lock()
+
+    def _read(self, key, default):
+        row = self._connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def _write(self, key, value):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, json.dumps(value))
+        )
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._read(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._write(key, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._connection.execute("DELETE FROM state WHERE key = ?", (key,))
+
+    def update(self, key, change, default=None):
+        """Atomically replace the value with change(value)[0] and return change(value)[1]"""
+        with self._lock:
+            # IMMEDIATE takes the write lock before reading, so no other process can interleave
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                value, result = change(self._read(key, default))
+                self._write(key, value)
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+            return result
+
+    def stats(self):
+        with self._lock:
+            (keys,) = self._connection.execute("SELECT COUNT(*) FROM state").fetchone()
+        return {"backend": self.name, "keys": keys, "path": self.path}
+
+
+def open_state(backend=STATE_BACKEND, path=STATE_PATH):
+    """The state backend named by GRANTBUDDY_STATE_BACKEND"""
+    if backend == "memory":
+        return MemoryState()
+    if backend == "sqlite":
+        return SQLiteState(path)
+    raise ValueError(f"Unknown state backend {backend!r}, expected 'memory' or 'sqlite'")
+
+
+shared_state = open_state()
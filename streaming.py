@@ -0,0 +1,132 @@
+import time
+
+from chat_render import escape_currency
+
+# Streaming helpers for Gemini chat sessions.
+# The reply is requested with stream=True and each chunk is written into the Streamlit
+# placeholder as soon as it arrives. If the stream breaks half way, the text received so
+# far is kept.
+
+STREAM_CURSOR = "▌"
+
+
+class StreamResult:
+    """Outcome of a streamed reply: the text, timings and any mid-stream error"""
+
+    def __init__(self, text, time_to_first_token, total_time, chunks, error=None, response=None):
+        self.text = text
+        self.time_to_first_token = time_to_first_token
+        self.total_time = total_time
+        self.chunks = chunks
+        self.error = error
+        # The model's response, for its usage metadata
+        self.response = response
+
+    @property
+    def partial(self):
+        # True when the stream failed after some text had already been received
+        return self.error is not None and bool(self.text)
+
+
+def _chunk_text(chunk):
+    # chunk.text raises when a chunk carries no text part (e.g. a safety-only chunk)
+    try:
+        return chunk.text
+    except Exception:
+        return ""
+
+
+def _keep_partial_turn(chat_session, content, partial_text):
+    # A broken stream leaves the chat session unable to build its history, so drop the
+    # broken request/response pair and put back the user turn with the partial answer.
+    # Only call this once send_message() has returned: rewind() after a failed send would
+    # remove the previous turn instead.
+    try:
+        chat_session.rewind()
+    except Exception:
+        pass
+    if not partial_text:
+        return
+    history = list(chat_session.history)
+    history.extend([
+        {"role": "user", "parts": [content]},
+        {"role": "model", "parts": [partial_text]},
+    ])
+    chat_session.history = history
+
+
+def stream_reply(chat_session, content, placeholder, cursor=STREAM_CURSOR, response=None, started=None, check=None):
+    """Send a message with stream=True and render the chunks into placeholder as they arrive
+
+    Pass response (and when it was requested, as started) to render a stream that was already opened.
+    check() is called after every chunk; an exception it raises ends the stream like a broken connection.
+    """
+    started = started or time.perf_counter()
+    first_token = None
+    parts = []
+    error = None
+
+    if response is None:
+        # A send that fails adds nothing to the history, so its error is simply raised
+        response = chat_session.send_message(content, stream=True)
+    try:
+        for chunk in response:
+            text = _chunk_text(chunk)
+            if not text:
+                continue
+            if first_token is None:
+                first_token = time.perf_counter() - started
+            parts.append(text)
+            placeholder.markdown(escape_currency("".join(parts)) + cursor)
+            if check is not None:
+                check()
+    except Exception as e:
+        _keep_partial_turn(chat_session, content, "".join(parts))
+        if not parts:
+            # Nothing was received, let the caller handle it like a normal failed call
+            raise
+        error = e
+
+    full_text = "".join(parts)
+    placeholder.markdown(escape_currency(full_text))
+    return StreamResult(
+        text=full_text,
+        time_to_first_token=first_token,
+        total_time=time.perf_counter() - started,
+        chunks=len(parts),
+        error=error,
+        response=response,
+    )
+
+
+def blocking_reply(chat_session, content, placeholder, response=None, started=None):
+    """Send a message the old way: wait for the whole answer, then render it in one go"""
+    started = started or time.perf_counter()
+    if response is None:
+        response = chat_session.send_message(content)
+    elapsed = time.perf_counter() - started
+    placeholder.markdown(escape_currency(response.text))
+    # Without streaming the first token only shows up together with the last one
+    return StreamResult(
+        text=response.text,
+        time_to_first_token=elapsed,
+        total_time=elapsed,
+        chunks=1,
+        response=response,
+    )
+
+
+def send_reply(chat_session, content, placeholder, stream=True, response=None, started=None, check=None):
+    """Send a message using streaming or blocking mode"""
+    if stream:
+        return stream_reply(chat_session, content, placeholder, response=response, started=started, check=check)
+    return blocking_reply(chat_session, content, placeholder, response=response, started=started)
+
+
+def describe_result(result):
+    """Short debug line with the timings of a reply"""
+    ttft = "n/a" if result.time_to_first_token is None else f"{result.time_to_first_token:.2f}s"
+    line = f"Time to first token: {ttft}, total: {result.total_time:.2f}s, chunks: {result.chunks}"
+    if result.error is not None:
+        line += f" (stream interrupted: {result.error})"
+    return line
@@ -0,0 +1,33 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The app modules live at the top of the repository, next to the Streamlit scripts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Set before any app module is imported, so the caches and saved conversations of a test run
+# don't end up in, or come from, the app's own cache directory
+os.environ["GRANTBUDDY_CACHE_DIR"] = tempfile.mkdtemp(prefix="grantbuddy-tests-")
+
+
+class Clock:
+    """A clock the test moves by hand"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def backend():
+    from engine import StubBackend
+
+    return StubBackend()
@@ -0,0 +1,117 @@
+from context_cache import PrefixCache, content_bytes, prefix_key
+from engine import Engine, build_prefix
+
+DOCUMENT = "Funder guidelines. " * 200
+
+
+def large_prefix(document=DOCUMENT):
+    return build_prefix("You are Grantbuddy.", document)
+
+
+def make_cache(backend, clock, **options):
+    options.setdefault("min_chars", 1000)
+    return PrefixCache(backend, ttl=3600, renew_margin=1800, clock=clock, **options)
+
+
+class FailingBackend:
+    def __init__(self):
+        self.attempts = 0
+
+    def create_cache(self, model_name, prefix_messages, ttl):
+        self.attempts += 1
+        raise RuntimeError("caching is not available for this model")
+
+
+def test_small_prefix_is_not_cached(backend, clock):
+    cache = make_cache(backend, clock)
+    assert cache.lookup("gemini-1.5-pro-002", build_prefix("You are Grantbuddy.")) is None
+    assert backend.caches == {}
+    assert cache.stats()["entries"] == 0
+
+
+def test_create_once_then_reuse(backend, clock):
+    cache = make_cache(backend, clock)
+    prefix = large_prefix()
+    handle = cache.lookup("gemini-1.5-pro-002", prefix)
+    assert handle in backend.caches
+    assert backend.bytes_sent == content_bytes(prefix)
+    assert cache.lookup("gemini-1.5-pro-002", prefix) == handle
+    stats = cache.stats()
+    assert (stats["created"], stats["reused"]) == (1, 1)
+    assert stats["prefix_bytes_saved"] == content_bytes(prefix)
+    # The key includes the model, so another model gets its own cache
+    assert cache.lookup("gemini-1.5-flash-002", prefix) != handle
+    assert cache.stats()["created"] == 2
+
+
+def test_use_renews_before_expiry(backend, clock):
+    cache = make_cache(backend, clock)
+    prefix = large_prefix()
+    handle = cache.lookup("gemini-1.5-pro-002", prefix)
+    clock.now = 1000
+    assert cache.lookup("gemini-1.5-pro-002", prefix) == handle
+    assert cache.stats()["renewed"] == 0
+    clock.now = 2000
+    assert cache.touch(prefix_key("gemini-1.5-pro-002", prefix), handle)
+    assert cache.stats()["renewed"] == 1
+    # Renewed at 2000, so still alive past the first TTL
+    clock.now = 5000
+    assert cache.touch(prefix_key("gemini-1.5-pro-002", prefix), handle)
+    assert cache.stats()["created"] == 1
+
+
+def test_expired_cache_is_replaced(backend, clock):
+    cache = make_cache(backend, clock)
+    prefix = large_prefix()
+    handle = cache.lookup("gemini-1.5-pro-002", prefix)
+    clock.now = 3600
+    assert not cache.touch(prefix_key("gemini-1.5-pro-002", prefix), handle)
+    assert handle not in backend.caches
+    new_handle = cache.lookup("gemini-1.5-pro-002", prefix)
+    assert new_handle != handle
+    stats = cache.stats()
+    assert (stats["created"], stats["evicted"]) == (2, 1)
+
+
+def test_least_recently_used_is_evicted(backend, clock):
+    cache = make_cache(backend, clock, max_entries=2)
+    prefixes = [large_prefix(f"Document {i}. " * 200) for i in range(3)]
+    handles = [cache.lookup("gemini-1.5-pro-002", prefix) for prefix in prefixes[:2]]
+    # Using the first one makes the second the least recently used
+    cache.lookup("gemini-1.5-pro-002", prefixes[0])
+    cache.lookup("gemini-1.5-pro-002", prefixes[2])
+    assert cache.stats()["evicted"] == 1
+    assert handles[0] in backend.caches
+    assert handles[1] not in backend.caches
+    assert not cache.touch(prefix_key("gemini-1.5-pro-002", prefixes[1]), handles[1])
+
+
+def test_failed_creation_is_not_retried_until_expiry(clock):
+    backend = FailingBackend()
+    cache = make_cache(backend, clock)
+    prefix = large_prefix()
+    assert cache.lookup("gemini-1.5-pro-002", prefix) is None
+    assert cache.lookup("gemini-1.5-pro-002", prefix) is None
+    assert backend.attempts == 1
+    clock.now = 3600
+    assert cache.lookup("gemini-1.5-pro-002", prefix) is None
+    assert backend.attempts == 2
+    assert cache.stats()["failures"] == 2
+
+
+def test_session_moves_to_new_cache_after_eviction(backend, clock):
+    engine = Engine(backend)
+    engine.prefix_cache = make_cache(backend, clock)
+    session = engine.start_session("gemini-1.5-pro-002", 0.7, "You are Grantbuddy.", DOCUMENT)
+    first_handle = session.cache_handle
+    assert first_handle is not None
+    assert session.history_offset == 0
+    session.send_message("What is the deadline?")
+    clock.now = 4000
+    session.send_message("And the budget?")
+    assert session.reopened == 1
+    assert session.cache_handle not in (None, first_handle)
+    assert [turn["parts"][0] for turn in session.conversation()[::2]] == ["What is the deadline?", "And the budget?"]
+    # The prefix went up once per cache and never with a message
+    assert engine.prefix_cache.stats()["created"] == 2
+    assert backend.bytes_sent - 2 * content_bytes(session.prefix_messages) < 1000
@@ -0,0 +1,58 @@
+import pytest
+
+from conversation_store import ConversationStore
+
+
+@pytest.fixture
+def store():
+    store = ConversationStore(path=None)
+    yield store
+    store.close()
+
+
+def conversation_of(store, count):
+    conversation_id = store.create({"model_name": "gemini-1.5-flash-002"})
+    for index in range(count):
+        store.append(conversation_id, {"role": "user" if index % 2 == 0 else "assistant", "content": f"message {index}"})
+    return conversation_id
+
+
+def contents(messages):
+    return [message["content"] for message in messages]
+
+
+def test_appends_are_numbered_in_order(store):
+    conversation_id = store.create()
+    assert store.append(conversation_id, {"role": "user", "content": "first"}) == 0
+    assert store.append(conversation_id, {"role": "assistant", "content": "second"}) == 1
+    assert store.info(conversation_id)["message_count"] == 2
+    assert contents(store.load(conversation_id)) == ["first", "second"]
+
+
+def test_resume_reads_only_the_latest_page(store):
+    conversation_id = conversation_of(store, 50)
+    assert contents(store.load(conversation_id, limit=20)) == [f"message {index}" for index in range(30, 50)]
+
+
+def test_earlier_pages_end_where_the_loaded_ones_begin(store):
+    conversation_id = conversation_of(store, 50)
+    assert contents(store.load(conversation_id, end=30, limit=20)) == [f"message {index}" for index in range(10, 30)]
+    # The last page back is shorter
+    assert contents(store.load(conversation_id, end=10, limit=20)) == [f"message {index}" for index in range(10)]
+    assert store.load(conversation_id, end=0, limit=20) == []
+
+
+def test_message_extras_and_settings_are_kept(store):
+    conversation_id = store.create({"model_name": "gemini-1.5-flash-002"})
+    store.append(conversation_id, {"role": "assistant", "content": "cached reply", "cached": "exact"},
+                 settings={"model_name": "gemini-1.5-pro-002"})
+    assert store.load(conversation_id) == [{"role": "assistant", "content": "cached reply", "cached": "exact"}]
+    assert store.info(conversation_id)["settings"] == {"model_name": "gemini-1.5-pro-002"}
+
+
+def test_conversations_are_kept_apart(store):
+    first = conversation_of(store, 3)
+    second = conversation_of(store, 2)
+    assert len(store.load(first)) == 3
+    assert len(store.load(second)) == 2
+    assert store.info("no-such-conversation") is None
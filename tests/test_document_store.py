@@ -0,0 +1,47 @@
+from document_store import DocumentStore
+
+
+def test_new_document_is_kept_when_the_store_is_full():
+    store = DocumentStore(max_bytes=100)
+    store.put("a", "x" * 80)
+    held = store.acquire("a")
+    ref = store.put("b", "y" * 50, acquire=True)
+    assert ref.text == "y" * 50
+    assert store.info("b") == {"bytes": 50, "references": 1}
+    assert store.info("a")["references"] == 1
+    held.release()
+    ref.release()
+
+
+def test_document_put_while_full_can_still_be_acquired():
+    store = DocumentStore(max_bytes=100)
+    store.put("a", "x" * 80)
+    held = store.acquire("a")
+    store.put("b", "y" * 50)
+    ref = store.acquire("b")
+    assert ref.text == "y" * 50
+    held.release()
+    ref.release()
+
+
+def test_unreferenced_documents_are_evicted_least_recent_first():
+    store = DocumentStore(max_bytes=100)
+    store.put("a", "x" * 40)
+    store.put("b", "y" * 40)
+    store.get("a")
+    ref = store.put("c", "z" * 40, acquire=True)
+    assert store.get("b") is None
+    assert store.get("a") == "x" * 40
+    assert store.stats()["evicted"] == 1
+    ref.release()
+
+
+def test_released_reference_lets_the_document_go():
+    store = DocumentStore(max_bytes=100)
+    first = store.put("a", "x" * 80, acquire=True)
+    second = store.put("b", "y" * 50, acquire=True)
+    assert store.stats()["bytes"] == 130
+    first.release()
+    assert store.get("a") is None
+    assert store.get("b") == "y" * 50
+    second.release()
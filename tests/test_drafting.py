@@ -0,0 +1,32 @@
+from drafting import DraftSection, ProposalDraft
+from generation_jobs import GenerationCancelled
+from streaming import StreamResult
+
+
+class FinishedJob:
+    def __init__(self, status, result=None, error=None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.done = True
+        self.started = self.finished = 0.0
+
+
+def test_stitch_keeps_section_order_and_marks_unfinished_sections():
+    draft = ProposalDraft([
+        DraftSection("Problem Statement", FinishedJob("done", StreamResult("Complete text.", 0.1, 1.0, 3))),
+        DraftSection("Budget Narrative", FinishedJob("done", StreamResult("Half a", 0.1, 1.0, 1, TimeoutError()))),
+        DraftSection("Impact Story", FinishedJob("done", StreamResult("Once", 0.1, 1.0, 1, GenerationCancelled()))),
+        DraftSection("Goals", FinishedJob("cancelled")),
+        DraftSection("Evaluation", FinishedJob("failed", error=RuntimeError("quota"))),
+    ])
+    document = draft.stitch()
+    sections = document.split("\n\n## ")[1:]
+    assert [section.split("\n")[0] for section in sections] == [
+        "Problem Statement", "Budget Narrative", "Impact Story", "Goals", "Evaluation",
+    ]
+    assert sections[0] == "Problem Statement\n\nComplete text."
+    assert "Half a\n\n_This section was interrupted." in sections[1]
+    assert "Once\n\n_You stopped this section." in sections[2]
+    assert "stopped before it was written" in sections[3]
+    assert "could not be drafted: quota" in sections[4]
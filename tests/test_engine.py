@@ -0,0 +1,91 @@
+from engine import Engine, ModelRegistry, build_prefix, generation_config
+
+PREFIX = build_prefix("You are Grantbuddy.")
+
+
+def test_registry_reuses_models(backend):
+    registry = ModelRegistry(backend)
+    model = registry.get("gemini-1.5-pro-002", generation_config(0.7))
+    assert registry.get("gemini-1.5-pro-002", generation_config(0.7)) is model
+    assert backend.models_created == 1
+    assert (registry.hits, registry.misses) == (1, 1)
+
+
+def test_registry_keys_on_model_config_and_cache(backend):
+    registry = ModelRegistry(backend)
+    model = registry.get("gemini-1.5-pro-002", generation_config(0.7))
+    assert registry.get("gemini-1.5-flash-002", generation_config(0.7)) is not model
+    assert registry.get("gemini-1.5-pro-002", generation_config(0.2)) is not model
+    assert registry.get("gemini-1.5-pro-002", generation_config(0.7), "cachedContents/a") is not model
+    assert backend.models_created == 4
+    assert len(registry) == 4
+
+
+def test_registry_drops_least_recently_used(backend):
+    registry = ModelRegistry(backend, max_models=2)
+    first = registry.get("gemini-1.5-pro-002", generation_config(0.1))
+    registry.get("gemini-1.5-pro-002", generation_config(0.2))
+    registry.get("gemini-1.5-pro-002", generation_config(0.1))
+    registry.get("gemini-1.5-pro-002", generation_config(0.3))
+    assert len(registry) == 2
+    assert registry.get("gemini-1.5-pro-002", generation_config(0.1)) is first
+    assert backend.models_created == 3
+
+
+def test_sessions_share_warm_models(backend):
+    engine = Engine(backend)
+    engine.start_session("gemini-1.5-pro-002", 0.7, "You are Grantbuddy.")
+    engine.start_session("gemini-1.5-pro-002", 0.7, "You are Grantbuddy.")
+    assert backend.models_created == 1
+    assert engine.stats()["model_hits"] == 1
+
+
+def test_session_sends_prefix_as_history_when_not_cached(backend):
+    engine = Engine(backend)
+    session = engine.start_session_with_prefix("gemini-1.5-pro-002", 0.7, PREFIX)
+    assert session.cache_handle is None
+    assert session.history_offset == len(PREFIX)
+    assert session.conversation() == []
+    session.send_message("Hello")
+    assert len(session.history) == len(PREFIX) + 2
+    assert session.conversation()[0] == {"role": "user", "parts": ["Hello"]}
+
+
+def test_continue_on_carries_the_conversation(backend):
+    engine = Engine(backend)
+    session = engine.start_session_with_prefix("gemini-1.5-pro-002", 0.7, PREFIX)
+    session.send_message("What is a logframe?")
+    session.send_message("Give an example.")
+    moved = session.continue_on("gemini-1.5-flash-002")
+    assert moved.model_name == "gemini-1.5-flash-002"
+    assert moved.temperature == 0.7
+    assert moved.prefix_messages is PREFIX
+    assert moved.conversation() == session.conversation()
+    assert list(moved.history)[:moved.history_offset] == PREFIX
+    # The new session answers on its own model and leaves the old one as it was
+    reply = moved.send_message("Shorter, please.")
+    assert reply.text.startswith("[gemini-1.5-flash-002 ")
+    assert len(moved.conversation()) == 6
+    assert len(session.conversation()) == 4
+
+
+def test_continue_on_with_new_temperature_and_prefix(backend):
+    engine = Engine(backend)
+    session = engine.start_session_with_prefix("gemini-1.5-pro-002", 0.7, PREFIX)
+    session.send_message("Hello")
+    other_prefix = build_prefix("You are a budget reviewer.")
+    moved = session.continue_on("gemini-1.5-pro-002", temperature=0.2, prefix_messages=other_prefix)
+    assert moved.temperature == 0.2
+    assert list(moved.history)[:moved.history_offset] == other_prefix
+    assert moved.conversation() == session.conversation()
+    assert engine.models.misses == 2
+
+
+def test_rebuild_reports_what_was_carried(backend):
+    engine = Engine(backend)
+    session = engine.start_session_with_prefix("gemini-1.5-pro-002", 0.7, PREFIX)
+    session.send_message("Hello")
+    moved, cost = engine.rebuild(session, "gemini-1.5-flash-002", 0.7)
+    assert moved.model_name == "gemini-1.5-flash-002"
+    assert cost["turns"] == 2
+    assert cost["prefix"] == "sent with the history"
@@ -0,0 +1,86 @@
+import threading
+import time
+
+from generation_jobs import GenerationPool
+from rate_limit import ModelRateLimiter
+from state_backend import MemoryState
+
+LIMITS = {"gemini-1.5-pro-002": 2, "gemini-1.5-flash-002": 15}
+
+
+def make_pool(max_workers=2):
+    return GenerationPool(max_workers=max_workers, limiter=ModelRateLimiter(LIMITS, state=MemoryState()))
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def reply(job, model, sent):
+    # A job that sends one request to model once it has a request slot
+    def send(job):
+        sent.append(model)
+        return model
+    return job.after_slot(model, send)
+
+
+def test_jobs_waiting_for_a_slot_leave_the_workers_free():
+    pool = make_pool()
+    sent = []
+    pro_jobs = [pool.submit(reply, "gemini-1.5-pro-002", sent) for _ in range(3)]
+    flash_job = pool.submit(reply, "gemini-1.5-flash-002", sent)
+    assert flash_job.wait(5)
+    assert flash_job.result == "gemini-1.5-flash-002"
+    # The first pro request had a slot straight away; the others are queued for the next ones
+    assert pro_jobs[0].wait(5)
+    assert sent.count("gemini-1.5-pro-002") == 1
+    wait_until(lambda: pool.stats()["waiting_for_slot"] == 2)
+    assert pool.stats()["running"] == 0
+    assert {job.status for job in pro_jobs[1:]} == {"waiting for slot"}
+    for job in pro_jobs[1:]:
+        job.cancel()
+        assert job.wait(5)
+        assert job.status == "cancelled"
+    assert pool.stats()["waiting_for_slot"] == 0
+
+
+def test_queue_position_is_reported_while_waiting():
+    pool = make_pool()
+    positions = []
+    seen = threading.Event()
+
+    def queued(job):
+        def send(job):
+            return "sent"
+
+        def on_wait(position, seconds):
+            positions.append((position, seconds))
+            seen.set()
+        return job.after_slot("gemini-1.5-pro-002", send, on_wait=on_wait)
+
+    first = pool.submit(queued)
+    assert first.wait(5)
+    second = pool.submit(queued)
+    assert seen.wait(5)
+    assert positions[0][0] == 1
+    assert 0 < positions[0][1] <= 30
+    second.cancel()
+    assert second.wait(5)
+
+
+def test_step_after_the_slot_runs_in_a_worker_and_its_error_fails_the_job():
+    pool = make_pool()
+
+    def broken(job):
+        def send(job):
+            raise ValueError("bad request")
+        return job.after_slot("gemini-1.5-flash-002", send)
+
+    job = pool.submit(broken)
+    assert job.wait(5)
+    assert job.status == "failed"
+    assert isinstance(job.error, ValueError)
+    assert pool.stats()["failed"] == 1
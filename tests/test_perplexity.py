@@ -0,0 +1,72 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from perplexity import merge_results, search_many, split_queries
+
+
+class FakeClient:
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+
+    def search(self, query, api_key):
+        if query in self.failing:
+            raise TimeoutError(f"no answer for {query}")
+        return f"Answer about {query}"
+
+
+def test_single_question_is_one_query():
+    assert split_queries("  grant writing tips for small NGOs ") == ["grant writing tips for small NGOs"]
+
+
+def test_short_parts_are_details_of_the_topic():
+    queries = split_queries("funders for girls' education in Kenya, deadlines, typical award sizes")
+    assert queries == [
+        "funders for girls' education in Kenya",
+        "funders for girls' education in Kenya deadlines",
+        "funders for girls' education in Kenya typical award sizes",
+    ]
+
+
+def test_long_parts_stand_alone_and_joining_words_are_dropped():
+    queries = split_queries("water grants in Ghana; and also climate adaptation funds for West Africa")
+    assert queries == ["water grants in Ghana", "climate adaptation funds for West Africa"]
+
+
+def test_repeated_parts_are_dropped_and_queries_capped():
+    assert split_queries("health grants, Deadlines, deadlines.") == ["health grants", "health grants Deadlines"]
+    assert len(split_queries("topic, a, b, c, d, e", max_queries=3)) == 3
+
+
+def test_search_many_keeps_order_and_reports_failures():
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        results = search_many(["one", "two", "three"], "key", client=FakeClient(failing={"two"}), pool=pool)
+    assert [query for query, _, _ in results] == ["one", "two", "three"]
+    assert results[0][1] == "Answer about one"
+    assert results[1][1] is None and isinstance(results[1][2], TimeoutError)
+
+
+def test_merge_drops_repeated_paragraphs_and_failed_queries():
+    shared = "Three sources discuss this topic."
+    results = [
+        ("deadlines", f"Deadlines are in March.\n\n{shared}", None),
+        ("award sizes", f"Awards range from $5,000 to $50,000.\n\n{shared.upper()}", None),
+        ("eligibility", None, TimeoutError()),
+    ]
+    merged = merge_results(results)
+    assert merged.count(shared) == 1
+    assert shared.upper() not in merged
+    assert "### Results for: deadlines" in merged
+    assert "### Results for: award sizes" in merged
+    assert "eligibility" not in merged
+
+
+def test_merge_trims_each_answer_to_its_share():
+    results = [("a", "word " * 500, None), ("b", "other " * 500, None)]
+    merged = merge_results(results, max_chars=400)
+    for section in merged.split("\n\n"):
+        body = section.split("\n", 1)[1]
+        assert len(body) <= 200 + len(" ...")
+        assert body.endswith(" ...")
+
+
+def test_merge_of_no_answers_is_empty():
+    assert merge_results([("a", None, TimeoutError())]) == ""
@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pytest
+
+from rate_limit import ModelRateLimiter
+from state_backend import MemoryState
+
+PRO = "gemini-1.5-pro-002"
+FLASH = "gemini-1.5-flash-002"
+LIMITS = {PRO: 2, FLASH: 15}
+
+
+def make_limiter(clock=time.time, limits=LIMITS):
+    return ModelRateLimiter(limits, clock=clock, state=MemoryState())
+
+
+def test_bucket_refills_at_the_model_rate(clock):
+    limiter = make_limiter(clock)
+    assert limiter.acquire(PRO, timeout=0)
+    assert not limiter.acquire(PRO, timeout=0)
+    # 2 requests per minute: the next token is there after 30 seconds
+    clock.now = 29
+    assert not limiter.acquire(PRO, timeout=0)
+    clock.now = 30
+    assert limiter.acquire(PRO, timeout=0)
+
+
+def test_buckets_are_per_model_and_unknown_models_are_not_limited(clock):
+    limiter = make_limiter(clock)
+    assert limiter.acquire(PRO, timeout=0)
+    assert limiter.acquire(FLASH, timeout=0)
+    assert limiter.acquire("some-other-model", timeout=0)
+    assert limiter.estimated_wait("some-other-model") == 0.0
+
+
+def test_estimated_wait_counts_down_to_the_next_token(clock):
+    limiter = make_limiter(clock)
+    assert limiter.estimated_wait(PRO) == 0.0
+    limiter.acquire(PRO, timeout=0)
+    assert limiter.estimated_wait(PRO) == 30.0
+    clock.now = 20
+    assert limiter.estimated_wait(PRO) == pytest.approx(10.0)
+
+
+def test_saturated_model_falls_back_when_the_fallback_is_sooner(clock):
+    limiter = make_limiter(clock)
+    assert limiter.choose_model(PRO, max_wait=10) == PRO
+    limiter.acquire(PRO, timeout=0)
+    assert limiter.choose_model(PRO, max_wait=10) == FLASH
+    # A wait within max_wait is worth it
+    assert limiter.choose_model(PRO, max_wait=30) == PRO
+    # Flash has no fallback of its own
+    limiter.acquire(FLASH, timeout=0)
+    assert limiter.choose_model(FLASH, max_wait=0) == FLASH
+
+
+def test_no_fallback_when_the_fallback_would_not_be_sooner(clock):
+    limiter = make_limiter(clock, limits={PRO: 2, FLASH: 1})
+    limiter.acquire(PRO, timeout=0)
+    limiter.acquire(FLASH, timeout=0)
+    assert limiter.choose_model(PRO, max_wait=10) == PRO
+
+
+def test_waiting_requests_are_served_first_come_first_served():
+    # 600 a minute is a token every 0.1 seconds
+    limiter = make_limiter(limits={FLASH: 600})
+    assert limiter.acquire(FLASH)
+    served = []
+    positions = {}
+
+    def request(name):
+        limiter.acquire(FLASH, timeout=5, on_wait=lambda position, wait: positions.setdefault(name, position))
+        served.append(name)
+
+    threads = []
+    for name in ("first", "second", "third"):
+        thread = threading.Thread(target=request, args=(name,))
+        thread.start()
+        threads.append(thread)
+        # Each joins the queue before the next one does
+        deadline = time.monotonic() + 2
+        while limiter.queue_length(FLASH) < len(threads):
+            assert time.monotonic() < deadline
+            time.sleep(0.001)
+    for thread in threads:
+        thread.join(5)
+    assert served == ["first", "second", "third"]
+    assert positions == {"first": 1, "second": 2, "third": 3}
@@ -0,0 +1,154 @@
+import threading
+
+import pytest
+
+from resilience import (
+    BreakerRegistry,
+    CircuitBreaker,
+    CircuitOpenError,
+    ResilienceStats,
+    RetryPolicy,
+    call_with_retry,
+    hedged_call,
+    is_retryable,
+)
+
+
+class TooManyRequests(Exception):
+    code = 429
+
+
+class Flaky:
+    """Fails with the given errors in turn, then returns "ok" """
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+def retry(fn, breakers=None, stats=None, **options):
+    return call_with_retry(
+        fn, "gemini-1.5-pro-002", policy=RetryPolicy(max_attempts=3, base_delay=0.01),
+        breakers=breakers or BreakerRegistry(), stats=stats or ResilienceStats(), sleep=lambda seconds: None,
+        **options
+    )
+
+
+def test_rate_limits_and_timeouts_are_retryable_bad_requests_are_not():
+    assert is_retryable(TooManyRequests())
+    assert is_retryable(TimeoutError())
+    assert not is_retryable(ValueError("bad request"))
+    assert not is_retryable(CircuitOpenError("gemini-1.5-pro-002", 10))
+
+
+def test_backoff_is_jittered_up_to_an_exponential_cap():
+    policy = RetryPolicy(base_delay=1.0, max_delay=5.0)
+    assert policy.delay(0, rand=lambda: 1.0) == 1.0
+    assert policy.delay(2, rand=lambda: 1.0) == 4.0
+    assert policy.delay(6, rand=lambda: 1.0) == 5.0
+    assert policy.delay(3, rand=lambda: 0.5) == 2.5
+
+
+def test_retryable_errors_are_retried_until_the_call_succeeds():
+    stats = ResilienceStats()
+    retries = []
+    fn = Flaky(TooManyRequests(), TimeoutError())
+    assert retry(fn, stats=stats, on_retry=lambda attempt, delay, error: retries.append(attempt)) == "ok"
+    assert fn.calls == 3
+    assert retries == [1, 2]
+    counts = stats.snapshot()["gemini-1.5-pro-002"]
+    assert (counts["calls"], counts["successes"], counts["retries"], counts["failures"]) == (1, 1, 2, 0)
+
+
+def test_other_errors_are_raised_without_a_retry():
+    fn = Flaky(ValueError("bad request"))
+    with pytest.raises(ValueError):
+        retry(fn)
+    assert fn.calls == 1
+
+
+def test_last_error_is_raised_when_attempts_run_out():
+    fn = Flaky(TooManyRequests(), TooManyRequests(), TimeoutError())
+    with pytest.raises(TimeoutError):
+        retry(fn)
+    assert fn.calls == 3
+
+
+def test_breaker_opens_after_repeated_failures_and_lets_one_trial_through(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_after=30, clock=clock)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert breaker.retry_in() == 30
+    clock.now = 30
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # Only one trial call at a time while half-open
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_failed_trial_opens_the_breaker_again(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_after=30, clock=clock)
+    breaker.record_failure()
+    clock.now = 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.retry_in() == 30
+
+
+def test_open_breaker_fails_fast_without_calling(clock):
+    breakers = BreakerRegistry(failure_threshold=2, reset_after=30, clock=clock)
+    failing = Flaky(TooManyRequests(), TooManyRequests(), TooManyRequests())
+    # The breaker opens during the retries, so the third attempt is never made
+    with pytest.raises(CircuitOpenError):
+        retry(failing, breakers=breakers)
+    assert failing.calls == 2
+    assert breakers.is_open("gemini-1.5-pro-002")
+    fn = Flaky()
+    with pytest.raises(CircuitOpenError):
+        retry(fn, breakers=breakers)
+    assert fn.calls == 0
+
+
+def test_hedge_is_not_sent_when_the_first_call_is_quick():
+    stats = ResilienceStats()
+    secondary = Flaky()
+    assert hedged_call(lambda: "first", secondary, hedge_after=5, stats=stats, model="pro") == (0, "first")
+    assert secondary.calls == 0
+    assert stats.snapshot() == {}
+
+
+def test_hedge_wins_when_the_first_call_is_slow():
+    stats = ResilienceStats()
+    release = threading.Event()
+
+    def slow():
+        release.wait(5)
+        return "slow"
+
+    try:
+        assert hedged_call(slow, lambda: "hedge", hedge_after=0.01, stats=stats, model="pro") == (1, "hedge")
+    finally:
+        release.set()
+    counts = stats.snapshot()["pro"]
+    assert (counts["hedges"], counts["hedge_wins"]) == (1, 1)
+
+
+def test_hedge_raises_the_first_calls_error_when_both_fail():
+    def slow_failure():
+        threading.Event().wait(0.05)
+        raise TooManyRequests("primary")
+
+    with pytest.raises(TooManyRequests, match="primary"):
+        hedged_call(slow_failure, Flaky(ValueError("secondary")), hedge_after=0.01)
@@ -0,0 +1,64 @@
+from response_cache import ResponseCache
+
+CONVERSATION = [("user", "Hello"), ("assistant", "Hi, how can I help?")]
+
+
+def make_cache(clock, directory=None, **options):
+    return ResponseCache(directory=directory, ttl=60, clock=clock, **options)
+
+
+def keys(cache, message, conversation=CONVERSATION, model_name="gemini-1.5-flash-002", documents=None):
+    return cache.keys(model_name, 0.5, "You are Grantbuddy.", documents or [False, ()], conversation, message)
+
+
+def test_exact_match_is_served_from_the_exact_tier(clock):
+    cache = make_cache(clock)
+    cache.put(keys(cache, "What is a logframe?"), "A planning matrix.")
+    assert cache.get(keys(cache, "What is a logframe?")) == ("A planning matrix.", "exact")
+
+
+def test_case_spacing_and_punctuation_fall_back_to_the_normalized_tier(clock):
+    cache = make_cache(clock)
+    cache.put(keys(cache, "What is a logframe?"), "A planning matrix.")
+    conversation = [("user", "hello"), ("assistant", "Hi, how can I  help")]
+    assert cache.get(keys(cache, "what is a  logframe", conversation)) == ("A planning matrix.", "normalized")
+    stats = cache.stats()
+    assert (stats["exact_hits"], stats["normalized_hits"], stats["misses"]) == (0, 1, 0)
+
+
+def test_anything_that_changes_the_reply_changes_the_key(clock):
+    cache = make_cache(clock)
+    cache.put(keys(cache, "What is a logframe?"), "A planning matrix.")
+    assert cache.get(keys(cache, "What is a logframe?", model_name="gemini-1.5-pro-002")) is None
+    assert cache.get(keys(cache, "What is a logframe?", conversation=[])) is None
+    assert cache.get(keys(cache, "What is a logframe?", documents=[True, ("abc",)])) is None
+    assert cache.stats()["misses"] == 3
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = make_cache(clock)
+    cache.put(keys(cache, "What is a logframe?"), "A planning matrix.")
+    clock.now = 59
+    assert cache.get(keys(cache, "What is a logframe?")) is not None
+    clock.now = 60
+    assert cache.get(keys(cache, "What is a logframe?")) is None
+
+
+def test_memory_copy_is_least_recently_used(clock):
+    cache = make_cache(clock, memory_entries=4)
+    for message in ("one", "two", "three"):
+        cache.put(keys(cache, message), message.upper())
+    # Each put stores two keys, so only the last two messages fit
+    assert cache.stats()["entries"] == 4
+    assert cache.get(keys(cache, "one")) is None
+    assert cache.get(keys(cache, "three")) == ("THREE", "exact")
+
+
+def test_disk_copy_survives_a_restart_and_keeps_its_expiry(clock, tmp_path):
+    cache = make_cache(clock, directory=str(tmp_path))
+    cache.put(keys(cache, "What is a logframe?"), "A planning matrix.")
+    restarted = make_cache(clock, directory=str(tmp_path))
+    assert restarted.get(keys(restarted, "What is a logframe?")) == ("A planning matrix.", "exact")
+    assert restarted.stats()["disk_hits"] == 1
+    clock.now = 60
+    assert make_cache(clock, directory=str(tmp_path)).get(keys(cache, "What is a logframe?")) is None
@@ -0,0 +1,99 @@
+import pytest
+
+import retrieval
+from retrieval import build_index, search_documents, split_into_chunks, tokenize
+
+GRANT_TEXT = "\n\n".join([
+    "The applicant organisation runs literacy programmes in rural schools.",
+    "Budget: the total request is 45,000 dollars over two years, mostly staff salaries.",
+    "Evaluation will use a logframe with baseline and endline reading assessments.",
+    "The deadline for full proposals is the 30th of June.",
+    "Staff include two trainers, one coordinator and a part-time accountant.",
+])
+
+
+def test_tokenize_drops_stopwords_and_case():
+    assert tokenize("What is the Budget for 2025?") == ["budget", "2025"]
+
+
+def test_chunks_cover_the_text_in_order():
+    text = "\n".join(f"Line {i} about the project activities and outcomes." for i in range(200))
+    chunks = split_into_chunks(text, chunk_chars=400, overlap=50)
+    assert len(chunks) > 1
+    assert [chunk.index for chunk in chunks] == list(range(len(chunks)))
+    for chunk in chunks:
+        assert len(chunk.text) <= 400
+        assert text[chunk.start:].lstrip().startswith(chunk.text)
+    starts = [chunk.start for chunk in chunks]
+    assert starts == sorted(starts)
+    assert chunks[0].start == 0
+    assert text.rstrip().endswith(chunks[-1].text)
+
+
+def test_chunks_overlap_and_cut_at_line_breaks():
+    text = "\n".join(f"Line {i:03d} of the narrative section." for i in range(100))
+    chunks = split_into_chunks(text, chunk_chars=300, overlap=60)
+    for previous, chunk in zip(chunks, chunks[1:]):
+        previous_end = previous.start + len(previous.text)
+        assert chunk.start < previous_end
+        assert previous.text.endswith(".")
+
+
+def test_chunks_of_empty_text():
+    assert split_into_chunks("") == []
+    assert split_into_chunks(" \n\n ") == []
+    assert len(build_index("")) == 0
+    assert build_index("").search("budget") == []
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_bm25_ranks_matching_chunk_first(use_numpy):
+    if use_numpy and retrieval.np is None:
+        pytest.skip("NumPy is not installed")
+    index = retrieval.BM25Index(split_into_chunks(GRANT_TEXT, chunk_chars=100, overlap=0), use_numpy=use_numpy)
+    results = index.search("When is the deadline?", k=3)
+    assert results[0][1].text.startswith("The deadline")
+    # Only chunks that contain a query term are returned
+    assert len(results) == 1
+    results = index.search("staff budget", k=5)
+    assert {chunk.text[:6] for _, chunk in results} == {"Budget", "Staff "}
+    assert [score for score, _ in results] == sorted((score for score, _ in results), reverse=True)
+    assert index.search("unrelated words entirely") == []
+
+
+def test_bm25_numpy_and_python_scores_agree():
+    if retrieval.np is None:
+        pytest.skip("NumPy is not installed")
+    chunks = split_into_chunks(GRANT_TEXT * 3, chunk_chars=120, overlap=20)
+    fast = retrieval.BM25Index(chunks, use_numpy=True)
+    plain = retrieval.BM25Index(chunks, use_numpy=False)
+    for query in ("budget staff salaries", "reading assessments logframe", "rural schools"):
+        assert list(fast.scores(query)) == pytest.approx(plain.scores(query))
+        # Repeated text gives tied chunks, which the two paths may return in either order
+        assert [score for score, _ in fast.search(query)] == pytest.approx([score for score, _ in plain.search(query)])
+
+
+def test_bm25_rare_term_outweighs_common_one():
+    chunks = split_into_chunks(
+        "\n\n".join(["project outcomes"] * 8 + ["project endline survey"]), chunk_chars=30, overlap=0
+    )
+    index = retrieval.BM25Index(chunks)
+    scores = list(index.scores("endline"))
+    assert scores.index(max(scores)) == len(chunks) - 1
+    assert index.search("project endline", k=1)[0][1].text == "project endline survey"
+
+
+def test_search_documents_merges_documents():
+    indexes = [
+        ("rfp.pdf", build_index(GRANT_TEXT)),
+        ("budget.pdf", build_index("Budget template.\n\nSalaries, travel and equipment budget lines.")),
+    ]
+    results = search_documents(indexes, "budget salaries", k=2)
+    assert len(results) == 2
+    assert results[0][0] >= results[1][0]
+    assert {name for _, _, name in results} <= {"rfp.pdf", "budget.pdf"}
+    assert search_documents(indexes, "nothing matches zzz") == []
+
+
+def test_get_index_is_reused():
+    assert retrieval.get_index(GRANT_TEXT) is retrieval.get_index(GRANT_TEXT)
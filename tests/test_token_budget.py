@@ -0,0 +1,94 @@
+from engine import Engine, build_prefix
+from token_budget import (
+    SUMMARY_ACK,
+    SUMMARY_INTRO,
+    ContextBudget,
+    TokenCounter,
+    estimate_tokens,
+    is_summary,
+    message_text,
+)
+
+
+def chat_with_turns(backend, turns):
+    session = Engine(backend).start_session_with_prefix(
+        "gemini-1.5-pro-002", 0.7, build_prefix("You are Grantbuddy.")
+    )
+    for i in range(turns):
+        session.send_message(f"Question {i}")
+    return session
+
+
+class Summarizer:
+    def __init__(self):
+        self.prompts = []
+
+    def __call__(self, prompt):
+        self.prompts.append(prompt)
+        return f"summary {len(self.prompts)}"
+
+
+def test_estimate_tokens_rounds_up():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcd") == 1
+    assert estimate_tokens("abcde") == 2
+
+
+def test_counter_learns_ratio_from_replies():
+    counter = TokenCounter()
+    assert counter.count("gemini-1.5-pro-002", "x" * 40) == 10
+    counter.observe("gemini-1.5-pro-002", "x" * 40, 20)
+    assert counter.count("gemini-1.5-pro-002", "x" * 40) > 10
+    assert counter.count("gemini-1.5-flash-002", "x" * 40) == 10
+
+
+def test_compact_summarizes_all_but_recent_turns(backend):
+    session = chat_with_turns(backend, 5)
+    prefix = list(session.history)[:session.history_offset]
+    recent = session.conversation()[-4:]
+    summarize = Summarizer()
+    assert ContextBudget(TokenCounter(), keep_recent=4).compact(session, summarize) == 6
+    conversation = session.conversation()
+    assert list(session.history)[:session.history_offset] == prefix
+    assert is_summary(conversation[0])
+    assert message_text(conversation[0]) == f"{SUMMARY_INTRO}\n\nsummary 1"
+    assert message_text(conversation[1]) == SUMMARY_ACK
+    assert conversation[2:] == recent
+    assert "Question 0" in summarize.prompts[0]
+    assert "Question 2" in summarize.prompts[0]
+    assert "Question 3" not in summarize.prompts[0]
+
+
+def test_compact_folds_previous_summary(backend):
+    session = chat_with_turns(backend, 5)
+    budget = ContextBudget(TokenCounter(), keep_recent=4)
+    summarize = Summarizer()
+    budget.compact(session, summarize)
+    for i in range(5, 8):
+        session.send_message(f"Question {i}")
+    assert budget.compact(session, summarize) == 6
+    assert "Summary so far:\nsummary 1" in summarize.prompts[1]
+    conversation = session.conversation()
+    assert sum(is_summary(message) for message in conversation) == 1
+    assert message_text(conversation[0]).endswith("summary 2")
+    assert [message_text(message) for message in conversation[2::2]] == ["Question 6", "Question 7"]
+
+
+def test_compact_leaves_short_chats_alone(backend):
+    session = chat_with_turns(backend, 3)
+    before = list(session.history)
+    summarize = Summarizer()
+    assert ContextBudget(TokenCounter(), keep_recent=6).compact(session, summarize) == 0
+    assert list(session.history) == before
+    assert summarize.prompts == []
+
+
+def test_over_budget_counts_prefix_conversation_and_next_message(backend):
+    session = chat_with_turns(backend, 2)
+    counter = TokenCounter()
+    usage = ContextBudget(counter).usage(session)
+    assert usage["total"] == usage["prefix"] + usage["conversation"]
+    assert usage["conversation"] > 0
+    budget = ContextBudget(counter, budget_tokens=usage["total"] + 2)
+    assert not budget.over_budget(session, "abcd")
+    assert budget.over_budget(session, "x" * 40)
@@ -0,0 +1,77 @@
+from benchmarks.bench_suite import synthetic_pdf
+from document_store import DocumentStore
+from pdf_ingest import file_digest, pdf_text_cache
+from workspace import Workspace
+
+
+def ingested(workspace, files):
+    added = workspace.sync(files)
+    for document in added:
+        assert document.job.wait(30)
+    workspace.refresh()
+    return added
+
+
+def test_sync_ingests_new_files_into_the_store():
+    store = DocumentStore()
+    workspace = Workspace(store)
+    added = ingested(workspace, [("rfp.pdf", synthetic_pdf(2, seed=101)), ("budget.pdf", synthetic_pdf(3, seed=102))])
+    assert [document.name for document in added] == ["rfp.pdf", "budget.pdf"]
+    assert all(document.ready for document in added)
+    assert [name for name, _ in workspace.sources()] == ["rfp.pdf", "budget.pdf"]
+    assert "### Document: budget.pdf" in workspace.combined_text()
+    assert store.info(added[0].digest)["references"] == 1
+    # Nothing new on the next rerun
+    assert workspace.sync([("rfp.pdf", synthetic_pdf(2, seed=101)), ("budget.pdf", synthetic_pdf(3, seed=102))]) == []
+
+
+def test_identical_files_are_kept_once():
+    workspace = Workspace(DocumentStore())
+    data = synthetic_pdf(2, seed=103)
+    added = ingested(workspace, [("report.pdf", data), ("report copy.pdf", data)])
+    assert len(added) == 1
+    assert len(workspace.documents) == 1
+
+
+def test_removed_files_are_dropped_and_released():
+    store = DocumentStore()
+    workspace = Workspace(store)
+    kept, removed = synthetic_pdf(2, seed=104), synthetic_pdf(2, seed=105)
+    ingested(workspace, [("kept.pdf", kept), ("removed.pdf", removed)])
+    workspace.sync([("kept.pdf", kept)])
+    assert [document.name for document in workspace.documents.values()] == ["kept.pdf"]
+    assert store.info(file_digest(removed))["references"] == 0
+
+
+def test_unreadable_file_is_listed_as_failed_once():
+    workspace = Workspace(DocumentStore())
+    added = workspace.sync([("notes.pdf", b"not a pdf")])
+    assert workspace.failed() == added
+    assert workspace.sync([("notes.pdf", b"not a pdf")]) == []
+    assert workspace.enabled() == []
+
+
+def test_disabled_documents_leave_the_key():
+    workspace = Workspace(DocumentStore())
+    first, second = ingested(workspace, [("a.pdf", synthetic_pdf(2, seed=106)), ("b.pdf", synthetic_pdf(2, seed=107))])
+    key = workspace.key()
+    second.enabled = False
+    assert workspace.key() == key[:1]
+    assert [name for name, _ in workspace.sources()] == ["a.pdf"]
+
+
+def test_restore_puts_back_cached_documents_until_cleared():
+    store = DocumentStore()
+    pdf_text_cache.put("cached-digest", "Organisation profile text")
+    workspace = Workspace(store)
+    restored = workspace.restore([["profile.pdf", "cached-digest", False], ["gone.pdf", "missing-digest", True]])
+    assert [document.name for document in restored] == ["profile.pdf"]
+    document = restored[0]
+    assert document.ready and not document.enabled and not document.uploaded
+    assert document.text == "Organisation profile text"
+    assert workspace.saved() == [["profile.pdf", "cached-digest", False]]
+    # The uploader doesn't list restored documents, so syncing with it doesn't drop them
+    workspace.sync([])
+    assert list(workspace.documents) == ["cached-digest"]
+    workspace.clear()
+    assert store.info("cached-digest")["references"] == 0
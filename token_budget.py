@@ -0,0 +1,140 @@
+import threading
+
+# Context budget for long chats.
+# Every turn is counted in tokens and the conversation is kept under a budget: when it would
+# go over, the older turns are replaced by a running summary generated by a fast model. The
+# most recent turns are always kept word for word.
+# The check before a message is sent uses a local estimate, since asking the model's token
+# counter would add a round trip to every message. The tokens a request actually used come
+# back with its response and are what the sidebar shows; they also tune the estimate.
+
+CHARS_PER_TOKEN = 4
+DEFAULT_BUDGET_TOKENS = 200_000
+# Messages (user and model turns) that are never summarized
+KEEP_RECENT_MESSAGES = 6
+SUMMARY_MODEL = "gemini-1.5-flash-002"
+SUMMARY_INTRO = "Summary of the earlier conversation:"
+SUMMARY_ACK = "Understood. I will treat this summary as the earlier part of our conversation."
+
+
+def estimate_tokens(text, chars_per_token=CHARS_PER_TOKEN):
+    """Rough token count from the length of the text"""
+    return int(-(-len(text) // chars_per_token))
+
+
+def reported_tokens(response):
+    """(prompt tokens, reply tokens) from a response's usage metadata, or None if it has none"""
+    try:
+        usage = response.usage_metadata
+        return usage.prompt_token_count, usage.candidates_token_count
+    except Exception:
+        return None
+
+
+def message_role(message):
+    return message["role"] if isinstance(message, dict) else message.role
+
+
+def message_text(message):
+    """Text of a chat turn, whether it is a dict or a Gemini Content object"""
+    parts = message["parts"] if isinstance(message, dict) else message.parts
+    return "\n".join(part if isinstance(part, str) else getattr(part, "text", "") for part in parts)
+
+
+class TokenCounter:
+    """Token estimates per model, with a characters-per-token ratio learned from replies"""
+
+    def __init__(self):
+        self._ratios = {}
+        self._lock = threading.Lock()
+        self.observed = 0
+
+    def count(self, model_name, text):
+        if not text:
+            return 0
+        with self._lock:
+            ratio = self._ratios.get(model_name, CHARS_PER_TOKEN)
+        return estimate_tokens(text, ratio)
+
+    def count_messages(self, model_name, messages):
+        return sum(self.count(model_name, message_text(message)) for message in messages)
+
+    def observe(self, model_name, text, tokens):
+        """Move the model's ratio towards that of a reply and the tokens reported for it"""
+        if not text or not tokens:
+            return
+        with self._lock:
+            ratio = self._ratios.get(model_name, CHARS_PER_TOKEN)
+            self._ratios[model_name] = 0.8 * ratio + 0.2 * (len(text) / tokens)
+            self.observed += 1
+
+    def stats(self):
+        with self._lock:
+            return {"observed": self.observed, "chars_per_token": dict(self._ratios)}
+
+
+def is_summary(message):
+    return message_role(message) == "user" and message_text(message).startswith(SUMMARY_INTRO)
+
+
+def summary_turns(summary):
+    return [
+        {"role": "user", "parts": [f"{SUMMARY_INTRO}\n\n{summary}"]},
+        {"role": "model", "parts": [SUMMARY_ACK]},
+    ]
+
+
+def summary_prompt(previous_summary, turns):
+    """Instructions for folding old turns into the running summary"""
+    transcript = "\n\n".join(
+        f"{'User' if message_role(message) == 'user' else 'Grantbuddy'}: {message_text(message)}" for message in turns
+    )
+    earlier = f"Summary so far:\n{previous_summary}\n\n" if previous_summary else ""
+    return (
+        "Summarize this grant-writing conversation so it can replace the original turns. Keep every "
+        "fact, figure, name, deadline, decision and piece of drafted text the user may refer back to. "
+        "Write it as compact notes.\n\n"
+        f"{earlier}Conversation:\n{transcript}"
+    )
+
+
+class ContextBudget:
+    """Keeps an engine session's context under budget_tokens by summarizing its older turns"""
+
+    def __init__(self, counter, budget_tokens=DEFAULT_BUDGET_TOKENS, keep_recent=KEEP_RECENT_MESSAGES):
+        self.counter = counter
+        self.budget_tokens = budget_tokens
+        self.keep_recent = keep_recent
+
+    def usage(self, session):
+        """Tokens in the session's prefix (system prompt and document) and in its conversation"""
+        prefix = self.counter.count_messages(session.model_name, session.prefix_messages)
+        conversation = self.counter.count_messages(session.model_name, session.conversation())
+        return {"prefix": prefix, "conversation": conversation, "total": prefix + conversation}
+
+    def over_budget(self, session, next_message=""):
+        total = self.usage(session)["total"] + self.counter.count(session.model_name, next_message)
+        return total > self.budget_tokens
+
+    def compact(self, session, generate):
+        """Replace all but the most recent turns with a summary; generate(prompt) returns its text
+
+        Returns the number of turns that were summarized.
+        """
+        conversation = session.conversation()
+        previous_summary = ""
+        if conversation and is_summary(conversation[0]):
+            previous_summary = message_text(conversation[0])[len(SUMMARY_INTRO):].strip()
+            conversation = conversation[2:]
+        split = len(conversation) - self.keep_recent
+        # Cut between a model turn and the next user turn
+        split -= split % 2
+        if split <= 0:
+            return 0
+        summary = generate(summary_prompt(previous_summary, conversation[:split]))
+        prefix = list(session.history)[:session.history_offset]
+        session.history = prefix + summary_turns(summary) + conversation[split:]
+        return split
+
+
+token_counter = TokenCounter()
@@ -0,0 +1,114 @@
+import itertools
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Where each turn spends its time.
+# Each stage of a run is recorded as a span: its name, duration and the counts that explain
+# it (bytes, tokens, pages, model). Runs are numbered, and every span is tagged with the run
+# it belongs to, including spans recorded by generation workers for a turn started in that
+# run. Free-text debug lines are kept as zero-length "event" spans. A session keeps its
+# latest spans in a ring buffer, so the record is bounded however long the session runs, and
+# it can be exported as JSON lines.
+
+MAX_SPANS = 1000
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def format_span(span):
+    """One sidebar line: stage, duration and the span's counts"""
+    details = ", ".join(
+        f"{key} {value:,}" if isinstance(value, int) and not isinstance(value, bool) else f"{key} {value}"
+        for key, value in span.items()
+        if key not in ("run", "stage", "started", "ms")
+    )
+    line = f"{span['stage']}: {span['ms']:,.0f} ms"
+    return f"{line} ({details})" if details else line
+
+
+class Trace:
+    """The latest spans of one session; worker threads may record into it as well"""
+
+    def __init__(self, max_spans=MAX_SPANS):
+        self._spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+        self._runs = itertools.count(1)
+        self.run = 0
+
+    def begin_run(self):
+        """Number the spans recorded from now on as a new run"""
+        self.run = next(self._runs)
+        return self.run
+
+    def add(self, stage, seconds, run=None, **fields):
+        """Record a finished span; run defaults to the current one"""
+        span = {
+            "run": self.run if run is None else run,
+            "stage": stage,
+            "started": round(time.time() - seconds, 3),
+            "ms": round(seconds * 1000, 2),
+        }
+        span.update(fields)
+        with self._lock:
+            self._spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, stage, run=None, **fields):
+        """Time a block; counts can be added to the yielded dict before it ends"""
+        started = time.perf_counter()
+        try:
+            yield fields
+        except BaseException as e:
+            fields["error"] = type(e).__name__
+            raise
+        finally:
+            self.add(stage, time.perf_counter() - started, run, **fields)
+
+    def event(self, message, run=None):
+        """A free-text debug line"""
+        self.add("event", 0.0, run, message=message)
+
+    def spans(self):
+        with self._lock:
+            return list(self._spans)
+
+    def events(self):
+        return [span["message"] for span in self.spans() if span["stage"] == "event"]
+
+    def latest_run(self, *stages):
+        """The latest run that has a span for one of stages, or None"""
+        for span in reversed(self.spans()):
+            if span["stage"] in stages:
+                return span["run"]
+        return None
+
+    def breakdown(self, run):
+        """The spans of one run, slowest first"""
+        spans = [span for span in self.spans() if span["run"] == run and span["stage"] != "event"]
+        return sorted(spans, key=lambda span: span["ms"], reverse=True)
+
+    def stage_summary(self):
+        """{stage: (count, p50 ms, p95 ms)} over every span still in the buffer"""
+        durations = {}
+        for span in self.spans():
+            if span["stage"] != "event":
+                durations.setdefault(span["stage"], []).append(span["ms"])
+        return {
+            stage: (len(values), percentile(values, 0.5), percentile(values, 0.95))
+            for stage, values in durations.items()
+        }
+
+    def to_jsonl(self):
+        return "".join(json.dumps(span, default=str) + "\n" for span in self.spans())
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
@@ -0,0 +1,158 @@
+from collections import OrderedDict
+
+from document_store import document_store
+from pdf_ingest import start_ingest, file_digest, pdf_text_cache, IngestJob, PREVIEW_PAGES
+
+# The set of documents one session is working with.
+# A proposal usually draws on several files (the RFP, a budget template, past reports, the
+# organisation profile). Every uploaded PDF is its own workspace document: it is ingested by
+# its own background job (the jobs run side by side), stored once in the shared document
+# store and indexed separately for retrieval. Each document can be switched off and on
+# without discarding the conversation.
+
+
+class WorkspaceDocument:
+    """One uploaded PDF: its ingest job, its reference in the document store and its toggle"""
+
+    def __init__(self, name, digest, job):
+        self.name = name
+        self.digest = digest
+        self.job = job
+        self.doc = None
+        self.length = 0
+        self.enabled = True
+        # False for documents put back from a saved conversation rather than the uploader
+        self.uploaded = True
+
+    @property
+    def ready(self):
+        return self.doc is not None
+
+    @property
+    def text(self):
+        """The text taken from the ingest job so far, read from the shared store"""
+        if self.doc is None:
+            return ""
+        return self.doc.text[:self.length]
+
+    def refresh(self, store):
+        """Take the pages the job has finished since the last call; True if the text grew"""
+        job = self.job
+        if job.error is not None or not (job.done or job.available_pages >= PREVIEW_PAGES):
+            return False
+        text = job.available_text()
+        if len(text) <= self.length:
+            return False
+        if self.doc is None:
+            self.doc = store.put(self.digest, text, acquire=True)
+        else:
+            store.put(self.digest, text)
+        self.length = len(text)
+        return True
+
+    def release(self):
+        if self.doc is not None:
+            self.doc.release()
+        self.doc = None
+        self.length = 0
+
+    def report(self, store):
+        """Ingest throughput and memory for the sidebar"""
+        info = store.info(self.digest)
+        job = self.job
+        if job.error is not None:
+            return "could not be read"
+        if job.page_count == 0:
+            ingest = "from cache"
+        else:
+            ingest = f"{job.pages_done}/{job.page_count} pages, {job.pages_per_second:.1f} pages/s"
+        return f"{ingest}, {info['bytes'] / 1024:,.0f} KB shared by {info['references']} sessions"
+
+
+class Workspace:
+    """The PDFs a session has uploaded, in upload order"""
+
+    def __init__(self, store=document_store):
+        self.store = store
+        self.documents = OrderedDict()
+
+    def sync(self, files):
+        """Match the uploader's files: start ingesting new ones and drop removed ones
+
+        files is a list of (name, bytes). Returns the documents that were added.
+        """
+        added = []
+        digests = set()
+        for name, data in files:
+            digest = file_digest(data)
+            digests.add(digest)
+            if digest not in self.documents:
+                try:
+                    job = start_ingest(data, digest=digest)
+                except Exception as e:
+                    # A file that isn't a readable PDF is listed as failed; the uploader keeps it, so it
+                    # must not raise again on every rerun
+                    job = IngestJob.from_error(digest, e)
+                # Identical files uploaded under two names are kept once
+                self.documents[digest] = WorkspaceDocument(name, digest, job)
+                added.append(self.documents[digest])
+            self.documents[digest].uploaded = True
+        removed = [digest for digest, document in self.documents.items() if document.uploaded and digest not in digests]
+        for digest in removed:
+            self.documents.pop(digest).release()
+        return added
+
+    def restore(self, saved):
+        """Put back documents of a saved conversation whose text is still in the PDF cache
+
+        saved is a list of [name, digest, enabled] as returned by saved(). Restored documents stay
+        until the chat is cleared, since the uploader no longer lists them. Returns the documents
+        that were restored.
+        """
+        restored = []
+        for name, digest, enabled in saved:
+            text = pdf_text_cache.get(digest)
+            if digest in self.documents or text is None:
+                continue
+            document = WorkspaceDocument(name, digest, IngestJob.from_text(digest, text))
+            document.enabled = enabled
+            document.uploaded = False
+            self.documents[digest] = document
+            restored.append(document)
+        self.refresh()
+        return restored
+
+    def saved(self):
+        """[name, digest, enabled] of every document, to store with a conversation"""
+        return [[document.name, document.digest, document.enabled] for document in self.documents.values()]
+
+    def refresh(self):
+        """Pick up newly extracted pages; returns the documents whose text grew"""
+        return [document for document in self.documents.values() if document.refresh(self.store)]
+
+    def ingesting(self):
+        return [document for document in self.documents.values() if not document.job.done]
+
+    def failed(self):
+        return [document for document in self.documents.values() if document.job.error is not None]
+
+    def enabled(self):
+        """Documents switched on that have text to use"""
+        return [document for document in self.documents.values() if document.enabled and document.ready]
+
+    def key(self):
+        """Identifies the enabled text, to tell when a chat built on it is out of date"""
+        return tuple((document.digest, document.length) for document in self.enabled())
+
+    def sources(self):
+        """(name, text) of every enabled document"""
+        return [(document.name, document.text) for document in self.enabled()]
+
+    def combined_text(self):
+        """All enabled documents as one text, each under its file name"""
+        return "\n\n".join(f"### Document: {name}\n\n{text}" for name, text in self.sources())
+
+    def clear(self):
+        for document in self.documents.values():
+            document.release()
+        self.documents.clear()